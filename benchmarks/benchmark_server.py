@@ -0,0 +1,43 @@
+#
+# Runs the API under waitress for the load test, with a local stub in place of the token validation.
+# Usage: python benchmarks/benchmark_server.py [--port 7102] [--threads 8] [--response-cache]
+# @version 1.0
+#
+
+import sys
+import argparse
+import importlib
+sys.path.append('.')
+
+from waitress import serve
+from permafrost_observations_api.web.views import *
+from permafrost_observations_api import permafrost_observations_factory
+
+class StubTokenValidator:
+    # Accepts every bearer token: the load test measures the API, not the identity provider.
+    def validate_token(self, token):
+        return True
+
+    def stats(self):
+        return {'stub': True}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve the API for the load test.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=7102)
+    parser.add_argument('--threads', type=int, default=8, help='waitress worker threads')
+    parser.add_argument('--response-cache', action='store_true', help='keep the response cache enabled')
+    parser.add_argument('--database-uri', help='database to serve, the one of client_secrets.json by default')
+    args = parser.parse_args()
+
+    app = permafrost_observations_factory.create_app(__name__)
+    if args.database_uri:
+        app.config['SQLALCHEMY_DATABASE_URI'] = args.database_uri
+    app.config['DEBUG'] = False
+    app.config['RESPONSE_CACHE_ENABLED'] = args.response_cache
+    app.app_context().push()
+    permafrost_observations_factory.register_blueprints(app)
+    # The package re-exports the decorator under the name of its module, the module is looked up by name.
+    importlib.import_module('permafrost_observations_api.decorators.authorization').token_validator = \
+        StubTokenValidator()
+    serve(app, host=args.host, port=args.port, threads=args.threads)
@@ -0,0 +1,66 @@
+#
+# Compares two baselines written by load_test.py, scenario by scenario.
+# Exits with status 1 when a scenario lost more than --threshold percent of throughput or gained more than
+# --threshold percent of p95 latency, so it can gate a change in a script.
+# Usage: python benchmarks/compare_baselines.py before.json after.json [--threshold 10]
+# @version 1.0
+#
+
+import sys
+import json
+import argparse
+
+# (label, getter, True when higher is better)
+METRICS = [
+    ('req/s', lambda result: result['throughput_rps'], True),
+    ('p50 ms', lambda result: result['latency_ms']['p50'], False),
+    ('p95 ms', lambda result: result['latency_ms']['p95'], False),
+    ('p99 ms', lambda result: result['latency_ms']['p99'], False),
+    ('db ms', lambda result: result['server_ms']['db_execute'], False),
+    ('rss MB', lambda result: result['peak_rss_mb'], False)
+]
+
+def get_change(before, after):
+    if before == None or after == None or before == 0:
+        return None
+    return (after - before) * 100.0 / before
+
+def format_change(change):
+    return '%+7.1f%%' % change if change != None else '       -'
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare two load test baselines.')
+    parser.add_argument('before')
+    parser.add_argument('after')
+    parser.add_argument('--threshold', type=float, default=10, help='percent of change reported as a regression')
+    args = parser.parse_args()
+
+    with open(args.before) as before_file:
+        before = json.load(before_file)
+    with open(args.after) as after_file:
+        after = json.load(after_file)
+    if before.get('seed') != None and after.get('seed') != None:
+        for key in ['locations', 'depths', 'years', 'step', 'observations']:
+            if before['seed'].get(key) != after['seed'].get(key):
+                print('warning: the baselines were seeded at different scales (' + key + ')', file=sys.stderr)
+                break
+    if before.get('settings') != after.get('settings'):
+        print('warning: the baselines were run with different settings', file=sys.stderr)
+
+    print('%-34s ' % ('before ' + str(before.get('commit'))[:10] + ' after ' + str(after.get('commit'))[:10]) +
+          ' '.join('%8s' % label for label, getter, higher_is_better in METRICS))
+    regressions = []
+    for name in sorted(set(before['scenarios']) & set(after['scenarios'])):
+        changes = []
+        for label, getter, higher_is_better in METRICS:
+            change = get_change(getter(before['scenarios'][name]), getter(after['scenarios'][name]))
+            changes.append(change)
+            if change != None and label in ('req/s', 'p95 ms'):
+                if (-change if higher_is_better else change) > args.threshold:
+                    regressions.append(name + ' ' + label + ' ' + format_change(change).strip())
+        print('%-34s ' % name + ' '.join(format_change(change) for change in changes))
+    for name in sorted(set(before['scenarios']) ^ set(after['scenarios'])):
+        print('%-34s only in %s' % (name, 'before' if name in before['scenarios'] else 'after'))
+    if regressions:
+        print('regressions over ' + str(args.threshold) + '%: ' + ', '.join(regressions), file=sys.stderr)
+        sys.exit(1)
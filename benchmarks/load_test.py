@@ -0,0 +1,423 @@
+#
+# Load test of every endpoint against a database seeded by seed_database.py.
+# Starts benchmark_server.py (or uses --url), then runs each scenario with --concurrency clients for
+# --duration seconds and reports per scenario the throughput, the client latency percentiles, the bytes
+# per response, the peak RSS of the server and the server time per phase (auth, db_execute, fetch,
+# serialize, other) read from its /metrics endpoint. The report is a JSON baseline, compare two of them
+# with compare_baselines.py.
+# Usage: python benchmarks/load_test.py [--concurrency 8] [--duration 10] [--writes] [--output baseline.json]
+# @version 1.0
+#
+
+import os
+import re
+import sys
+import json
+import math
+import time
+import random
+import platform
+import argparse
+import threading
+import subprocess
+from decimal import Decimal
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+import requests
+from sqlalchemy import create_engine
+from sqlalchemy.sql import text
+
+API_PREFIX = '/permafrost_observations_api'
+LOCATION_PATTERN = 'BENCH-*'
+HEADERS = {'Authorization': 'Bearer benchmark'}
+PHASES = ['auth', 'db_execute', 'fetch', 'serialize', 'other']
+METRIC_LINE = re.compile(r'^permafrost_api_request_(phase_seconds|duration_seconds)_(sum|count)'
+                         r'\{route="([^"]*)",method="([^"]*)"(?:,phase="([^"]*)")?\} (\S+)$')
+
+def get_location(context, client, number):
+    return context['locations'][(client + number) % len(context['locations'])]
+
+def get_two_locations(context, client, number):
+    return get_location(context, client, number) + '&location=' + get_location(context, client, number + 1)
+
+def get(path):
+    # GET scenario of a path template filled with a location, a second location, dates and an offset.
+    def make_request(context, client, number):
+        return 'GET', path.format(location=get_location(context, client, number),
+                                  locations=get_two_locations(context, client, number),
+                                  start_date=context['start_date'], end_date=context['end_date'],
+                                  offset=(number * 100) % 5000), None, None
+    return make_request
+
+def download_zip(context, client, number):
+    names = [get_location(context, client, number + i) for i in range(3)]
+    return 'POST', '/download_observations_time_temperature', json.dumps(names), 'application/json'
+
+def update_marker(context, client, number):
+    return 'PUT', '/locations_of_observations_as_markers', \
+        json.dumps(context['markers'][(client + number) % len(context['markers'])]), 'application/json'
+
+def insert_marker(context, client, number):
+    name = 'BENCH-TMP-%s-%d-%d' % (context['run'], client, number)
+    with context['lock']:
+        context['created'].append(name)
+    marker = {'text': name, 'lat': 70.0 + client / 100.0, 'lng': -120.0 + number / 1000.0,
+              'comment': 'Load test marker', 'accuracy_in_metres': 5, 'elevation_in_metres': 10,
+              'record_observations': 'temperature'}
+    return 'POST', '/locations_of_observations_as_markers', json.dumps(marker), 'application/json'
+
+def delete_marker(context, client, number):
+    # Deletes the markers created by the insert scenario, the client stops when none is left.
+    with context['lock']:
+        if not context['created']:
+            return None
+        name = context['created'].pop()
+    return 'DELETE', '/locations_of_observations_as_markers', json.dumps({'text': name}), 'application/json'
+
+def bulk_upsert(context, client, number):
+    return 'POST', '/locations_of_observations_as_markers/bulk', json.dumps(context['markers']), 'application/json'
+
+def ingest(context, client, number):
+    # Observations already seeded: the ingest validates, stages and skips them as duplicates.
+    location = get_location(context, client, number)
+    lines = []
+    for hour in range(24):
+        for height in context['heights'][location]:
+            lines.append(json.dumps({'location': location, 'sensor': 'bench_ground_temperature',
+                                     'time': context['first_day'] + 'T%02d:00:00Z' % hour,
+                                     'height': height, 'value': 0, 'unit': 'C'}))
+    return 'POST', '/observations/ingest', '\n'.join(lines) + '\n', 'application/x-ndjson'
+
+SCENARIOS = [
+    ('locations_of_observations', get('/locations_of_observations?name_pattern=' + LOCATION_PATTERN)),
+    ('locations_of_observations_count', get('/locations_of_observations/count')),
+    ('markers', get('/locations_of_observations_as_markers')),
+    ('markers_clustered', get('/locations_of_observations_as_markers?zoom=3&bbox=-141,55,-52,80')),
+    ('location_summary', get('/locations_of_observations/summary?location={location}')),
+    ('ground_temperatures', get('/ground_temperatures?location={location}')),
+    ('ground_temperatures_page', get('/ground_temperatures?location={location}&limit=100&offset={offset}')),
+    ('ground_temperatures_monthly', get('/ground_temperatures?location={location}&resolution=monthly')),
+    ('ground_temperatures_columnar', get('/ground_temperatures?location={location}&format=columnar')),
+    ('ground_temperatures_binary', get('/ground_temperatures?location={location}&format=binary')),
+    ('ground_temperatures_downsampled', get('/ground_temperatures?location={location}&max_points=500')),
+    ('ground_temperatures_batch', get('/ground_temperatures/batch?location={locations}&resolution=monthly')),
+    ('ground_temperatures_count', get('/ground_temperatures/count?location={location}')),
+    ('ground_temperature_heights', get('/ground_temperatures/height?location={location}')),
+    ('ground_thermal_regime', get('/ground_thermal_regime?location={location}'
+                                  '&start_date={start_date}&end_date={end_date}')),
+    ('ground_thermal_regime_multi_year', get('/ground_thermal_regime?location={location}&multi_year=true'
+                                             '&start_date={start_date}&end_date={end_date}')),
+    ('ground_thermal_regime_batch', get('/ground_thermal_regime/batch?location={locations}'
+                                        '&start_date={start_date}&end_date={end_date}')),
+    ('observations_range', get('/observations/range?location={location}')),
+    ('observations_categories', get('/observations/categories?location={location}')),
+    ('download_time_temperature', get('/download_observation_time_temperature?location={location}')),
+    ('download_temperature_height', get('/download_observation_temperature_height?location={location}'
+                                        '&start_date={start_date}&end_date={end_date}')),
+    ('download_zip', download_zip)
+]
+
+# Run with --writes, they write to the benchmark locations only and leave them as seeded.
+WRITE_SCENARIOS = [
+    ('marker_update', update_marker),
+    ('marker_insert', insert_marker),
+    ('marker_delete', delete_marker),
+    ('markers_bulk_upsert', bulk_upsert),
+    ('observations_ingest', ingest)
+]
+
+def percentile(values, fraction):
+    # Nearest rank of sorted values.
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(math.ceil(fraction * len(values))) - 1))]
+
+def read_rss(pid, field='VmRSS'):
+    # Resident set size of the server in MB, None where /proc is not available.
+    try:
+        with open('/proc/' + str(pid) + '/status') as status:
+            for line in status:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 1024.0
+    except (IOError, ValueError):
+        return None
+    return None
+
+def read_metrics(url):
+    """
+    :return: Dictionary of (route, method, phase or 'duration') to (sum of seconds, count)
+    """
+    metrics = {}
+    response = requests.get(url + API_PREFIX + '/metrics', headers=HEADERS)
+    response.raise_for_status()
+    for line in response.text.splitlines():
+        match = METRIC_LINE.match(line)
+        if match == None:
+            continue
+        kind, field, route, method, phase, value = match.groups()
+        key = (route, method, phase if kind == 'phase_seconds' else 'duration')
+        total, count = metrics.get(key, (0.0, 0))
+        metrics[key] = (float(value), count) if field == 'sum' else (total, int(float(value)))
+    return metrics
+
+def get_server_phases(before, after):
+    # Mean server time per request of each phase, for the routes the scenario called.
+    phases = {}
+    for phase in ['duration'] + PHASES:
+        total = 0.0
+        count = 0
+        for key, (value, calls) in after.items():
+            if key[2] != phase or key[0].endswith('/metrics'):
+                continue
+            previous_value, previous_calls = before.get(key, (0.0, 0))
+            total += value - previous_value
+            count += calls - previous_calls
+        phases[phase] = round(total * 1000 / count, 3) if count else None
+    return phases
+
+def run_clients(url, make_request, context, concurrency, duration, max_requests=None):
+    """
+    :return: (list of (latency in seconds, status, bytes) per request, elapsed seconds)
+    """
+    samples = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def client(client_id):
+        session = requests.Session()
+        session.headers.update(HEADERS)
+        number = 0
+        results = []
+        while time.perf_counter() < deadline and (max_requests == None or number < max_requests):
+            request = make_request(context, client_id, number)
+            if request == None:
+                break
+            method, path, body, content_type = request
+            headers = {'Content-Type': content_type} if content_type != None else {}
+            start = time.perf_counter()
+            try:
+                response = session.request(method, url + API_PREFIX + path, data=body, headers=headers)
+                results.append((time.perf_counter() - start, response.status_code, len(response.content)))
+            except requests.RequestException:
+                results.append((time.perf_counter() - start, None, 0))
+            number += 1
+        session.close()
+        with lock:
+            samples.extend(results)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, time.perf_counter() - start
+
+def run_scenario(url, name, make_request, context, args, server_pid):
+    if args.warmup > 0 and name not in ('marker_insert', 'marker_delete'):
+        run_clients(url, make_request, context, args.concurrency, args.warmup)
+    before = read_metrics(url)
+    peak_rss = [read_rss(server_pid) if server_pid != None else None]
+    sampling = threading.Event()
+
+    def sample_rss():
+        while not sampling.wait(0.05):
+            rss = read_rss(server_pid)
+            if rss != None and (peak_rss[0] == None or rss > peak_rss[0]):
+                peak_rss[0] = rss
+
+    sampler = threading.Thread(target=sample_rss)
+    if server_pid != None:
+        sampler.start()
+    samples, elapsed = run_clients(url, make_request, context, args.concurrency, args.duration, args.max_requests)
+    sampling.set()
+    if server_pid != None:
+        sampler.join()
+    after = read_metrics(url)
+
+    latencies = sorted(latency for latency, status, size in samples)
+    statuses = {}
+    for latency, status, size in samples:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    errors = sum(1 for latency, status, size in samples if status == None or status >= 400)
+    return {
+        'requests': len(samples),
+        'errors': errors,
+        'statuses': statuses,
+        'seconds': round(elapsed, 3),
+        'throughput_rps': round(len(samples) / elapsed, 2) if elapsed > 0 else None,
+        'latency_ms': {
+            'mean': round(sum(latencies) * 1000 / len(latencies), 3) if latencies else None,
+            'p50': round(percentile(latencies, 0.50) * 1000, 3) if latencies else None,
+            'p95': round(percentile(latencies, 0.95) * 1000, 3) if latencies else None,
+            'p99': round(percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+            'max': round(latencies[-1] * 1000, 3) if latencies else None
+        },
+        'bytes_per_response': round(sum(size for latency, status, size in samples) / len(samples)) if samples else None,
+        'peak_rss_mb': round(peak_rss[0], 1) if peak_rss[0] != None else None,
+        'server_ms': get_server_phases(before, after)
+    }
+
+def delete_markers(session, url, names):
+    for name in names:
+        session.delete(url + API_PREFIX + '/locations_of_observations_as_markers', json={'text': name}, headers=HEADERS)
+
+def get_context(url, seed):
+    # Benchmark locations, their depths and a year of observations, read through the API.
+    session = requests.Session()
+    session.headers.update(HEADERS)
+    response = session.get(url + API_PREFIX + '/locations_of_observations_as_markers',
+                           params={'name_pattern': LOCATION_PATTERN})
+    response.raise_for_status()
+    markers = [marker for marker in response.json() if marker['name'].startswith('BENCH-')]
+    # Markers left by an interrupted run of the insert scenario.
+    delete_markers(session, url, [marker['name'] for marker in markers if marker['name'].startswith('BENCH-TMP-')])
+    markers = [marker for marker in markers if not marker['name'].startswith('BENCH-TMP-')]
+    if not markers:
+        sys.exit("no benchmark locations, run benchmarks/seed_database.py first")
+    markers.sort(key=lambda marker: marker['name'])
+    locations = [marker['name'] for marker in markers]
+    summary = session.get(url + API_PREFIX + '/locations_of_observations/summary',
+                          params={'location': locations[0]}).json()
+    # Timestamps are HTTP dates, as flask.jsonify formats them.
+    first_year = parsedate_to_datetime(summary['first_time']).year if summary.get('first_time') else 1990
+    heights = {}
+    for location in locations:
+        heights[location] = [row['height'] for row in session.get(url + API_PREFIX + '/ground_temperatures/height',
+                                                                 params={'location': location}).json()]
+    random.Random(seed).shuffle(locations)
+    return {
+        'locations': locations,
+        'markers': [dict((key, marker.get(key)) for key in ['text', 'lat', 'lng', 'comment', 'accuracy_in_metres',
+                                                            'elevation_in_metres', 'record_observations'])
+                    for marker in markers],
+        'heights': heights,
+        'start_date': '%d-01-01' % first_year,
+        'end_date': '%d-01-01' % (first_year + 1),
+        'first_day': '%d-01-01' % first_year,
+        'run': '%x' % int(time.time()),
+        'created': [],
+        'lock': threading.Lock()
+    }
+
+def get_database_uri(args):
+    if args.database_uri:
+        return args.database_uri
+    with open('client_secrets.json') as client_secrets_file:
+        return json.load(client_secrets_file).get('postgres').get('database_uri')
+
+def read_seed(args):
+    # Scale of the last seed, None when the database cannot be read from here.
+    try:
+        engine = create_engine(get_database_uri(args))
+        with engine.connect() as connection:
+            row = connection.execute(text("SELECT * FROM benchmark_seed ORDER BY seeded_at DESC LIMIT 1")).first()
+        engine.dispose()
+    except Exception:
+        return None
+    if row == None:
+        return None
+    seed = {}
+    for key, value in row._mapping.items():
+        seed[key] = str(value) if key == 'seeded_at' else float(value) if isinstance(value, Decimal) else value
+    return seed
+
+def get_commit():
+    try:
+        repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=repository,
+                                         stderr=subprocess.DEVNULL).decode().strip()
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD'], cwd=repository, stderr=subprocess.DEVNULL) != 0
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+def start_server(args):
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_server.py'),
+               '--port', str(args.port), '--threads', str(args.server_threads)]
+    if args.response_cache:
+        command.append('--response-cache')
+    if args.database_uri:
+        command.extend(['--database-uri', args.database_uri])
+    server = subprocess.Popen(command)
+    url = 'http://127.0.0.1:' + str(args.port)
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if server.poll() != None:
+            sys.exit("the benchmark server exited with status " + str(server.returncode))
+        try:
+            requests.get(url + API_PREFIX + '/metrics', headers=HEADERS).raise_for_status()
+            return server, url
+        except requests.RequestException:
+            time.sleep(0.2)
+    server.terminate()
+    sys.exit("the benchmark server did not start within 60 s")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load test the API and write a JSON baseline.')
+    parser.add_argument('--url', help='API already running with a stub token validator, started otherwise')
+    parser.add_argument('--port', type=int, default=7102, help='port of the server started by the load test')
+    parser.add_argument('--server-threads', type=int, default=8)
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrent clients per scenario')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per scenario')
+    parser.add_argument('--warmup', type=float, default=1, help='seconds of warm up before each scenario')
+    parser.add_argument('--max-requests', type=int, help='requests per client and scenario at most')
+    parser.add_argument('--scenarios', help='comma separated names of the scenarios to run')
+    parser.add_argument('--writes', action='store_true', help='also run the scenarios that write')
+    parser.add_argument('--response-cache', action='store_true', help='keep the response cache of the server enabled')
+    parser.add_argument('--database-uri', help='database of the server, the one of client_secrets.json by default')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the order of the locations')
+    parser.add_argument('--output', help='file of the JSON baseline, printed when missing')
+    args = parser.parse_args()
+
+    scenarios = SCENARIOS + (WRITE_SCENARIOS if args.writes else [])
+    if args.scenarios:
+        names = args.scenarios.split(',')
+        unknown = set(names) - set(name for name, make_request in SCENARIOS + WRITE_SCENARIOS)
+        if unknown:
+            sys.exit("unknown scenarios: " + ', '.join(sorted(unknown)))
+        scenarios = [(name, make_request) for name, make_request in SCENARIOS + WRITE_SCENARIOS if name in names]
+
+    server = None
+    url = args.url.rstrip('/') if args.url else None
+    if url == None:
+        server, url = start_server(args)
+    try:
+        context = get_context(url, args.seed)
+        commit, dirty = get_commit()
+        baseline = {
+            'commit': commit,
+            'dirty': dirty,
+            'created_at': datetime.utcnow().isoformat() + 'Z',
+            'python': platform.python_version(),
+            'settings': {
+                'concurrency': args.concurrency,
+                'duration': args.duration,
+                'warmup': args.warmup,
+                'max_requests': args.max_requests,
+                'server_threads': args.server_threads if server != None else None,
+                'response_cache': args.response_cache,
+                'locations': len(context['locations'])
+            },
+            'seed': read_seed(args),
+            'scenarios': {}
+        }
+        for name, make_request in scenarios:
+            result = run_scenario(url, name, make_request, context, args, server.pid if server != None else None)
+            baseline['scenarios'][name] = result
+            print('%-34s %8s req/s  p50 %9s ms  p95 %9s ms  p99 %9s ms  db %8s ms  errors %d' % (
+                name, result['throughput_rps'], result['latency_ms']['p50'], result['latency_ms']['p95'],
+                result['latency_ms']['p99'], result['server_ms']['db_execute'], result['errors']), file=sys.stderr)
+        if server != None:
+            baseline['server_peak_rss_mb'] = read_rss(server.pid, 'VmHWM')
+        # Markers the delete scenario had no time to delete.
+        delete_markers(requests.Session(), url, context['created'])
+    finally:
+        if server != None:
+            server.terminate()
+            server.wait()
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(baseline, output, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(baseline, indent=2, sort_keys=True))
@@ -0,0 +1,233 @@
+#
+# Seeds a local PostGIS database with synthetic boreholes for the load test.
+# Each borehole (location BENCH-0001, ...) gets hourly ground temperatures at every depth over the
+# requested years, an annual cycle damped and delayed with depth, and a stratigraphy log. The base tables
+# are created when the database has none, then the derived tables are created and refreshed as
+# make_rollup.py does. The scale is recorded in the benchmark_seed table and reported by load_test.py.
+# Usage: python benchmarks/seed_database.py [--locations 10] [--depths 10] [--years 5] [--reset]
+# @version 1.0
+#
+
+import sys
+import math
+import time
+import random
+import argparse
+from datetime import datetime, timezone
+sys.path.append('.')
+
+from sqlalchemy.sql import text
+from sqlalchemy.engine.url import make_url
+from permafrost_observations_api import permafrost_observations_factory
+from permafrost_observations_api.extensions import db
+from permafrost_observations_api.providers.temperature_rollup_provider import TemperatureRollupProvider
+from permafrost_observations_api.providers.data_version_provider import DataVersionProvider
+from permafrost_observations_api.providers.location_import_provider import LocationImportProvider
+from permafrost_observations_api.providers.observation_ingest_provider import ObservationIngestProvider
+from permafrost_observations_api.providers.location_summary_provider import LocationSummaryProvider, \
+    STRATIGRAPHY_LABELS
+
+LOCATION_PREFIX = 'BENCH-'
+TEMPERATURE_SENSOR = 'bench_ground_temperature'
+LOCAL_HOSTS = (None, '', 'localhost', '127.0.0.1', '::1')
+
+# Only used when the database has no locations table, the production schema is created elsewhere.
+BASE_SCHEMA_SQL = [
+    "CREATE EXTENSION IF NOT EXISTS postgis",
+    """CREATE TABLE locations (
+           name TEXT,
+           coordinates geometry(Geometry, 4326),
+           elevation_in_metres NUMERIC,
+           comment TEXT,
+           record_observations TEXT,
+           accuracy_in_metres NUMERIC)""",
+    """CREATE TABLE sensors (
+           id SERIAL PRIMARY KEY,
+           label TEXT)""",
+    """CREATE TABLE observations (
+           location geometry(Geometry, 4326),
+           sensor_id INTEGER,
+           corrected_utc_time TIMESTAMPTZ,
+           height_min_metres NUMERIC,
+           height_max_metres NUMERIC,
+           numeric_value NUMERIC,
+           text_value TEXT,
+           unit_of_measure TEXT)""",
+    "CREATE INDEX observations_location ON observations (location)"
+]
+
+SEED_SCHEMA_SQL = """CREATE TABLE IF NOT EXISTS benchmark_seed (
+                         seeded_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                         locations INTEGER,
+                         depths INTEGER,
+                         years INTEGER,
+                         start_year INTEGER,
+                         step TEXT,
+                         seed INTEGER,
+                         observations BIGINT,
+                         seconds NUMERIC)"""
+
+# Heights are negative below the ground surface. The annual wave is damped by exp(-depth / 2) and
+# delayed by depth / 2 radians, as heat diffuses in frozen ground.
+TEMPERATURES_SQL = """INSERT INTO observations (location, sensor_id, corrected_utc_time, height_min_metres,
+                                               height_max_metres, numeric_value, unit_of_measure)
+                      SELECT locations.coordinates, :sensor_id, time, -depth, -depth,
+                             round(CAST(:mean_temperature
+                                        + :amplitude * exp(-depth / 2.0)
+                                          * sin(2 * pi() * extract(epoch FROM time) / 31557600.0 - depth / 2.0)
+                                        + (random() - 0.5) * 0.1 AS numeric), 3),
+                             'C'
+                        FROM locations
+                             CROSS JOIN unnest(CAST(:depths AS double precision[])) AS depth
+                             CROSS JOIN generate_series(CAST(:start_time AS timestamptz),
+                                                        CAST(:end_time AS timestamptz) - CAST(:step AS interval),
+                                                        CAST(:step AS interval)) AS time
+                       WHERE locations.name = :name"""
+
+STRATIGRAPHY_VALUES = {
+    'geo_class_1': ['Organic', 'Silt', 'Sand', 'Gravel', 'Clay', 'Bedrock'],
+    'ice_visual_perc': ['0', '5', '10', '25', '50'],
+    'ice_description': ['Nf', 'Nbn', 'Vx', 'Vs', 'ICE'],
+    'geo_description': ['Peat', 'Silty sand', 'Sandy gravel', 'Till', 'Shale']
+}
+
+def get_depths(count):
+    # Logger strings are denser near the surface: 0.1 m, then geometrically down to 20 m.
+    if count == 1:
+        return [0.1]
+    return [round(0.1 * math.pow(200, i / (count - 1)), 2) for i in range(count)]
+
+def check_local(uri, allow_remote):
+    host = make_url(uri).host
+    if host not in LOCAL_HOSTS and not allow_remote:
+        sys.exit("refusing to seed " + str(host) + ", the load test seeds a local database (--allow-remote)")
+
+def get_sensor_id(label):
+    sensor_id = db.session.execute(text("SELECT id FROM sensors WHERE label = :label ORDER BY id LIMIT 1"),
+                                   {'label': label}).scalar()
+    if sensor_id == None:
+        sensor_id = db.session.execute(text("INSERT INTO sensors (label) VALUES (:label) RETURNING id"),
+                                       {'label': label}).scalar()
+    return sensor_id
+
+def reset():
+    db.session.execute(text("""DELETE FROM observations
+                               WHERE location IN (SELECT coordinates FROM locations WHERE name LIKE :prefix)"""),
+                       {'prefix': LOCATION_PREFIX + '%'})
+    db.session.execute(text("DELETE FROM locations WHERE name LIKE :prefix"), {'prefix': LOCATION_PREFIX + '%'})
+    db.session.commit()
+
+def seed_locations(args, generator):
+    existing = db.session.execute(text("SELECT count(*) FROM locations WHERE name LIKE :prefix"),
+                                  {'prefix': LOCATION_PREFIX + '%'}).scalar()
+    if existing:
+        sys.exit(str(existing) + " benchmark locations already exist, use --reset to seed them again")
+    locations = []
+    for i in range(1, args.locations + 1):
+        location = {
+            'name': LOCATION_PREFIX + '%04d' % i,
+            'lat': round(generator.uniform(60, 75), 5),
+            'lng': round(generator.uniform(-140, -60), 5),
+            'elevation_in_metres': round(generator.uniform(0, 600), 1),
+            'accuracy_in_metres': 5,
+            'comment': 'Synthetic borehole for the load test',
+            'record_observations': 'temperature'
+        }
+        db.session.execute(text("""INSERT INTO locations (name, coordinates, elevation_in_metres, comment,
+                                                         record_observations, accuracy_in_metres)
+                                   VALUES (:name, ST_SetSRID(ST_MakePoint(:lng, :lat), 4326), :elevation_in_metres,
+                                           :comment, :record_observations, :accuracy_in_metres)"""), location)
+        locations.append(location)
+    db.session.commit()
+    return locations
+
+def seed_observations(args, locations, generator):
+    depths = get_depths(args.depths)
+    temperature_sensor = get_sensor_id(TEMPERATURE_SENSOR)
+    stratigraphy_sensors = dict((label, get_sensor_id(label)) for label in STRATIGRAPHY_LABELS)
+    db.session.execute(text("SELECT setseed(:seed)"), {'seed': (args.seed % 1000) / 1000.0})
+    total = 0
+    for location in locations:
+        params = {
+            'name': location['name'],
+            'sensor_id': temperature_sensor,
+            'depths': depths,
+            'step': args.step,
+            'mean_temperature': round(generator.uniform(-8, 1), 2),
+            'amplitude': round(generator.uniform(10, 20), 2)
+        }
+        # One statement per year keeps the transition tables of the observation triggers small.
+        for year in range(args.start_year, args.start_year + args.years):
+            params['start_time'] = datetime(year, 1, 1, tzinfo=timezone.utc)
+            params['end_time'] = datetime(year + 1, 1, 1, tzinfo=timezone.utc)
+            total += db.session.execute(text(TEMPERATURES_SQL), params).rowcount
+            db.session.commit()
+        # Stratigraphy log: one interval per layer, observed when the borehole was drilled.
+        bottom = 0.0
+        while bottom < depths[-1]:
+            top, bottom = bottom, round(bottom + generator.uniform(0.5, 4), 2)
+            for label, sensor_id in stratigraphy_sensors.items():
+                db.session.execute(text("""INSERT INTO observations (location, sensor_id, corrected_utc_time,
+                                                                    height_min_metres, height_max_metres, text_value)
+                                           SELECT coordinates, :sensor_id, :time, :top, :bottom, :value
+                                             FROM locations WHERE name = :name"""),
+                                   {'name': location['name'], 'sensor_id': sensor_id, 'top': -top, 'bottom': -bottom,
+                                    'time': datetime(args.start_year, 1, 1, tzinfo=timezone.utc),
+                                    'value': generator.choice(STRATIGRAPHY_VALUES[label])})
+                total += 1
+        db.session.commit()
+        print(location['name'] + ': ' + str(total) + ' observations', file=sys.stderr)
+    return total
+
+def create_derived_tables():
+    DataVersionProvider().create_schema()
+    LocationImportProvider().create_schema()
+    ObservationIngestProvider().create_schema()
+    rollup_provider = TemperatureRollupProvider()
+    rollup_provider.create_schema()
+    rollup_provider.refresh(full=True)
+    summary_provider = LocationSummaryProvider()
+    summary_provider.create_schema()
+    summary_provider.refresh(full=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Seed a local database with synthetic boreholes.')
+    parser.add_argument('--locations', type=int, default=10, help='number of boreholes')
+    parser.add_argument('--depths', type=int, default=10, help='number of temperature depths per borehole')
+    parser.add_argument('--years', type=int, default=5, help='years of observations per borehole')
+    parser.add_argument('--start-year', type=int, default=1990)
+    parser.add_argument('--step', default='1 hour', help='interval between two observations of a depth')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the random values')
+    parser.add_argument('--reset', action='store_true', help='delete the benchmark locations and observations first')
+    parser.add_argument('--database-uri', help='database to seed, the one of client_secrets.json by default')
+    parser.add_argument('--allow-remote', action='store_true', help='seed a database that is not on this host')
+    args = parser.parse_args()
+
+    app = permafrost_observations_factory.create_app(__name__)
+    if args.database_uri:
+        app.config['SQLALCHEMY_DATABASE_URI'] = args.database_uri
+    check_local(app.config['SQLALCHEMY_DATABASE_URI'], args.allow_remote)
+    generator = random.Random(args.seed)
+    start = time.perf_counter()
+    with app.app_context():
+        if not db.session.execute(text("SELECT to_regclass('locations') IS NOT NULL")).scalar():
+            for sql_statement in BASE_SCHEMA_SQL:
+                db.session.execute(text(sql_statement))
+            db.session.commit()
+        if args.reset:
+            reset()
+        locations = seed_locations(args, generator)
+        total = seed_observations(args, locations, generator)
+        create_derived_tables()
+        seconds = round(time.perf_counter() - start, 1)
+        db.session.execute(text(SEED_SCHEMA_SQL))
+        db.session.execute(text("""INSERT INTO benchmark_seed (locations, depths, years, start_year, step, seed,
+                                                              observations, seconds)
+                                   VALUES (:locations, :depths, :years, :start_year, :step, :seed,
+                                           :observations, :seconds)"""),
+                           {'locations': args.locations, 'depths': args.depths, 'years': args.years,
+                            'start_year': args.start_year, 'step': args.step, 'seed': args.seed,
+                            'observations': total, 'seconds': seconds})
+        db.session.commit()
+    print('seeded ' + str(args.locations) + ' locations and ' + str(total) + ' observations in ' +
+          str(seconds) + ' s')
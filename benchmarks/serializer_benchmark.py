@@ -0,0 +1,101 @@
+#
+# Benchmark of the JSON serialization of /ground_temperatures rows.
+# Compares the former path (namedtuple records, one dict per row, jsonify) with RowSerializer.
+# Both bodies hold the same values, they are compared once parsed: the key order and the whitespace differ.
+# Usage: python benchmarks/serializer_benchmark.py [rows]
+# @version 1.0
+#
+
+import sys
+import time
+import json
+from datetime import datetime, timedelta
+from decimal import Decimal
+from collections import namedtuple
+sys.path.append('.')
+
+from flask import Flask, jsonify
+from permafrost_observations_api.providers.row_serializer import RowSerializer
+
+class Results:
+    # Mimics the driver result: column names and rows fetched in batches.
+    def __init__(self, keys, rows):
+        self.columns = keys
+        self.rows = rows
+        self.position = 0
+
+    def keys(self):
+        return self.columns
+
+    def fetchall(self):
+        rows = self.rows[self.position:]
+        self.position = len(self.rows)
+        return rows
+
+    def fetchmany(self, size):
+        rows = self.rows[self.position:self.position + size]
+        self.position += len(rows)
+        return rows
+
+def make_rows(count):
+    start = datetime(1990, 1, 1)
+    depths = 20
+    return [('NGO-RC-165_ST01', Decimal(i % depths) / 2, Decimal('-3.1415926535897932'), 24,
+             start + timedelta(days=i // depths)) for i in range(count)]
+
+def former_path(results):
+    Record = namedtuple('Record', results.keys())
+    records = [Record(*r) for r in results.fetchall()]
+    array = []
+    for record in records:
+        item = {}
+        item["loc_name"] = record.loc_name
+        item["height"] = float(record.height)
+        item["agg_avg"] = float(record.agg_avg)
+        item["time"] = record.time
+        array.append(item)
+    return jsonify(array).get_data()
+
+serializer = RowSerializer([
+    ('loc_name', 'loc_name', 'string'),
+    ('height', 'height', 'float'),
+    ('agg_avg', 'agg_avg', 'float'),
+    ('time', 'time', 'http_date')
+])
+
+def serializer_path(results):
+    return serializer.serialize(results, batch_size=2000).body.encode('utf-8')
+
+def measure(function, keys, rows, repeat=5):
+    best = None
+    for i in range(repeat):
+        results = Results(keys, rows)
+        start = time.perf_counter()
+        body = function(results)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best == None else min(best, elapsed)
+    return best, body
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    keys = ['loc_name', 'height', 'agg_avg', 'agg_cnt', 'time']
+    rows = make_rows(count)
+    app = Flask(__name__)
+    with app.app_context():
+        former_time, former_body = measure(former_path, keys, rows)
+        serializer_time, serializer_body = measure(serializer_path, keys, rows)
+    assert json.loads(former_body) == json.loads(serializer_body)
+    app.config['DEBUG'] = True
+    with app.app_context():
+        # The factory runs with DEBUG on, where jsonify indented the body.
+        debug_body = former_path(Results(keys, rows))
+    assert json.loads(debug_body) == json.loads(serializer_body)
+    print(json.dumps({
+        'rows': count,
+        'former_seconds': round(former_time, 4),
+        'serializer_seconds': round(serializer_time, 4),
+        'speedup': round(former_time / serializer_time, 2),
+        'former_bytes': len(former_body),
+        'former_debug_bytes': len(debug_body),
+        'serializer_bytes': len(serializer_body)
+    }, indent=2))
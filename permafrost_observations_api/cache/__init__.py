@@ -0,0 +1,4 @@
+from permafrost_observations_api.cache.ttl_lru_cache import *
+from permafrost_observations_api.cache.response_cache import *
+from permafrost_observations_api.cache.location_catalog import *
+from permafrost_observations_api.cache.export_cache import *
@@ -0,0 +1,148 @@
+#
+# On-disk cache of the finished export artifacts (CSV files and ZIP archives).
+# An artifact is a file named after its key in EXPORT_CACHE_DIR. The least recently used artifacts are
+# deleted once the files take more than EXPORT_CACHE_MAX_BYTES. The files found in the directory at start
+# are indexed again, oldest access first, so the cache survives a restart. The compressed copies of an
+# artifact (<artifact>.gz, ...) are cached and evicted with it.
+# @version 1.0
+#
+
+import os
+import uuid
+import tempfile
+import threading
+import collections
+from flask import current_app
+from permafrost_observations_api.providers.response_compression import SUFFIXES
+
+TEMPORARY_SUFFIX = '.tmp'
+
+class ExportCache:
+    def __init__(self):
+        self.entries = None
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_directory(self):
+        directory = current_app.config['EXPORT_CACHE_DIR']
+        if directory == None:
+            directory = os.path.join(tempfile.gettempdir(), 'permafrost_observations_exports')
+        return directory
+
+    def get_entries(self):
+        if self.entries == None:
+            with self.lock:
+                if self.entries == None:
+                    self.entries = self.load()
+        return self.entries
+
+    def load(self):
+        # Key (file name without extension) to (path, size of the artifact and its copies), least recently used first.
+        directory = self.get_directory()
+        os.makedirs(directory, exist_ok=True)
+        files = {}
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if TEMPORARY_SUFFIX in name:
+                # Left by an export interrupted by a restart.
+                os.remove(path)
+                continue
+            status = os.stat(path)
+            key = name.split('.')[0]
+            modified, artifact_path, size = files.get(key, (0, None, 0))
+            # The artifact is the shortest name, its compressed copies add a suffix to it.
+            if artifact_path == None or len(path) < len(artifact_path):
+                artifact_path = path
+            files[key] = (max(modified, status.st_mtime), artifact_path, size + status.st_size)
+        entries = collections.OrderedDict()
+        for key, (modified, path, size) in sorted(files.items(), key=lambda item: item[1][0]):
+            entries[key] = (path, size)
+            self.size += size
+        return entries
+
+    def get(self, key):
+        """
+        :return: Path of the artifact, None when it is not cached
+        """
+        entries = self.get_entries()
+        with self.lock:
+            entry = entries.get(key)
+            if entry != None and not os.path.exists(entry[0]):
+                del entries[key]
+                self.size -= entry[1]
+                entry = None
+            if entry == None:
+                self.misses += 1
+                return None
+            entries.move_to_end(key)
+            self.hits += 1
+        # The modification time orders the files when they are indexed again.
+        os.utime(entry[0])
+        return entry[0]
+
+    def get_compressed(self, path, encoding):
+        """
+        :return: Path of the copy of an artifact compressed with the encoding, None when there is none
+        """
+        compressed_path = path + SUFFIXES[encoding]
+        return compressed_path if os.path.exists(compressed_path) else None
+
+    def new_temporary_path(self):
+        directory = self.get_directory()
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, uuid.uuid4().hex + TEMPORARY_SUFFIX)
+
+    def put(self, key, temporary_path, extension, compressed_paths=None):
+        """
+        Moves a finished artifact into the cache and evicts the least recently used ones over the size limit.
+        :param compressed_paths: Encoding to temporary path of the compressed copies of the artifact
+        :return: Path of the artifact
+        """
+        entries = self.get_entries()
+        path = os.path.join(self.get_directory(), key + extension)
+        size = 0
+        for encoding, compressed_path in (compressed_paths or {}).items():
+            os.replace(compressed_path, path + SUFFIXES[encoding])
+            size += os.path.getsize(path + SUFFIXES[encoding])
+        os.replace(temporary_path, path)
+        size += os.path.getsize(path)
+        removed = []
+        with self.lock:
+            previous = entries.pop(key, None)
+            if previous != None:
+                self.size -= previous[1]
+            entries[key] = (path, size)
+            self.size += size
+            # The artifact just added is kept even when it is larger than the limit, it is about to be downloaded.
+            while self.size > current_app.config['EXPORT_CACHE_MAX_BYTES'] and len(entries) > 1:
+                evicted_key, (evicted_path, evicted_size) = entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+                removed.append(evicted_path)
+        for evicted_path in removed:
+            for removed_path in [evicted_path] + [evicted_path + suffix for suffix in SUFFIXES.values()]:
+                try:
+                    # A download in progress keeps reading the file it opened.
+                    os.remove(removed_path)
+                except OSError:
+                    pass
+        return path
+
+    def stats(self):
+        entries = self.get_entries()
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(entries),
+                'bytes': self.size,
+                'max_bytes': current_app.config['EXPORT_CACHE_MAX_BYTES'],
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': float(self.hits) / lookups if lookups else 0.0,
+                'evictions': self.evictions
+            }
+
+export_cache = ExportCache()
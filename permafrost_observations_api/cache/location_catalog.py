@@ -0,0 +1,244 @@
+#
+# Process-local catalog of the locations table.
+# The locations are held in arrays ordered like the database orders their names, with a sorted
+# name index answering the LIKE patterns of the location listings by prefix range. The catalog
+# is reloaded when the data version of the locations table changes and patched in place by the
+# marker handlers of this process, so their writes are visible immediately.
+# It serves the location listings, their counts and the marker clusters, lookups of one location stay in SQL.
+# @version 1.0
+#
+
+import re
+import time
+import bisect
+import threading
+import numpy
+from sqlalchemy.sql import text
+from flask import current_app
+from permafrost_observations_api.extensions import db
+from permafrost_observations_api.providers.data_version_provider import DataVersionProvider
+from permafrost_observations_api.providers.row_serializer import ResultGroup
+
+LOCATIONS_SQL = """SELECT name,
+                          CASE WHEN ST_GeometryType(coordinates) = 'ST_Point' THEN ST_X(coordinates) END AS lon,
+                          CASE WHEN ST_GeometryType(coordinates) = 'ST_Point' THEN ST_Y(coordinates) END AS lat,
+                          ST_GeometryType(coordinates) AS geometry_type,
+                          elevation_in_metres,
+                          comment,
+                          record_observations,
+                          accuracy_in_metres
+                     FROM locations """
+
+# Columns of the rows given to the serializers, the same as the listing queries.
+LOCATION_COLUMNS = ['name', 'lon', 'lat', 'elevation_in_metres', 'comment', 'record_observations',
+                    'accuracy_in_metres', 'provider']
+PROVIDER = 'Carleton Internal'
+
+data_version_provider = DataVersionProvider()
+
+def like_to_regex(pattern):
+    """
+    Translates a LIKE pattern (% any string, _ any character, \\ escape) to a regular expression.
+    :return: (compiled regular expression, literal prefix before the first wildcard)
+    """
+    parts = []
+    prefix = None
+    literal = ''
+    i = 0
+    while i < len(pattern):
+        character = pattern[i]
+        if character == '\\' and i + 1 < len(pattern):
+            i += 1
+            character = pattern[i]
+            parts.append(re.escape(character))
+            literal += character
+        elif character in '%_':
+            if prefix == None:
+                prefix = literal
+            parts.append('.*' if character == '%' else '.')
+        else:
+            parts.append(re.escape(character))
+            literal += character
+        i += 1
+    if prefix == None:
+        prefix = literal
+    return re.compile(''.join(parts) + r'\Z', re.DOTALL), prefix
+
+def float_or_nan(value):
+    return float(value) if value != None else numpy.nan
+
+class LocationSnapshot:
+    # Immutable state of the catalog, replaced as a whole so readers never need a lock.
+    def __init__(self, records):
+        """
+        :param records: Location rows ordered by name as the database orders them
+        """
+        self.names = [record.name for record in records]
+        self.geometry_types = [record.geometry_type for record in records]
+        self.comments = [record.comment for record in records]
+        self.record_observations = [record.record_observations for record in records]
+        self.coordinates = numpy.array([[float_or_nan(record.lon), float_or_nan(record.lat)] for record in records],
+                                       dtype=numpy.float64).reshape(-1, 2)
+        self.elevations = numpy.array([float_or_nan(record.elevation_in_metres) for record in records],
+                                      dtype=numpy.float64)
+        self.accuracies = numpy.array([float_or_nan(record.accuracy_in_metres) for record in records],
+                                      dtype=numpy.float64)
+        self.positions = dict((name, position) for position, name in enumerate(self.names))
+        # Web Mercator coordinates in [0, 1] of the points, NaN for other geometries, with the positions
+        # sorted by x so that a box is a binary search followed by a filter on y.
+        latitudes = numpy.radians(numpy.clip(self.coordinates[:, 1], -85.0511, 85.0511))
+        self.mercator_x = (self.coordinates[:, 0] + 180.0) / 360.0
+        self.mercator_y = (1.0 - numpy.log(numpy.tan(latitudes) + 1.0 / numpy.cos(latitudes)) / numpy.pi) / 2.0
+        located = numpy.flatnonzero(~numpy.isnan(self.mercator_x) & ~numpy.isnan(self.mercator_y))
+        self.x_order = located[numpy.argsort(self.mercator_x[located], kind='stable')]
+        self.sorted_x = self.mercator_x[self.x_order]
+        self.generation = 0
+        # Code point order of the names for prefix ranges, mapped back to the database order.
+        self.name_order = sorted(range(len(self.names)), key=lambda position: self.names[position])
+        self.sorted_names = [self.names[position] for position in self.name_order]
+
+    def get_records(self):
+        return [self.get_record(position) for position in range(len(self.names))]
+
+    def get_record(self, position):
+        lon, lat = self.coordinates[position]
+        return LocationRecord(self.names[position], lon, lat, self.geometry_types[position],
+                              self.elevations[position], self.comments[position],
+                              self.record_observations[position], self.accuracies[position])
+
+    def search(self, name_pattern, geometry_type):
+        regex, prefix = like_to_regex(name_pattern)
+        start = bisect.bisect_left(self.sorted_names, prefix)
+        end = bisect.bisect_left(self.sorted_names, prefix + '\U0010ffff') if prefix else len(self.sorted_names)
+        positions = [self.name_order[i] for i in range(start, end)
+                     if regex.match(self.sorted_names[i]) and self.geometry_types[self.name_order[i]] == geometry_type]
+        positions.sort()
+        return positions
+
+    def search_box(self, min_x, max_x, min_y, max_y):
+        """
+        Positions of the points in a Web Mercator box, minimums included and maximums excluded.
+        """
+        start = numpy.searchsorted(self.sorted_x, min_x, side='left')
+        end = numpy.searchsorted(self.sorted_x, max_x, side='left')
+        positions = self.x_order[start:end]
+        y = self.mercator_y[positions]
+        return positions[(y >= min_y) & (y < max_y)]
+
+    def get_row(self, position):
+        lon, lat = self.coordinates[position]
+        return (self.names[position], float_or_none(lon), float_or_none(lat), float_or_none(self.elevations[position]),
+                self.comments[position], self.record_observations[position], float_or_none(self.accuracies[position]),
+                PROVIDER)
+
+def float_or_none(value):
+    return None if value == None or value != value else float(value)
+
+class LocationRecord:
+    def __init__(self, name, lon, lat, geometry_type, elevation_in_metres, comment, record_observations,
+                 accuracy_in_metres):
+        self.name = name
+        self.lon = float_or_none(lon)
+        self.lat = float_or_none(lat)
+        self.geometry_type = geometry_type
+        self.elevation_in_metres = float_or_none(elevation_in_metres)
+        self.comment = comment
+        self.record_observations = record_observations
+        self.accuracy_in_metres = float_or_none(accuracy_in_metres)
+
+class LocationCatalog:
+    def __init__(self):
+        self.snapshot = None
+        self.generation = 0
+        self.version = None
+        self.checked_at = 0
+        self.lock = threading.Lock()
+
+    def is_enabled(self):
+        return current_app.config['LOCATION_CATALOG_ENABLED']
+
+    def load(self):
+        version = data_version_provider.get_version(None)
+        results = db.session.execute(text(LOCATIONS_SQL + " ORDER BY name ASC"))
+        self.set_snapshot(LocationSnapshot(results.fetchall()))
+        db.session.commit()
+        self.version = version[0] if version != None else None
+        self.checked_at = time.time()
+
+    def query_snapshot(self, bounds):
+        """
+        Snapshot of the point locations inside bounding boxes, read from the database without touching the catalog.
+        :param bounds: List of (west, south, east, north) boxes in degrees
+        """
+        predicates = []
+        params = {}
+        for i, box in enumerate(bounds):
+            names = [name + '_' + str(i) for name in ('west', 'south', 'east', 'north')]
+            params.update(zip(names, [float(value) for value in box]))
+            predicates.append("(lon BETWEEN :{0} AND :{2} AND lat BETWEEN :{1} AND :{3})".format(*names))
+        if not predicates:
+            predicates.append('FALSE')
+        # lon and lat are null for the other geometries.
+        results = db.session.execute(text("SELECT * FROM (" + LOCATIONS_SQL + ") locations WHERE " +
+                                          ' OR '.join(predicates) + " ORDER BY name ASC"), params)
+        snapshot = LocationSnapshot(results.fetchall())
+        db.session.commit()
+        return snapshot
+
+    def set_snapshot(self, snapshot):
+        # The generation identifies the snapshot in the keys of the caches derived from it.
+        self.generation += 1
+        snapshot.generation = self.generation
+        self.snapshot = snapshot
+
+    def get_snapshot(self):
+        # The version of the locations table is checked at most every LOCATION_CATALOG_CHECK_SECONDS.
+        if self.snapshot != None and time.time() - self.checked_at < current_app.config['LOCATION_CATALOG_CHECK_SECONDS']:
+            return self.snapshot
+        with self.lock:
+            if self.snapshot == None or time.time() - self.checked_at >= current_app.config['LOCATION_CATALOG_CHECK_SECONDS']:
+                version = data_version_provider.get_version(None)
+                if self.snapshot == None or version == None or version[0] != self.version:
+                    self.load()
+                else:
+                    self.checked_at = time.time()
+        return self.snapshot
+
+    def search(self, name_pattern, geometry_type):
+        """
+        :param name_pattern: LIKE pattern of the names
+        :return: Rows (LOCATION_COLUMNS) of the matching locations, ordered by name
+        """
+        snapshot = self.get_snapshot()
+        return [snapshot.get_row(position) for position in snapshot.search(name_pattern, geometry_type)]
+
+    def get_results(self, rows):
+        # Result-like object over rows returned by search, for the serializers.
+        return ResultGroup(LOCATION_COLUMNS, iter(rows))
+
+    def refresh_location(self, name):
+        # Applies a change made by this process to one location without reloading the catalog.
+        if not self.is_enabled() or self.snapshot == None:
+            return
+        results = db.session.execute(text(LOCATIONS_SQL + " WHERE name = :name"), {'name': name})
+        record = results.first()
+        with self.lock:
+            records = self.snapshot.get_records()
+            position = self.snapshot.positions.get(name)
+            if position != None:
+                del records[position]
+            if record != None:
+                # The rank of the name in the database collation keeps the listing order of the database.
+                rank = db.session.execute(text("SELECT COUNT(*) FROM locations WHERE name < :name"), {'name': name})
+                records.insert(rank.scalar(), record)
+            self.set_snapshot(LocationSnapshot(records))
+        db.session.commit()
+
+    def reload(self):
+        # Reloads the catalog after a change of many locations made by this process.
+        if not self.is_enabled() or self.snapshot == None:
+            return
+        with self.lock:
+            self.load()
+
+location_catalog = LocationCatalog()
@@ -0,0 +1,188 @@
+#
+# Cache of the responses of the read endpoints.
+# Entries are keyed by route and normalized query string. Every key also carries the
+# generation of the data it depends on (a location, the locations table or everything),
+# so bumping a generation invalidates the entries without having to find them.
+# An entry also keeps the compressed bodies sent for it, so a body is compressed once per encoding.
+# The cache is in process by default, or shared by all the workers through Redis.
+# @version 1.0
+#
+
+import json
+import base64
+import hashlib
+import threading
+from flask import current_app, request, g
+from permafrost_observations_api.cache.ttl_lru_cache import TtlLruCache
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+ALL_TAG = '*'
+LOCATIONS_TAG = 'locations'
+
+def location_tag(location):
+    return 'location:' + location
+
+class LocalBackend:
+    def __init__(self, max_size, ttl):
+        self.entries = TtlLruCache(max_size=max_size, ttl=ttl)
+        self.generations = {}
+        self.lock = threading.Lock()
+
+    def get_generations(self, tags):
+        return [self.generations.get(tag, 0) for tag in tags]
+
+    def bump_generations(self, tags):
+        with self.lock:
+            for tag in tags:
+                self.generations[tag] = self.generations.get(tag, 0) + 1
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def set(self, key, entry):
+        self.entries.set(key, entry)
+
+    def stats(self):
+        return self.entries.stats()
+
+class RedisBackend:
+    def __init__(self, url, ttl, prefix):
+        if redis == None:
+            raise RuntimeError('RESPONSE_CACHE_REDIS_URL is set but the redis package is not installed')
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_generations(self, tags):
+        values = self.client.mget([self.prefix + 'generation:' + tag for tag in tags])
+        return [int(value) if value != None else 0 for value in values]
+
+    def bump_generations(self, tags):
+        pipeline = self.client.pipeline()
+        for tag in tags:
+            pipeline.incr(self.prefix + 'generation:' + tag)
+        pipeline.execute()
+
+    def get(self, key):
+        value = self.client.get(self.prefix + 'response:' + key)
+        with self.lock:
+            if value == None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        entry = json.loads(value)
+        entry['body'] = base64.b64decode(entry['body'])
+        entry['encodings'] = {encoding: base64.b64decode(body) for encoding, body in entry.get('encodings', {}).items()}
+        return entry
+
+    def set(self, key, entry):
+        value = dict(entry)
+        value['body'] = base64.b64encode(entry['body']).decode('ascii')
+        value['encodings'] = {encoding: base64.b64encode(body).decode('ascii')
+                              for encoding, body in entry['encodings'].items()}
+        self.client.setex(self.prefix + 'response:' + key, self.ttl, json.dumps(value))
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            # Evictions are done by Redis itself (maxmemory policy) and reported by its INFO command.
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': float(self.hits) / lookups if lookups else 0.0,
+                'evictions': self.client.info('stats').get('evicted_keys')
+            }
+
+class ResponseCache:
+    # Headers set by the views that are part of the cached response.
+    CACHED_HEADERS = ['X-Next-Cursor', 'X-Total-Items', 'Content-Disposition']
+
+    def __init__(self):
+        self.backend = None
+        self.lock = threading.Lock()
+
+    def get_backend(self):
+        if self.backend == None:
+            with self.lock:
+                if self.backend == None:
+                    config = current_app.config
+                    if config['RESPONSE_CACHE_REDIS_URL']:
+                        self.backend = RedisBackend(config['RESPONSE_CACHE_REDIS_URL'],
+                                                    config['RESPONSE_CACHE_TTL'],
+                                                    config['RESPONSE_CACHE_REDIS_PREFIX'])
+                    else:
+                        self.backend = LocalBackend(config['RESPONSE_CACHE_SIZE'], config['RESPONSE_CACHE_TTL'])
+        return self.backend
+
+    def is_enabled(self):
+        return current_app.config['RESPONSE_CACHE_ENABLED']
+
+    def get_request_tags(self):
+        locations = [location for location in request.args.getlist('location') if location]
+        if locations:
+            return [ALL_TAG] + [location_tag(location) for location in locations]
+        return [ALL_TAG, LOCATIONS_TAG]
+
+    def get_data_key(self):
+        """
+        :return: Generations and data version of the data the request depends on, both change with the data
+        """
+        tags = self.get_request_tags()
+        return [tags, self.get_backend().get_generations(tags), getattr(g, 'data_version', None)]
+
+    def make_key(self):
+        arguments = sorted(request.args.items(multi=True))
+        key = json.dumps([request.path, arguments] + self.get_data_key())
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        return self.get_backend().get(key)
+
+    def set(self, key, response):
+        """
+        :return: The cached entry, None when the response is too large to be cached
+        """
+        body = response.get_data()
+        if len(body) > current_app.config['RESPONSE_CACHE_MAX_ENTRY_BYTES']:
+            return None
+        entry = {
+            'body': body,
+            'status': response.status_code,
+            'mimetype': response.mimetype,
+            'headers': {name: response.headers[name] for name in self.CACHED_HEADERS if name in response.headers},
+            'encodings': {}
+        }
+        self.get_backend().set(key, entry)
+        return entry
+
+    def set_encoding(self, key, entry, encoding, body):
+        """
+        Adds the body compressed with an encoding to a cached entry.
+        """
+        entry['encodings'][encoding] = body
+        self.get_backend().set(key, entry)
+
+    def invalidate_location(self, location):
+        # A location change affects its own series and the location listings.
+        self.get_backend().bump_generations([location_tag(location), LOCATIONS_TAG])
+
+    def invalidate_locations(self, locations):
+        self.get_backend().bump_generations([location_tag(location) for location in locations] + [LOCATIONS_TAG])
+
+    def invalidate_observations(self, locations):
+        self.get_backend().bump_generations([location_tag(location) for location in locations])
+
+    def invalidate_all(self):
+        self.get_backend().bump_generations([ALL_TAG])
+
+    def stats(self):
+        return self.get_backend().stats()
+
+response_cache = ResponseCache()
@@ -1,3 +1,4 @@
 from permafrost_observations_api.decorators.authorization import *
 from permafrost_observations_api.decorators.crossorigin import *
-
+from permafrost_observations_api.decorators.cached_response import *
+from permafrost_observations_api.decorators.conditional_response import *
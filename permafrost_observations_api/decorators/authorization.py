@@ -1,28 +1,43 @@
+import time
 from flask import request, Response, json
 from functools import wraps
-from permafrost_observations_api.extensions import oidc
+from permafrost_observations_api.providers.token_validation_provider import TokenValidationProvider
+from permafrost_observations_api.providers.request_metrics import request_metrics
+
+token_validator = TokenValidationProvider()
+
+def check_authorization():
+    """
+    :return: The error response when the bearer token is missing or invalid, None otherwise
+    """
+    auth = request.headers.get('Authorization')
+    if auth == None:
+        error = {
+            "error": "Could not find authentication token"
+        }
+        return Response(json.dumps(error), 403, mimetype="application/json")
+    auth_fragments = auth.split(' ')
+    if len(auth_fragments) < 2 or auth_fragments[0] != 'Bearer':
+        error = {
+            "error": "Autherization header is invalid"
+        }
+        return Response(json.dumps(error), 403, mimetype="application/json")
+    token = auth_fragments[1]
+    is_valid = token_validator.validate_token(token)
+    if not is_valid:
+        error = {
+            "error": "Authentication token is not valid"
+        }
+        return Response(json.dumps(error), 401, mimetype="application/json")
+    return None
 
 def authorization(original_func):
     @wraps(original_func)
     def decorator(*args, **kwargs):
-        auth = request.headers.get('Authorization')
-        if auth == None:
-            error = {
-                "error": "Could not find authentication token"
-            }
-            return Response(json.dumps(error), 403, mimetype="application/json")
-        auth_fragments = auth.split(' ')
-        if len(auth_fragments) < 2 or auth_fragments[0] != 'Bearer':
-            error = {
-                "error": "Autherization header is invalid"
-            }
-            return Response(json.dumps(error), 403, mimetype="application/json")
-        token = auth_fragments[1]
-        is_valid = oidc.validate_token(token)
-        if not is_valid:
-            error = {
-                "error": "Authentication token is not valid"
-            }
-            return Response(json.dumps(error), 401, mimetype="application/json")
+        start = time.perf_counter()
+        error = check_authorization()
+        request_metrics.add_phase('auth', time.perf_counter() - start)
+        if error != None:
+            return error
         return original_func(*args, **kwargs)
     return decorator
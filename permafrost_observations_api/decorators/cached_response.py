@@ -0,0 +1,34 @@
+#
+# Serve GET responses from the response cache.
+# @version 1.0
+#
+
+from flask import request, Response, make_response, g
+from functools import wraps
+from permafrost_observations_api.cache.response_cache import response_cache
+from permafrost_observations_api.providers.response_compression import response_compression
+
+def cached_response(original_func):
+    @wraps(original_func)
+    def decorator(*args, **kwargs):
+        if request.method != 'GET' or not response_cache.is_enabled():
+            return original_func(*args, **kwargs)
+        key = response_cache.make_key()
+        entry = response_cache.get(key)
+        if entry != None:
+            encoding = response_compression.negotiate()
+            if encoding in entry['encodings']:
+                response = Response(entry['encodings'][encoding], entry['status'], headers=entry['headers'],
+                                    mimetype=entry['mimetype'])
+                response.headers['Content-Encoding'] = encoding
+                return response
+            # The body compressed for this response is added to the entry.
+            g.response_cache_entry = (key, entry)
+            return Response(entry['body'], entry['status'], headers=entry['headers'], mimetype=entry['mimetype'])
+        response = make_response(original_func(*args, **kwargs))
+        if response.status_code == 200 and not response.is_streamed:
+            entry = response_cache.set(key, response)
+            if entry != None:
+                g.response_cache_entry = (key, entry)
+        return response
+    return decorator
@@ -0,0 +1,55 @@
+#
+# Conditional GET: ETag and Last-Modified derived from the data version of the requested locations,
+# a request whose validators still match is answered with 304 before the view runs.
+# @version 1.0
+#
+
+import hashlib
+from datetime import timezone
+from flask import request, Response, make_response, g
+from functools import wraps
+from permafrost_observations_api.providers.data_version_provider import DataVersionProvider
+
+data_version_provider = DataVersionProvider()
+
+def conditional_response(original_func):
+    @wraps(original_func)
+    def decorator(*args, **kwargs):
+        if request.method != 'GET':
+            return original_func(*args, **kwargs)
+        locations = request.args.getlist('location')
+        if len(locations) > 1:
+            data_version = data_version_provider.get_batch_version(locations)
+        else:
+            data_version = data_version_provider.get_version(request.args.get('location'))
+        if data_version == None:
+            return original_func(*args, **kwargs)
+        version, last_modified = data_version
+        # Also part of the response cache key, so a cached body always matches its ETag.
+        g.data_version = version
+        if last_modified != None:
+            last_modified = last_modified.astimezone(timezone.utc).replace(microsecond=0)
+        arguments = sorted(request.args.items(multi=True))
+        etag = hashlib.sha1((request.path + str(arguments) + str(version)).encode('utf-8')).hexdigest()
+
+        if request.if_none_match:
+            # Weak comparison, the ETag of a compressed response is weak.
+            not_modified = request.if_none_match.contains_weak(etag)
+        else:
+            if_modified_since = request.if_modified_since
+            if if_modified_since != None and if_modified_since.tzinfo == None:
+                if_modified_since = if_modified_since.replace(tzinfo=timezone.utc)
+            not_modified = last_modified != None and if_modified_since != None and \
+                           last_modified <= if_modified_since
+        if not_modified:
+            response = Response(status=304)
+        else:
+            response = make_response(original_func(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+        response.set_etag(etag, weak='Content-Encoding' in response.headers)
+        if last_modified != None:
+            response.last_modified = last_modified
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    return decorator
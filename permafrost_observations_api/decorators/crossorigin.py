@@ -8,6 +8,7 @@ from datetime import timedelta
 from functools import update_wrapper
 
 from flask import request, current_app, make_response
+from werkzeug.exceptions import HTTPException
 
 def crossdomain(origin=None, methods=None, headers=None,
                 exposed_headers=None, max_age=21600,
@@ -54,7 +55,10 @@ def crossdomain(origin=None, methods=None, headers=None,
             if automatic_options and request.method == 'OPTIONS':
                 resp = current_app.make_default_options_response()
             else:
-                resp = make_response(f(*args, **kwargs))
+                try:
+                    resp = make_response(f(*args, **kwargs))
+                except HTTPException as error:
+                    resp = error.get_response()
             if not attach_to_all and request.method != 'OPTIONS':
                 return resp
 
@@ -64,10 +68,12 @@ def crossdomain(origin=None, methods=None, headers=None,
             h['Access-Control-Max-Age'] = str(max_age)
             h['Access-Control-Allow-Credentials'] = 'true'
             h['Access-Control-Allow-Headers'] = \
-                "Origin, X-Requested-With, Content-Type, Accept, Authorization"
+                "Origin, X-Requested-With, Content-Type, Accept, Authorization, " \
+                "If-None-Match, If-Modified-Since"
             h['Access-Control-Expose-Headers'] = \
                 'Location, X-Epoch, X-Safety-Off, ' \
-                'X-Total-Items, X-Set, X-Items-Per-Set'
+                'X-Total-Items, X-Set, X-Items-Per-Set, X-Next-Cursor, ' \
+                'ETag, Last-Modified'
             if headers is not None:
                 h['Access-Control-Allow-Headers'] = headers
             if exposed_headers is not None:
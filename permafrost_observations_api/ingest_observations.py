@@ -0,0 +1,45 @@
+#
+# Load logger files into the observations table with COPY, each file in its own transaction.
+# The format follows the extension: .csv files have a header row, other files are NDJSON.
+#     python ingest_observations.py [--unit=C] file...
+# @version 1.0
+#
+
+import sys
+sys.path.append('../')
+
+import json
+from permafrost_observations_api import permafrost_observations_factory
+from permafrost_observations_api.providers.observation_ingest_provider import ObservationIngestProvider, \
+    ObservationIngestError
+from permafrost_observations_api.cache.response_cache import response_cache
+
+app = permafrost_observations_factory.create_app(__name__)
+
+unit_of_measure = None
+paths = []
+for arg in sys.argv[1:]:
+    if arg.startswith('--unit='):
+        unit_of_measure = arg[len('--unit='):]
+    else:
+        paths.append(arg)
+
+status = 0
+with app.app_context():
+    provider = ObservationIngestProvider()
+    for path in paths:
+        mimetype = 'text/csv' if path.lower().endswith('.csv') else 'application/x-ndjson'
+        with open(path, 'rb') as stream:
+            try:
+                summary = provider.ingest(provider.read_rows(stream, mimetype), unit_of_measure)
+            except ObservationIngestError as error:
+                print(path + ': ' + str(error), file=sys.stderr)
+                status = 1
+                continue
+        print(path + ': ' + json.dumps(summary))
+        # Only reaches the API workers when the response cache is shared through Redis.
+        locations = [item['location'] for item in summary['locations'] if item['location'] != None]
+        if locations:
+            response_cache.invalidate_observations(locations)
+
+sys.exit(status)
@@ -0,0 +1,37 @@
+#
+# Create the derived tables (daily and monthly ground temperature rollups, location summaries, data versions),
+# the unique index on the location names used by the bulk location upsert, the index used by the observation
+# ingest to skip duplicates and the observation ids breaking the ties of the keyset pagination, then refresh the
+# rollups and the location summaries.
+# Only the days touched by new observations are reprocessed unless --full is given.
+# @version 1.0
+#
+
+import sys
+sys.path.append('../')
+
+from permafrost_observations_api import permafrost_observations_factory
+from permafrost_observations_api.providers.temperature_rollup_provider import TemperatureRollupProvider
+from permafrost_observations_api.providers.data_version_provider import DataVersionProvider
+from permafrost_observations_api.providers.location_import_provider import LocationImportProvider
+from permafrost_observations_api.providers.observation_ingest_provider import ObservationIngestProvider
+from permafrost_observations_api.providers.location_summary_provider import LocationSummaryProvider
+from permafrost_observations_api.cache.response_cache import response_cache
+
+app = permafrost_observations_factory.create_app(__name__)
+
+with app.app_context():
+    DataVersionProvider().create_schema()
+    LocationImportProvider().create_schema()
+    ObservationIngestProvider().create_schema()
+    rollup_provider = TemperatureRollupProvider()
+    rollup_provider.create_schema()
+    locations = rollup_provider.refresh(full='--full' in sys.argv)
+    summary_provider = LocationSummaryProvider()
+    summary_provider.create_schema()
+    summary_provider.refresh(full='--full' in sys.argv)
+    # Only reaches the API workers when the response cache is shared through Redis.
+    if locations == None:
+        response_cache.invalidate_all()
+    else:
+        response_cache.invalidate_observations(locations)
@@ -29,8 +29,60 @@ def create_app(package_name):
         'OIDC_INTROSPECTION_AUTH_METHOD': 'client_secret_post',
         'OIDC_TOKEN_TYPE_HINT': 'access_token',
         'OIDC_ID_TOKEN_COOKIE_SECURE': False,
-        'OIDC_REQUIRE_VERIFIED_EMAIL': False
+        'OIDC_REQUIRE_VERIFIED_EMAIL': False,
+        'OIDC_LOCAL_JWT_VALIDATION': True,
+        'OIDC_TOKEN_CACHE_SIZE': 4096,
+        'OIDC_TOKEN_CACHE_DEFAULT_TTL': 60,
+        'OIDC_TOKEN_CLOCK_SKEW': 30,
+        'OIDC_JWKS_CACHE_SECONDS': 3600,
+        'OIDC_JWKS_MIN_REFRESH_SECONDS': 30,
+        'EXPORT_FETCH_BATCH_SIZE': 5000,
+        'EXPORT_MAX_CONCURRENT_QUERIES': 4,
+        'TEMPERATURE_ROLLUP_ENABLED': True,
+        'RESPONSE_CACHE_ENABLED': True,
+        'RESPONSE_CACHE_SIZE': 512,
+        'RESPONSE_CACHE_TTL': 300,
+        'RESPONSE_CACHE_MAX_ENTRY_BYTES': 5 * 1024 * 1024,
+        'RESPONSE_CACHE_REDIS_URL': None,
+        'RESPONSE_CACHE_REDIS_PREFIX': 'permafrost_observations_api:',
+        'CONDITIONAL_GET_ENABLED': True,
+        'SERIALIZER_FETCH_BATCH_SIZE': 2000,
+        'BATCH_MAX_LOCATIONS': 50,
+        'LOCATION_CATALOG_ENABLED': True,
+        'LOCATION_CATALOG_CHECK_SECONDS': 5,
+        'MARKER_CLUSTER_MAX_ZOOM': 10,
+        'MARKER_CLUSTER_CELLS_PER_TILE': 4,
+        'MARKER_CLUSTER_MAX_TILES': 256,
+        'MARKER_CLUSTER_CACHE_SIZE': 4096,
+        'LOCATION_IMPORT_BATCH_SIZE': 500,
+        'OBSERVATION_INGEST_LOOKUP_TTL': 300,
+        'OBSERVATION_INGEST_MAX_ERRORS': 100,
+        'OBSERVATION_INGEST_COPY_BUFFER_SIZE': 256 * 1024,
+        'LOCATION_SUMMARY_ENABLED': True,
+        'QUERY_REGISTRY_PREPARE_ENABLED': True,
+        'QUERY_REGISTRY_MAX_QUERIES': 1024,
+        'METRICS_ENABLED': True,
+        'SLOW_QUERY_LOG_ENABLED': True,
+        'SLOW_QUERY_LOG_SIZE': 100,
+        'SLOW_QUERY_THRESHOLD_MS': 1000,
+        'SLOW_QUERY_EXPLAIN_ENABLED': True,
+        'SLOW_QUERY_EXPLAIN_ANALYZE': True,
+        'SLOW_QUERY_EXPLAIN_INTERVAL': 300,
+        'SLOW_QUERY_EXPLAIN_TIMEOUT_MS': 60000,
+        'EXPORT_JOB_WORKERS': 2,
+        'EXPORT_JOB_MAX_QUEUED': 32,
+        'EXPORT_JOB_MAX_LOCATIONS': 500,
+        'EXPORT_JOB_RETENTION_SECONDS': 3600,
+        'EXPORT_CACHE_DIR': None,
+        'EXPORT_CACHE_MAX_BYTES': 2 * 1024 * 1024 * 1024,
+        'COMPRESSION_ENABLED': True,
+        'COMPRESSION_ENCODINGS': ['zstd', 'br', 'gzip'],
+        'COMPRESSION_MIN_BYTES': 1024,
+        'COMPRESSION_GZIP_LEVEL': 6,
+        'COMPRESSION_ZSTD_LEVEL': 3,
+        'COMPRESSION_BROTLI_QUALITY': 5
     })
+    app.config.update(client_secrets.get('settings', {}))
 
     db.init_app(app)
     ma.init_app(app)
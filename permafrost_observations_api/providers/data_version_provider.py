@@ -0,0 +1,101 @@
+#
+# Per-location data versions used to validate conditional GET requests.
+# Triggers on observations and locations bump the version of every location they change,
+# the '*' row is bumped by any change to the locations table.
+# @version 1.0
+#
+
+import time
+from sqlalchemy.sql import text
+from flask import current_app
+from permafrost_observations_api.extensions import db
+
+LOCATIONS_VERSION = '*'
+
+BUMP_VERSIONS_SQL = """INSERT INTO location_data_versions (location_name, version, last_modified)
+                       SELECT location_name, 1, now() FROM ({changed_locations}) changed
+                       ON CONFLICT (location_name) DO UPDATE
+                          SET version = location_data_versions.version + 1,
+                              last_modified = now()"""
+
+SCHEMA_SQL = [
+    """CREATE TABLE IF NOT EXISTS location_data_versions (
+           location_name TEXT PRIMARY KEY,
+           version BIGINT NOT NULL,
+           last_modified TIMESTAMPTZ NOT NULL)""",
+    """CREATE OR REPLACE FUNCTION bump_observation_data_versions() RETURNS trigger AS $$
+       BEGIN
+           """ + BUMP_VERSIONS_SQL.format(changed_locations="""
+                  SELECT DISTINCT locations.name AS location_name
+                    FROM changed_observations
+                         INNER JOIN locations ON changed_observations.location = locations.coordinates""") + """;
+           RETURN NULL;
+       END;
+       $$ LANGUAGE plpgsql""",
+    """CREATE OR REPLACE FUNCTION bump_location_data_versions() RETURNS trigger AS $$
+       BEGIN
+           """ + BUMP_VERSIONS_SQL.format(changed_locations="""
+                  SELECT name AS location_name FROM changed_locations
+                  UNION SELECT '""" + LOCATIONS_VERSION + """'""") + """;
+           RETURN NULL;
+       END;
+       $$ LANGUAGE plpgsql"""
+]
+
+for table, function in [('observations', 'bump_observation_data_versions'), ('locations', 'bump_location_data_versions')]:
+    for event, transition in [('INSERT', 'NEW'), ('UPDATE', 'OLD'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')]:
+        trigger = table + '_version_' + event.lower() + '_' + transition.lower()
+        SCHEMA_SQL.append("DROP TRIGGER IF EXISTS " + trigger + " ON " + table)
+        SCHEMA_SQL.append("CREATE TRIGGER " + trigger + " AFTER " + event + " ON " + table +
+                          " REFERENCING " + transition + " TABLE AS changed_" + table +
+                          " FOR EACH STATEMENT EXECUTE PROCEDURE " + function + "()")
+
+class DataVersionProvider:
+    def __init__(self):
+        self.installed = False
+        self.installed_checked_at = 0
+
+    def create_schema(self):
+        for sql_statement in SCHEMA_SQL:
+            db.session.execute(text(sql_statement))
+        db.session.commit()
+
+    def is_installed(self):
+        if not current_app.config['CONDITIONAL_GET_ENABLED']:
+            return False
+        if not self.installed and time.time() - self.installed_checked_at > 60:
+            self.installed_checked_at = time.time()
+            results = db.session.execute(text("SELECT to_regclass('location_data_versions') IS NOT NULL AS installed"))
+            self.installed = results.scalar()
+        return self.installed
+
+    def get_version(self, location):
+        """
+        Primary key lookup of the data version of a location, or of the locations table when location is None.
+        :return: (version, last modified) tuple, None when the versions are not installed
+        """
+        if not self.is_installed():
+            return None
+        location_name = location if location else LOCATIONS_VERSION
+        results = db.session.execute(text("""SELECT version, last_modified FROM location_data_versions
+                                              WHERE location_name = :location_name"""),
+                                     {'location_name': location_name})
+        record = results.first()
+        if record == None:
+            return (0, None)
+        return (record.version, record.last_modified)
+
+    def get_batch_version(self, locations):
+        """
+        Data version of several locations, changes when any of them changes.
+        :return: (version, last modified) tuple, None when the versions are not installed
+        """
+        if not self.is_installed():
+            return None
+        results = db.session.execute(text("""SELECT location_name, version, last_modified FROM location_data_versions
+                                              WHERE location_name = ANY(:locations)"""),
+                                     {'locations': list(locations)})
+        versions = dict((record.location_name, record) for record in results)
+        version = ','.join(str(versions[location].version) if location in versions else '0' for location in locations)
+        last_modified = max([record.last_modified for record in versions.values()], default=None)
+        return (version, last_modified)
@@ -0,0 +1,107 @@
+#
+# Server-side downsampling of time series with min/max buckets.
+# Each series is cut into buckets of equal duration and only the lowest and highest point of every
+# bucket is kept, so peaks survive. A bucket without data between two others is a gap, it is marked
+# with a null point so that charts break the line instead of drawing across it.
+# @version 1.0
+#
+
+import itertools
+import numpy
+from flask import current_app
+from permafrost_observations_api.providers.row_serializer import epoch_milliseconds
+
+class DownsampledResults:
+    # Result-like object (keys and fetchmany) producing the downsampled rows one series at a time.
+    def __init__(self, provider, results, max_points, series_columns, time_column, value_column):
+        self.columns = list(results.keys())
+        self.rows = provider.downsample_rows(results, self.columns, max_points, series_columns,
+                                             time_column, value_column)
+
+    def keys(self):
+        return self.columns
+
+    def fetchmany(self, size):
+        return list(itertools.islice(self.rows, size))
+
+class DownsamplingProvider:
+    def select_points(self, times, values, max_points):
+        """
+        Vectorized min/max bucketing of one series sorted by time.
+        :param times: Float array of the times
+        :param values: Float array of the values, NaN for null
+        :param max_points: Maximum number of points of the result, gap markers included
+        :return: (sorted indexes of the kept points, list of (index before, index after) of the gaps)
+        """
+        count = len(times)
+        if count <= max_points:
+            return numpy.arange(count), []
+        # Each bucket gives at most two points and one gap marker.
+        buckets = max(max_points // 3, 1)
+        span = times[-1] - times[0]
+        if span > 0:
+            bucket = numpy.minimum(((times - times[0]) * (buckets / span)).astype(numpy.int64), buckets - 1)
+        else:
+            bucket = numpy.zeros(count, dtype=numpy.int64)
+
+        # Null values are left out, a bucket holding only nulls becomes a gap.
+        indexes = numpy.flatnonzero(~numpy.isnan(values))
+        if len(indexes) == 0:
+            return indexes, []
+        bucket = bucket[indexes]
+        order = numpy.lexsort((values[indexes], bucket))
+        sorted_bucket = bucket[order]
+        firsts = numpy.flatnonzero(numpy.r_[True, sorted_bucket[1:] != sorted_bucket[:-1]])
+        lasts = numpy.r_[firsts[1:], len(order)] - 1
+        kept = numpy.unique(numpy.concatenate((indexes[order[firsts]], indexes[order[lasts]])))
+
+        # Buckets are in time order, the last point of a bucket is followed by the first point of the next.
+        present = sorted_bucket[firsts]
+        ends = numpy.flatnonzero(numpy.r_[bucket[1:] != bucket[:-1], True])
+        starts = numpy.r_[0, ends[:-1] + 1]
+        gap_positions = numpy.flatnonzero(numpy.diff(present) > 1)
+        gaps = list(zip(indexes[ends[gap_positions]].tolist(), indexes[starts[gap_positions + 1]].tolist()))
+        return kept, gaps
+
+    def downsample_rows(self, results, columns, max_points, series_columns, time_column, value_column,
+                        batch_size=None):
+        if batch_size == None:
+            batch_size = current_app.config['EXPORT_FETCH_BATCH_SIZE']
+        series_indexes = [columns.index(column) for column in series_columns]
+        time_index = columns.index(time_column)
+        value_index = columns.index(value_column)
+
+        def read_rows():
+            while True:
+                rows = results.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+
+        # Rows come ordered by series, only one series is held in memory at a time.
+        for key, series in itertools.groupby(read_rows(), lambda row: tuple(row[index] for index in series_indexes)):
+            series = list(series)
+            times = numpy.array([epoch_milliseconds(row[time_index]) for row in series], dtype=numpy.float64)
+            values = numpy.array([row[value_index] for row in series], dtype=numpy.float64)
+            kept, gaps = self.select_points(times, values, max_points)
+            gaps = iter(gaps)
+            gap = next(gaps, None)
+            for index in kept.tolist():
+                while gap != None and gap[0] < index:
+                    yield self.make_gap_row(series[gap[0]], series[gap[1]], time_index, value_index)
+                    gap = next(gaps, None)
+                yield series[index]
+
+    def make_gap_row(self, before, after, time_index, value_index):
+        row = list(before)
+        row[time_index] = before[time_index] + (after[time_index] - before[time_index]) / 2
+        row[value_index] = None
+        return tuple(row)
+
+    def downsample(self, results, max_points, series_columns, time_column, value_column):
+        """
+        :param results: Rows ordered by the series columns then by time
+        :return: Result-like object to pass to a RowSerializer
+        """
+        return DownsampledResults(self, results, max_points, series_columns, time_column, value_column)
@@ -0,0 +1,230 @@
+#
+# Export jobs: the CSV downloads and ZIP archives built by a bounded pool of background workers.
+# A job is keyed by export type, set of locations, request arguments (date range, resolution, ...) and data
+# version of the locations. A job whose artifact is in the export cache is done as soon as it is submitted,
+# and a job already queued or running for the same key is returned instead of a new one. The options of
+# the exports are read from the request arguments when the job is submitted and passed to the worker.
+# @version 1.0
+#
+
+import os
+import time
+import uuid
+import json
+import hashlib
+import threading
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app, request
+from permafrost_observations_api.providers.raw_sql_provider import RawSqlProvider
+from permafrost_observations_api.providers.zip_export_provider import ZipExportProvider
+from permafrost_observations_api.providers.data_version_provider import DataVersionProvider
+from permafrost_observations_api.providers.response_compression import response_compression
+from permafrost_observations_api.cache.export_cache import export_cache
+
+# Export type to (name of the RawSqlProvider method returning the CSV chunks of a location and options, archive folder).
+EXPORT_TYPES = {
+    'time_temperature': ('stream_observation_time_temperature_csv', 'download_observation_time_temperature'),
+    'temperature_height': ('stream_observation_temperature_height_csv', 'download_observation_temperature_height')
+}
+
+ZIP_FILENAME = 'observations.zip'
+
+class ExportJobError(Exception):
+    pass
+
+def utc_now():
+    return datetime.now(timezone.utc).isoformat()
+
+class ExportJob:
+    def __init__(self, export_type, locations, key):
+        self.id = uuid.uuid4().hex
+        self.export_type = export_type
+        self.locations = locations
+        self.key = key
+        self.status = 'queued'
+        self.error = None
+        self.cached = False
+        self.path = None
+        self.entries_done = 0
+        self.bytes = 0
+        self.created_at = utc_now()
+        self.started_at = None
+        self.finished_at = None
+        self.finished = None
+
+    def is_zip(self):
+        return len(self.locations) > 1
+
+    def get_filename(self):
+        return ZIP_FILENAME if self.is_zip() else self.locations[0] + '.txt'
+
+    def get_mimetype(self):
+        return 'application/zip' if self.is_zip() else 'text/plain'
+
+    def get_extension(self):
+        return '.zip' if self.is_zip() else '.txt'
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'type': self.export_type,
+            'locations': self.locations,
+            'status': self.status,
+            'cached': self.cached,
+            'error': self.error,
+            'progress': {
+                'entries_done': self.entries_done,
+                'entries_total': len(self.locations),
+                'bytes': self.bytes
+            },
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at
+        }
+
+class ExportJobProvider:
+    def __init__(self):
+        self.provider = RawSqlProvider()
+        self.zip_provider = ZipExportProvider()
+        self.data_version_provider = DataVersionProvider()
+        self.executor = None
+        self.jobs = {}
+        self.active = {}
+        self.lock = threading.Lock()
+
+    def get_executor(self):
+        if self.executor == None:
+            with self.lock:
+                if self.executor == None:
+                    self.executor = ThreadPoolExecutor(max_workers=current_app.config['EXPORT_JOB_WORKERS'],
+                                                       thread_name_prefix='export-job')
+        return self.executor
+
+    def get_arguments(self):
+        # Arguments of the export, the locations and the type are part of the key on their own.
+        return sorted((name, value) for name, value in request.args.items(multi=True) if name not in ('location', 'type'))
+
+    def get_key(self, export_type, locations):
+        """
+        :return: Key of the artifact, None when the data versions are not installed and it cannot be reused
+        """
+        locations = sorted(locations)
+        data_version = self.data_version_provider.get_batch_version(locations)
+        if data_version == None:
+            return None
+        key = json.dumps([export_type, locations, self.get_arguments(), str(data_version[0])])
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def get_cached(self, export_type, locations):
+        """
+        :return: Path of the artifact of the export when it is in the export cache, None otherwise
+        """
+        key = self.get_key(export_type, locations)
+        return export_cache.get(key) if key != None else None
+
+    def submit(self, export_type, locations):
+        """
+        :param export_type: One of EXPORT_TYPES
+        :param locations: Location names, a ZIP archive is built for more than one
+        :return: ExportJob, done when the artifact was cached
+        """
+        method_name, folder = EXPORT_TYPES[export_type]
+        options = self.provider.get_export_options()
+        # Checks the arguments now, the generator runs no statement until it is read.
+        getattr(self.provider, method_name)(locations[0], options)
+        key = self.get_key(export_type, locations)
+        self.remove_expired_jobs()
+        # The same export is looked up, found in the cache or queued by one submission at a time.
+        with self.lock:
+            job = self.active.get(key) if key != None else None
+            if job != None:
+                return job
+            job = ExportJob(export_type, locations, key if key != None else uuid.uuid4().hex)
+            path = export_cache.get(key) if key != None else None
+            if path != None:
+                job.status = 'done'
+                job.cached = True
+                job.path = path
+                job.entries_done = len(locations)
+                job.started_at = job.finished_at = job.created_at
+                job.finished = time.time()
+                self.jobs[job.id] = job
+                return job
+            pending = sum(1 for active_job in self.active.values() if active_job.status == 'queued')
+            if pending >= current_app.config['EXPORT_JOB_MAX_QUEUED']:
+                raise ExportJobError("too many exports are waiting, retry later")
+            self.jobs[job.id] = job
+            self.active[job.key] = job
+        app = current_app._get_current_object()
+        self.get_executor().submit(self.run, app, job, options)
+        return job
+
+    def run(self, app, job, options):
+        temporary_path = None
+        compressed_paths = {}
+        try:
+            with app.app_context():
+                job.status = 'running'
+                job.started_at = utc_now()
+                method_name, folder = EXPORT_TYPES[job.export_type]
+                export = getattr(self.provider, method_name)
+                temporary_path = export_cache.new_temporary_path()
+                with open(temporary_path, 'wb') as output:
+                    if job.is_zip():
+                        entries = [(folder + '/' + location + '.txt', export(location, options))
+                                   for location in job.locations]
+                        chunks = self.zip_provider.stream_zip(entries, progress=lambda arcname: self.add_entry(job))
+                    else:
+                        chunks = (chunk.encode('utf-8') for chunk in export(job.locations[0], options))
+                    for chunk in chunks:
+                        output.write(chunk)
+                        job.bytes += len(chunk)
+                if not job.is_zip() and response_compression.is_enabled():
+                    # Compressed once here instead of on every download.
+                    for encoding in response_compression.get_encodings():
+                        compressed_paths[encoding] = response_compression.compress_file(temporary_path, encoding)
+                job.path = export_cache.put(job.key, temporary_path, job.get_extension(), compressed_paths)
+                job.entries_done = len(job.locations)
+                job.status = 'done'
+        except Exception as error:
+            job.status = 'failed'
+            job.error = str(error).strip().split('\n')[0]
+            for removed_path in [temporary_path] + list(compressed_paths.values()):
+                if removed_path == None:
+                    continue
+                try:
+                    os.remove(removed_path)
+                except OSError:
+                    pass
+        finally:
+            job.finished_at = utc_now()
+            job.finished = time.time()
+            with self.lock:
+                if self.active.get(job.key) is job:
+                    del self.active[job.key]
+
+    def add_entry(self, job):
+        job.entries_done += 1
+
+    def get_job(self, job_id):
+        return self.jobs.get(job_id)
+
+    def remove_expired_jobs(self):
+        retention = current_app.config['EXPORT_JOB_RETENTION_SECONDS']
+        with self.lock:
+            for job_id in [job_id for job_id, job in self.jobs.items()
+                           if job.finished != None and time.time() - job.finished > retention]:
+                del self.jobs[job_id]
+
+    def stats(self):
+        with self.lock:
+            statuses = {}
+            for job in self.jobs.values():
+                statuses[job.status] = statuses.get(job.status, 0) + 1
+        return {
+            'jobs': statuses,
+            'cache': export_cache.stats()
+        }
+
+export_job_provider = ExportJobProvider()
@@ -0,0 +1,194 @@
+#
+# Bulk upsert of locations from a JSON array, a CSV file or NDJSON lines.
+# The rows are written in multi-row INSERT ... ON CONFLICT (name) statements of LOCATION_IMPORT_BATCH_SIZE
+# rows, all in one transaction. A batch that fails is rolled back to its savepoint and replayed row by
+# row, so an invalid row is reported with its error without aborting the other rows.
+# @version 1.0
+#
+
+import io
+import csv
+import math
+import time
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.sql import text
+from flask import json, current_app
+from permafrost_observations_api.extensions import db
+
+UNIQUE_NAME_INDEX = 'locations_name_unique'
+
+SCHEMA_SQL = [
+    "CREATE UNIQUE INDEX IF NOT EXISTS " + UNIQUE_NAME_INDEX + " ON locations (name)"
+]
+
+UPSERT_SQL = """INSERT INTO locations (name, coordinates, accuracy_in_metres, comment, record_observations,
+                                      elevation_in_metres)
+                VALUES {values}
+                ON CONFLICT (name) DO UPDATE
+                   SET coordinates = EXCLUDED.coordinates,
+                       accuracy_in_metres = EXCLUDED.accuracy_in_metres,
+                       comment = EXCLUDED.comment,
+                       record_observations = EXCLUDED.record_observations,
+                       elevation_in_metres = EXCLUDED.elevation_in_metres
+                RETURNING name, (xmax = 0) AS inserted"""
+
+VALUES_SQL = """(:name_{i}, ST_SetSRID(ST_MakePoint(:lng_{i}, :lat_{i}), 4326), :accuracy_in_metres_{i}, :comment_{i},
+                 :record_observations_{i}, :elevation_in_metres_{i})"""
+
+CSV_MIMETYPES = ('text/csv', 'application/csv')
+NDJSON_MIMETYPES = ('application/x-ndjson', 'application/ndjson', 'application/jsonl')
+
+class LocationImportError(Exception):
+    pass
+
+def get_value(data, *names):
+    for name in names:
+        value = data.get(name)
+        if value != None and value != '':
+            return value
+    return None
+
+def get_number(data, *names, minimum=-math.inf, maximum=math.inf, required=False):
+    value = get_value(data, *names)
+    if value == None:
+        if required:
+            raise LocationImportError(names[0] + " is required")
+        return None
+    try:
+        if isinstance(value, bool):
+            raise ValueError()
+        value = float(value)
+    except (TypeError, ValueError):
+        raise LocationImportError(names[0] + " must be a number")
+    if not (minimum <= value <= maximum):
+        raise LocationImportError(names[0] + " must be between " + str(minimum) + " and " + str(maximum))
+    return value
+
+def get_string(data, *names):
+    value = get_value(data, *names)
+    return str(value) if value != None else None
+
+class LocationImportProvider:
+    def __init__(self):
+        self.installed = False
+        self.installed_checked_at = 0
+
+    def create_schema(self):
+        for sql_statement in SCHEMA_SQL:
+            db.session.execute(text(sql_statement))
+        db.session.commit()
+
+    def is_installed(self):
+        if not self.installed and time.time() - self.installed_checked_at > 60:
+            self.installed_checked_at = time.time()
+            results = db.session.execute(text("SELECT to_regclass('" + UNIQUE_NAME_INDEX + "') IS NOT NULL AS installed"))
+            self.installed = results.scalar()
+        return self.installed
+
+    def read_rows(self, stream, mimetype):
+        """
+        :param stream: Binary stream of the request body
+        :param mimetype: application/json (array of objects), text/csv (header row) or application/x-ndjson
+        :return: Iterator of (row number, dictionary or LocationImportError) pairs, numbered from 1
+        """
+        if mimetype in CSV_MIMETYPES:
+            reader = csv.DictReader(io.TextIOWrapper(stream, encoding='utf-8-sig', newline=''))
+            for number, data in enumerate(reader, 1):
+                yield number, data
+        elif mimetype in NDJSON_MIMETYPES:
+            number = 0
+            for line in io.TextIOWrapper(stream, encoding='utf-8'):
+                if not line.strip():
+                    continue
+                number += 1
+                try:
+                    yield number, json.loads(line)
+                except ValueError:
+                    yield number, LocationImportError("invalid JSON")
+        else:
+            try:
+                data = json.loads(stream.read())
+            except ValueError:
+                raise LocationImportError("the body must be a JSON array of locations")
+            if not isinstance(data, list):
+                raise LocationImportError("the body must be a JSON array of locations")
+            for number, item in enumerate(data, 1):
+                yield number, item
+
+    def get_params(self, data):
+        # Same fields as the marker endpoints, name and lon are accepted for text and lng.
+        if isinstance(data, LocationImportError):
+            raise data
+        if not isinstance(data, dict):
+            raise LocationImportError("a location must be an object")
+        name = get_string(data, 'text', 'name')
+        if name == None:
+            raise LocationImportError("text is required")
+        return {
+            'name': name,
+            'lat': get_number(data, 'lat', minimum=-90, maximum=90, required=True),
+            'lng': get_number(data, 'lng', 'lon', minimum=-180, maximum=180, required=True),
+            'comment': get_string(data, 'comment'),
+            'record_observations': get_string(data, 'record_observations'),
+            'accuracy_in_metres': get_number(data, 'accuracy_in_metres'),
+            'elevation_in_metres': get_number(data, 'elevation_in_metres')
+        }
+
+    def upsert(self, rows):
+        """
+        Upserts the rows in one transaction, committed when all of them were processed.
+        :param rows: Iterator of (row number, dictionary) pairs, see read_rows
+        :return: Dictionary with the counts, the per-row errors and the names written
+        """
+        summary = {'received': 0, 'inserted': 0, 'updated': 0, 'errors': []}
+        names = set()
+        batch = {}
+        batch_size = current_app.config['LOCATION_IMPORT_BATCH_SIZE']
+        for number, data in rows:
+            summary['received'] += 1
+            try:
+                params = self.get_params(data)
+            except LocationImportError as error:
+                summary['errors'].append({'row': number, 'error': str(error)})
+                continue
+            # A name repeated in the batch would be updated twice by the same statement, the last row wins.
+            batch.pop(params['name'], None)
+            batch[params['name']] = (number, params)
+            if len(batch) >= batch_size:
+                self.write_batch(list(batch.values()), summary, names)
+                batch = {}
+        if batch:
+            self.write_batch(list(batch.values()), summary, names)
+        db.session.commit()
+        summary['names'] = sorted(names)
+        return summary
+
+    def write_batch(self, batch, summary, names):
+        savepoint = db.session.begin_nested()
+        try:
+            written = self.execute_upsert([params for number, params in batch])
+            savepoint.commit()
+        except DBAPIError:
+            savepoint.rollback()
+            written = []
+            for number, params in batch:
+                savepoint = db.session.begin_nested()
+                try:
+                    written.extend(self.execute_upsert([params]))
+                    savepoint.commit()
+                except DBAPIError as error:
+                    savepoint.rollback()
+                    summary['errors'].append({'row': number, 'name': params['name'],
+                                              'error': str(error.orig).strip().split('\n')[0]})
+        for name, inserted in written:
+            summary['inserted' if inserted else 'updated'] += 1
+            names.add(name)
+
+    def execute_upsert(self, batch):
+        params = {}
+        for i, row in enumerate(batch):
+            for key, value in row.items():
+                params[key + '_' + str(i)] = value
+        values = ', '.join(VALUES_SQL.format(i=i) for i in range(len(batch)))
+        results = db.session.execute(text(UPSERT_SQL.format(values=values)), params)
+        return [(row.name, row.inserted) for row in results.fetchall()]
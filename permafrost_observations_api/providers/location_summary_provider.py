@@ -0,0 +1,226 @@
+#
+# Per-location summary of the observations: count and time extent per unit of measure, sensor label and depth.
+# It answers the depths, the stratigraphy categories and the observation counts of a location with an index
+# lookup instead of a scan of its observations. Inserted observations are added by a trigger as partial rows,
+# merged by the refresh; updated or deleted observations and changed locations make the location stale, and
+# stale locations are served from the observations until the refresh rebuilds them.
+# @version 1.0
+#
+
+import time
+from sqlalchemy.sql import text
+from flask import current_app
+from permafrost_observations_api.extensions import db
+
+STRATIGRAPHY_LABELS = ['geo_class_1', 'ice_visual_perc', 'ice_description', 'geo_description']
+
+SUMMARY_COLUMNS = 'location_name, unit_of_measure, sensor_label, height, observation_count, first_time, last_time'
+
+# Summary rows of the observations of a table (observations or a transition table).
+SUMMARY_SELECT_SQL = """SELECT locations.name AS location_name,
+                               {table}.unit_of_measure,
+                               sensors.label AS sensor_label,
+                               {table}.height_min_metres AS height,
+                               COUNT(*) AS observation_count,
+                               MIN({table}.corrected_utc_time) AS first_time,
+                               MAX({table}.corrected_utc_time) AS last_time
+                          FROM {table}
+                               INNER JOIN locations ON {table}.location = locations.coordinates
+                               LEFT JOIN sensors ON sensors.id = {table}.sensor_id """
+
+SUMMARY_GROUP_BY_SQL = """ GROUP BY 1, 2, 3, 4"""
+
+SCHEMA_SQL = [
+    # Several rows can share a key until the refresh merges them, the readers aggregate them.
+    """CREATE TABLE IF NOT EXISTS location_summaries (
+           location_name TEXT NOT NULL,
+           unit_of_measure TEXT,
+           sensor_label TEXT,
+           height NUMERIC,
+           observation_count BIGINT NOT NULL,
+           first_time TIMESTAMPTZ,
+           last_time TIMESTAMPTZ)""",
+    """CREATE INDEX IF NOT EXISTS location_summaries_location
+           ON location_summaries (location_name, unit_of_measure, sensor_label)""",
+    """CREATE TABLE IF NOT EXISTS location_summary_locations (
+           location_name TEXT PRIMARY KEY,
+           refreshed_at TIMESTAMPTZ NOT NULL DEFAULT now())""",
+    """CREATE OR REPLACE FUNCTION add_location_summary_observations() RETURNS trigger AS $$
+       BEGIN
+           INSERT INTO location_summaries (""" + SUMMARY_COLUMNS + """)
+           """ + SUMMARY_SELECT_SQL.format(table='changed_observations') + SUMMARY_GROUP_BY_SQL + """;
+           RETURN NULL;
+       END;
+       $$ LANGUAGE plpgsql""",
+    """CREATE OR REPLACE FUNCTION invalidate_location_summaries() RETURNS trigger AS $$
+       BEGIN
+           DELETE FROM location_summary_locations
+            WHERE location_name IN (SELECT locations.name
+                                      FROM changed_observations
+                                           INNER JOIN locations ON changed_observations.location = locations.coordinates);
+           RETURN NULL;
+       END;
+       $$ LANGUAGE plpgsql"""
+]
+
+for trigger, event, transition, function in [('insert', 'INSERT', 'NEW', 'add_location_summary_observations'),
+                                             ('update_old', 'UPDATE', 'OLD', 'invalidate_location_summaries'),
+                                             ('update_new', 'UPDATE', 'NEW', 'invalidate_location_summaries'),
+                                             ('delete', 'DELETE', 'OLD', 'invalidate_location_summaries')]:
+    SCHEMA_SQL.append("DROP TRIGGER IF EXISTS observations_summary_" + trigger + " ON observations")
+    SCHEMA_SQL.append("CREATE TRIGGER observations_summary_" + trigger + " AFTER " + event + " ON observations" +
+                      " REFERENCING " + transition + " TABLE AS changed_observations" +
+                      " FOR EACH STATEMENT EXECUTE PROCEDURE " + function + "()")
+
+# Stale locations are rebuilt from the observations in one statement, so the partial rows added by
+# concurrent inserts are either counted by the rebuild or kept, never both.
+REFRESH_STALE_SQL = """WITH stale AS (SELECT name FROM locations
+                                      WHERE name NOT IN (SELECT location_name FROM location_summary_locations)),
+                            removed AS (DELETE FROM location_summaries
+                                         WHERE location_name IN (SELECT name FROM stale)
+                                            OR location_name NOT IN (SELECT name FROM locations)),
+                            refreshed AS (INSERT INTO location_summary_locations (location_name)
+                                          SELECT name FROM stale
+                                          ON CONFLICT (location_name) DO UPDATE SET refreshed_at = now())
+                       INSERT INTO location_summaries (""" + SUMMARY_COLUMNS + """)
+                       """ + SUMMARY_SELECT_SQL.format(table='observations') + """
+                        WHERE locations.name IN (SELECT name FROM stale) """ + SUMMARY_GROUP_BY_SQL
+
+MERGE_SQL = """WITH merged AS (DELETE FROM location_summaries
+                                WHERE location_name IN (SELECT location_name FROM location_summaries
+                                                         GROUP BY location_name, unit_of_measure, sensor_label, height
+                                                        HAVING COUNT(*) > 1)
+                               RETURNING """ + SUMMARY_COLUMNS + """)
+               INSERT INTO location_summaries (""" + SUMMARY_COLUMNS + """)
+               SELECT location_name, unit_of_measure, sensor_label, height,
+                      SUM(observation_count), MIN(first_time), MAX(last_time)
+                 FROM merged
+                GROUP BY 1, 2, 3, 4"""
+
+class LocationSummaryProvider:
+    def __init__(self):
+        self.installed = False
+        self.installed_checked_at = 0
+
+    def create_schema(self):
+        for sql_statement in SCHEMA_SQL:
+            db.session.execute(text(sql_statement))
+        db.session.commit()
+
+    def refresh(self, full=False):
+        """
+        Rebuilds the stale locations and merges the partial rows added since the last refresh.
+        :param full: Rebuild the summary of every location
+        """
+        if full:
+            db.session.execute(text("TRUNCATE location_summaries, location_summary_locations"))
+        db.session.execute(text(REFRESH_STALE_SQL))
+        db.session.execute(text("""DELETE FROM location_summary_locations
+                                   WHERE location_name NOT IN (SELECT name FROM locations)"""))
+        db.session.execute(text(MERGE_SQL))
+        db.session.commit()
+
+    def invalidate_location(self, location):
+        # The location is served from the observations until the next refresh rebuilds it.
+        self.invalidate_locations([location])
+
+    def invalidate_locations(self, locations):
+        if self.is_installed():
+            db.session.execute(text("DELETE FROM location_summary_locations WHERE location_name = ANY(:locations)"),
+                               {'locations': list(locations)})
+            db.session.commit()
+
+    def is_installed(self):
+        if not current_app.config['LOCATION_SUMMARY_ENABLED']:
+            return False
+        if not self.installed and time.time() - self.installed_checked_at > 60:
+            self.installed_checked_at = time.time()
+            results = db.session.execute(text("SELECT to_regclass('location_summary_locations') IS NOT NULL AS installed"))
+            self.installed = results.scalar()
+        return self.installed
+
+    def is_fresh(self, location):
+        if not self.is_installed():
+            return False
+        results = db.session.execute(text("""SELECT EXISTS (SELECT 1 FROM location_summary_locations
+                                                             WHERE location_name = :location)"""),
+                                     {'location': location})
+        return results.scalar()
+
+    def get_summary_source(self, location):
+        """
+        :return: (SQL of the summary rows of the location, parameters), read from the summary when it is fresh
+        """
+        return self.build_summary_sql(self.is_fresh(location)), {'location': location}
+
+    def build_summary_sql(self, fresh):
+        if fresh:
+            return """SELECT """ + SUMMARY_COLUMNS + """
+                        FROM location_summaries
+                       WHERE location_name = :location"""
+        return SUMMARY_SELECT_SQL.format(table='observations') + """
+                       WHERE locations.name = :location """ + SUMMARY_GROUP_BY_SQL
+
+    def get_heights_query(self, location, start_time, end_time):
+        """
+        :return: (SQL, parameters) of the distinct depths of the temperatures observed between the times
+        """
+        summary, params = self.get_summary_source(location)
+        params.update({'start_time': start_time, 'end_time': end_time})
+        return self.build_heights_sql(summary), params
+
+    def build_heights_sql(self, summary):
+        return """SELECT DISTINCT height
+                    FROM (""" + summary + """) summary
+                   WHERE unit_of_measure = 'C'
+                     AND first_time <= CAST(:end_time AS timestamptz)
+                     AND last_time >= CAST(:start_time AS timestamptz)
+                   ORDER BY height"""
+
+    def get_categories_query(self, location):
+        """
+        :return: (SQL, parameters) of the stratigraphy categories observed at the location
+        """
+        summary, params = self.get_summary_source(location)
+        params['labels'] = STRATIGRAPHY_LABELS
+        return self.build_categories_sql(summary), params
+
+    def build_categories_sql(self, summary):
+        return """SELECT DISTINCT sensor_label AS label
+                    FROM (""" + summary + """) summary
+                   WHERE sensor_label = ANY(:labels)
+                   ORDER BY label"""
+
+    def get_heights_statements(self):
+        # Every statement get_heights_query can return, to register them once.
+        return [self.build_heights_sql(self.build_summary_sql(fresh)) for fresh in (True, False)]
+
+    def get_categories_statements(self):
+        return [self.build_categories_sql(self.build_summary_sql(fresh)) for fresh in (True, False)]
+
+    def get_summary(self, location):
+        """
+        :return: Dictionary with the depths, categories, time extent and counts of the observations of the location
+        """
+        summary, params = self.get_summary_source(location)
+        results = db.session.execute(text(summary), params).fetchall()
+        db.session.commit()
+        units = {}
+        sensors = {}
+        for record in results:
+            units[record.unit_of_measure] = units.get(record.unit_of_measure, 0) + record.observation_count
+            sensors[record.sensor_label] = sensors.get(record.sensor_label, 0) + record.observation_count
+        first_times = [record.first_time for record in results if record.first_time != None]
+        last_times = [record.last_time for record in results if record.last_time != None]
+        return {
+            'location': location,
+            'observation_count': sum(record.observation_count for record in results),
+            'first_time': min(first_times) if first_times else None,
+            'last_time': max(last_times) if last_times else None,
+            'depths': sorted(set(float(record.height) for record in results
+                                 if record.unit_of_measure == 'C' and record.height != None)),
+            'categories': sorted(set(record.sensor_label for record in results
+                                     if record.sensor_label in STRATIGRAPHY_LABELS)),
+            'unit_counts': [{'unit_of_measure': unit, 'count': units[unit]} for unit in sorted(units, key=str)],
+            'sensor_counts': [{'sensor_label': label, 'count': sensors[label]} for label in sorted(sensors, key=str)]
+        }
@@ -0,0 +1,175 @@
+#
+# Map markers of a bounding box, clustered at low zoom levels.
+# Points are looked up in the Web Mercator index of the location catalog. Below MARKER_CLUSTER_MAX_ZOOM
+# each map tile covering the box is divided in a grid of cells, and the points sharing a cell are
+# returned as one cluster with its count, centroid and extent. Tiles are cached per catalog snapshot,
+# so panning over tiles already seen does not recompute them. When LOCATION_CATALOG_ENABLED is off, the
+# locations of the area are read from the database for each request and the tiles are not cached.
+# @version 1.0
+#
+
+import math
+import numpy
+from flask import current_app
+from permafrost_observations_api.cache.ttl_lru_cache import TtlLruCache
+from permafrost_observations_api.cache.location_catalog import location_catalog
+
+MAX_LATITUDE = 85.0511
+# Degrees added around the area read from the database, the exact bounds are applied to the Web Mercator coordinates.
+BOUNDS_MARGIN = 1e-9
+
+def mercator_x(lon):
+    return (lon + 180.0) / 360.0
+
+def mercator_y(lat):
+    lat = math.radians(max(min(lat, MAX_LATITUDE), -MAX_LATITUDE))
+    return (1.0 - math.log(math.tan(lat) + 1.0 / math.cos(lat)) / math.pi) / 2.0
+
+# Web Mercator y of the latitudes clipped to MAX_LATITUDE, the edges of the map.
+MIN_Y = mercator_y(MAX_LATITUDE)
+MAX_Y = mercator_y(-MAX_LATITUDE)
+
+def longitude(x):
+    return x * 360.0 - 180.0
+
+def latitude(y):
+    return math.degrees(math.atan(math.sinh(math.pi * (1.0 - 2.0 * y))))
+
+class MarkerClusterProvider:
+    def __init__(self):
+        self.tile_cache = None
+
+    def get_tile_cache(self):
+        if self.tile_cache == None:
+            self.tile_cache = TtlLruCache(max_size=current_app.config['MARKER_CLUSTER_CACHE_SIZE'],
+                                          ttl=current_app.config['RESPONSE_CACHE_TTL'])
+        return self.tile_cache
+
+    def parse_bbox(self, value):
+        """
+        :param value: 'west,south,east,north' in degrees, west greater than east crosses the antimeridian
+        :return: (west, south, east, north), None when the value is not valid
+        """
+        try:
+            west, south, east, north = [float(part) for part in value.split(',')]
+        except ValueError:
+            return None
+        if not (-180 <= west <= 180 and -180 <= east <= 180 and -90 <= south <= north <= 90):
+            return None
+        return (west, south, east, north)
+
+    def get_boxes(self, bbox):
+        # Web Mercator boxes (min x, max x, min y, max y) of a bounding box, two when it crosses the antimeridian.
+        west, south, east, north = bbox
+        min_y = mercator_y(north)
+        max_y = numpy.nextafter(mercator_y(south), 2.0)
+        if west > east:
+            return [(mercator_x(west), 1.0, min_y, max_y), (0.0, numpy.nextafter(mercator_x(east), 2.0), min_y, max_y)]
+        return [(mercator_x(west), numpy.nextafter(mercator_x(east), 2.0), min_y, max_y)]
+
+    def get_tile_ranges(self, bbox, zoom):
+        # (x range, y range) of the tiles covering each box of a bounding box.
+        count = 2 ** zoom
+        return [(range(int(min_x * count), min(int(math.ceil(max_x * count)), count)),
+                 range(int(min_y * count), min(int(math.ceil(max_y * count)), count)))
+                for min_x, max_x, min_y, max_y in self.get_boxes(bbox)]
+
+    def count_tiles(self, bbox, zoom):
+        return sum(len(xs) * len(ys) for xs, ys in self.get_tile_ranges(bbox, zoom))
+
+    def get_tiles(self, bbox, zoom):
+        return [(x, y) for xs, ys in self.get_tile_ranges(bbox, zoom) for x in xs for y in ys]
+
+    def get_tile_boxes(self, bbox, zoom):
+        # Web Mercator boxes covered by the tiles of a bounding box.
+        count = 2 ** zoom
+        return [(xs.start / count, xs.stop / count, ys.start / count, ys.stop / count)
+                for xs, ys in self.get_tile_ranges(bbox, zoom) if len(xs) > 0 and len(ys) > 0]
+
+    def get_bounds(self, box):
+        # (west, south, east, north) in degrees of a Web Mercator box. The edges of the map are left open,
+        # the catalog clips the latitudes beyond MAX_LATITUDE (or out of range) to them.
+        min_x, max_x, min_y, max_y = box
+        west = longitude(min_x) - BOUNDS_MARGIN if min_x > 0 else -math.inf
+        east = longitude(max_x) + BOUNDS_MARGIN if max_x < 1 else math.inf
+        south = latitude(max_y) - BOUNDS_MARGIN if max_y < MAX_Y else -math.inf
+        north = latitude(min_y) + BOUNDS_MARGIN if min_y > MIN_Y else math.inf
+        return (west, south, east, north)
+
+    def get_snapshot(self, boxes):
+        """
+        :param boxes: Web Mercator boxes of the request
+        :return: The catalog snapshot, or a snapshot of the locations in the boxes when the catalog is disabled
+        """
+        if location_catalog.is_enabled():
+            return location_catalog.get_snapshot()
+        return location_catalog.query_snapshot([self.get_bounds(box) for box in boxes])
+
+    def get_markers(self, bbox, name_pattern, geometry_type):
+        """
+        :return: Catalog rows of the locations in the bounding box, ordered by name
+        """
+        snapshot = self.get_snapshot(self.get_boxes(bbox))
+        positions = numpy.concatenate([snapshot.search_box(*box) for box in self.get_boxes(bbox)])
+        allowed = numpy.array(snapshot.search(name_pattern, geometry_type), dtype=numpy.int64)
+        positions = numpy.unique(positions[numpy.isin(positions, allowed)])
+        return [snapshot.get_row(position) for position in positions.tolist()]
+
+    def get_clusters(self, bbox, zoom, name_pattern, geometry_type):
+        """
+        :return: (list of cluster dictionaries, catalog rows of the locations alone in their cell)
+        """
+        snapshot = self.get_snapshot(self.get_tile_boxes(bbox, zoom))
+        # The generation of a snapshot read for this request only does not identify it.
+        tile_cache = self.get_tile_cache() if location_catalog.is_enabled() else None
+        allowed = None
+        clusters = []
+        positions = []
+        for x, y in self.get_tiles(bbox, zoom):
+            key = (snapshot.generation, name_pattern, geometry_type, zoom, x, y)
+            tile = tile_cache.get(key) if tile_cache != None else None
+            if tile == None:
+                if allowed is None:
+                    allowed = numpy.array(snapshot.search(name_pattern, geometry_type), dtype=numpy.int64)
+                tile = self.cluster_tile(snapshot, allowed, zoom, x, y)
+                if tile_cache != None:
+                    tile_cache.set(key, tile)
+            clusters.extend(tile[0])
+            positions.extend(tile[1])
+        positions.sort()
+        return clusters, [snapshot.get_row(position) for position in positions]
+
+    def cluster_tile(self, snapshot, allowed, zoom, x, y):
+        count = 2 ** zoom
+        positions = snapshot.search_box(x / count, (x + 1) / count, y / count, (y + 1) / count)
+        positions = positions[numpy.isin(positions, allowed)]
+        if len(positions) == 0:
+            return ([], [])
+        cells = current_app.config['MARKER_CLUSTER_CELLS_PER_TILE']
+        cell_x = numpy.clip(((snapshot.mercator_x[positions] * count - x) * cells).astype(numpy.int64), 0, cells - 1)
+        cell_y = numpy.clip(((snapshot.mercator_y[positions] * count - y) * cells).astype(numpy.int64), 0, cells - 1)
+        cell_ids, members, sizes = numpy.unique(cell_y * cells + cell_x, return_inverse=True, return_counts=True)
+        lon = snapshot.coordinates[positions, 0]
+        lat = snapshot.coordinates[positions, 1]
+        mean_lon = numpy.bincount(members, weights=lon) / sizes
+        mean_lat = numpy.bincount(members, weights=lat) / sizes
+        extent = numpy.full((len(cell_ids), 4), numpy.nan)
+        extent[:, 0] = numpy.inf
+        extent[:, 1] = numpy.inf
+        extent[:, 2] = -numpy.inf
+        extent[:, 3] = -numpy.inf
+        numpy.minimum.at(extent[:, 0], members, lon)
+        numpy.minimum.at(extent[:, 1], members, lat)
+        numpy.maximum.at(extent[:, 2], members, lon)
+        numpy.maximum.at(extent[:, 3], members, lat)
+        clusters = []
+        for cluster in numpy.flatnonzero(sizes > 1).tolist():
+            clusters.append({
+                'count': int(sizes[cluster]),
+                'lat': float(mean_lat[cluster]),
+                'lon': float(mean_lon[cluster]),
+                'lng': float(mean_lon[cluster]),
+                'bbox': [float(value) for value in extent[cluster]]
+            })
+        markers = positions[sizes[members] == 1].tolist()
+        return (clusters, markers)
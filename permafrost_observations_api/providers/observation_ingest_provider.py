@@ -0,0 +1,309 @@
+#
+# Ingest of logger files (CSV or NDJSON) into the observations table.
+# The rows are validated and converted to COPY text lines as they are read, location names and sensor
+# labels being resolved from lookups cached for OBSERVATION_INGEST_LOOKUP_TTL seconds. COPY loads them in a
+# temporary staging table, and one INSERT ... SELECT moves the rows not already in observations for the same
+# (location, sensor, time, depth). The triggers of the observations table mark the days touched for the
+# rollup refresh and bump the data versions of the locations.
+# @version 1.0
+#
+
+import io
+import re
+import csv
+import time
+import threading
+import psycopg2
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.sql import text
+from flask import json, current_app
+from permafrost_observations_api.extensions import db
+from permafrost_observations_api.providers.temperature_rollup_provider import parse_timestamp
+
+# Input fields, in the order of the COPY columns, and the names accepted for them.
+FIELDS = [
+    ('location', ('location', 'loc_name')),
+    ('sensor', ('sensor', 'sensor_label')),
+    ('sensor_id', ('sensor_id',)),
+    ('time', ('corrected_utc_time', 'time')),
+    ('height_min_metres', ('height_min_metres', 'height')),
+    ('height_max_metres', ('height_max_metres',)),
+    ('numeric_value', ('numeric_value', 'value')),
+    ('text_value', ('text_value',)),
+    ('unit_of_measure', ('unit_of_measure', 'unit'))
+]
+
+COPY_COLUMNS = 'location, sensor_id, corrected_utc_time, height_min_metres, height_max_metres, numeric_value, ' \
+               'text_value, unit_of_measure'
+
+CSV_MIMETYPES = ('text/csv', 'application/csv')
+
+OBSERVATION_ID_INDEX = 'observations_id_key'
+
+SCHEMA_SQL = [
+    # Turns the duplicate check of the ingest into index probes.
+    """CREATE INDEX IF NOT EXISTS observations_ingest_key
+           ON observations (location, sensor_id, corrected_utc_time, height_min_metres)""",
+    # Key of an observation, the last sort key of the keyset pagination. Kept when the table already has one.
+    """ALTER TABLE observations ADD COLUMN IF NOT EXISTS id BIGINT GENERATED BY DEFAULT AS IDENTITY""",
+    """CREATE UNIQUE INDEX IF NOT EXISTS """ + OBSERVATION_ID_INDEX + """ ON observations (id)"""
+]
+
+# Only the COPY columns, the id of the observations is generated by the INSERT.
+STAGING_SQL = """CREATE TEMPORARY TABLE observation_ingest_staging ON COMMIT DROP
+                 AS SELECT """ + COPY_COLUMNS + """ FROM observations WITH NO DATA"""
+
+INSERT_SQL = """WITH inserted AS (
+                    INSERT INTO observations (""" + COPY_COLUMNS + """)
+                    SELECT DISTINCT ON (location, sensor_id, corrected_utc_time, height_min_metres) """ + COPY_COLUMNS + """
+                      FROM observation_ingest_staging staged
+                     WHERE NOT EXISTS (SELECT 1
+                                         FROM observations
+                                        WHERE observations.location = staged.location
+                                          AND observations.sensor_id = staged.sensor_id
+                                          AND observations.corrected_utc_time = staged.corrected_utc_time
+                                          AND observations.height_min_metres IS NOT DISTINCT FROM staged.height_min_metres)
+                     ORDER BY location, sensor_id, corrected_utc_time, height_min_metres
+                    RETURNING location, corrected_utc_time)
+                SELECT location,
+                       (MIN(corrected_utc_time) AT TIME ZONE 'UTC')::date AS first_day,
+                       (MAX(corrected_utc_time) AT TIME ZONE 'UTC')::date AS last_day,
+                       COUNT(*) AS inserted
+                  FROM inserted
+                 GROUP BY location"""
+
+NUMBER = re.compile(r'[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?\Z')
+COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+class ObservationIngestError(Exception):
+    pass
+
+class CopyStream(io.RawIOBase):
+    # File-like object read by COPY, filled from the lines as COPY asks for data.
+    def __init__(self, lines):
+        self.lines = lines
+        self.buffer = b''
+        # Error of the file raised while COPY was reading, psycopg2 reports it as a COPY failure.
+        self.error = None
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        chunks = []
+        length = len(self.buffer)
+        while size < 0 or length < size:
+            try:
+                line = next(self.lines, None)
+            except ObservationIngestError as error:
+                self.error = error
+                raise
+            if line == None:
+                break
+            chunks.append(line)
+            length += len(line)
+        data = self.buffer + ''.join(chunks).encode('utf-8')
+        if size < 0:
+            size = len(data)
+        self.buffer = data[size:]
+        return data[:size]
+
+def get_field_indexes(header):
+    indexes = []
+    for field, names in FIELDS:
+        index = None
+        for name in names:
+            if name in header:
+                index = header.index(name)
+                break
+        indexes.append(index)
+    return indexes
+
+def copy_number(value, name):
+    if value == None or value == '':
+        return '\\N'
+    value = str(value).strip()
+    if not NUMBER.match(value):
+        raise ObservationIngestError(name + " must be a number")
+    return value
+
+def copy_text(value):
+    if value == None or value == '':
+        return '\\N'
+    value = str(value)
+    if '\x00' in value:
+        raise ObservationIngestError("text cannot contain NUL characters")
+    return value.translate(COPY_ESCAPES)
+
+def read_lines(stream, encoding, newline=None):
+    # A decoding error is an error of the file, not of the server.
+    try:
+        for line in io.TextIOWrapper(stream, encoding=encoding, newline=newline):
+            yield line
+    except UnicodeDecodeError:
+        raise ObservationIngestError("the file is not valid UTF-8")
+
+class ObservationIngestProvider:
+    def __init__(self):
+        self.locations = {}
+        self.location_names = {}
+        self.sensors = {}
+        self.sensor_ids = set()
+        self.loaded_at = 0
+        self.lock = threading.Lock()
+        self.keyed = False
+        self.keyed_checked_at = 0
+
+    def create_schema(self):
+        for sql_statement in SCHEMA_SQL:
+            db.session.execute(text(sql_statement))
+        db.session.commit()
+
+    def has_observation_ids(self):
+        """
+        :return: True when the observations have the unique id installed by make_rollup.py
+        """
+        if not self.keyed and time.time() - self.keyed_checked_at > 60:
+            self.keyed_checked_at = time.time()
+            results = db.session.execute(text("SELECT to_regclass('" + OBSERVATION_ID_INDEX + "') IS NOT NULL AS installed"))
+            self.keyed = results.scalar()
+        return self.keyed
+
+    def load_lookups(self):
+        # Own connection, the lookups can be reloaded while the session connection is in COPY.
+        with db.engine.connect() as connection:
+            locations = dict(connection.execute(text("SELECT name, coordinates FROM locations")).fetchall())
+            sensors = dict(connection.execute(text("SELECT label, id FROM sensors")).fetchall())
+        with self.lock:
+            self.locations = locations
+            self.location_names = dict((coordinates, name) for name, coordinates in locations.items())
+            self.sensors = sensors
+            self.sensor_ids = set(sensors.values())
+            self.loaded_at = time.time()
+
+    def get_lookups(self):
+        if time.time() - self.loaded_at >= current_app.config['OBSERVATION_INGEST_LOOKUP_TTL']:
+            self.load_lookups()
+        return self.locations, self.sensors
+
+    def read_rows(self, stream, mimetype):
+        """
+        :param stream: Binary stream of a CSV file with a header row, or of NDJSON lines
+        :return: Iterator of (row number, tuple of the FIELDS values or ObservationIngestError), numbered from 1
+        """
+        if mimetype in CSV_MIMETYPES:
+            reader = csv.reader(read_lines(stream, 'utf-8-sig', newline=''))
+            header = [name.strip() for name in next(reader, [])]
+            indexes = get_field_indexes(header)
+            for number, row in enumerate(reader, 1):
+                yield number, tuple(row[index] if index != None and index < len(row) else None for index in indexes)
+        else:
+            number = 0
+            for line in read_lines(stream, 'utf-8'):
+                if not line.strip():
+                    continue
+                number += 1
+                try:
+                    data = json.loads(line)
+                except ValueError:
+                    yield number, ObservationIngestError("invalid JSON")
+                    continue
+                if not isinstance(data, dict):
+                    yield number, ObservationIngestError("an observation must be an object")
+                    continue
+                values = []
+                for field, names in FIELDS:
+                    value = None
+                    for name in names:
+                        if data.get(name) != None:
+                            value = data[name]
+                            break
+                    values.append(value)
+                yield number, tuple(values)
+
+    def get_copy_lines(self, rows, summary, unit_of_measure):
+        # COPY text lines of the valid rows, the others are counted and reported in the summary.
+        locations, sensors = self.get_lookups()
+        reloaded = False
+        max_errors = current_app.config['OBSERVATION_INGEST_MAX_ERRORS']
+        for number, values in rows:
+            summary['received'] += 1
+            try:
+                if isinstance(values, ObservationIngestError):
+                    raise values
+                location, sensor, sensor_id, timestamp, height_min, height_max, numeric_value, text_value, unit = values
+                sensor_id = sensor_id if sensor_id != '' else None
+                if sensor_id != None:
+                    if isinstance(sensor_id, bool) or not str(sensor_id).strip().isdigit():
+                        raise ObservationIngestError("sensor_id must be an integer")
+                    sensor_id = int(str(sensor_id).strip())
+                unknown_sensor = sensor not in sensors if sensor_id == None else sensor_id not in self.sensor_ids
+                if (location not in locations or unknown_sensor) and not reloaded:
+                    # Locations and sensors created since the lookups were loaded.
+                    self.load_lookups()
+                    locations, sensors = self.locations, self.sensors
+                    reloaded = True
+                coordinates = locations.get(location)
+                if coordinates == None:
+                    raise ObservationIngestError("unknown location " + str(location))
+                if sensor_id == None:
+                    sensor_id = sensors.get(sensor)
+                    if sensor_id == None:
+                        raise ObservationIngestError("unknown sensor " + str(sensor))
+                elif sensor_id not in self.sensor_ids:
+                    raise ObservationIngestError("unknown sensor_id " + str(sensor_id))
+                # Parsed here, an invalid date or time would fail the COPY of the whole file.
+                timestamp = parse_timestamp(timestamp.strip()) if isinstance(timestamp, str) else None
+                if timestamp == None:
+                    raise ObservationIngestError("time must be an ISO 8601 timestamp")
+                height_min = copy_number(height_min, 'height_min_metres')
+                height_max = copy_number(height_max, 'height_max_metres') if height_max not in (None, '') else height_min
+                numeric_value = copy_number(numeric_value, 'numeric_value')
+                unit = unit if unit not in (None, '') else unit_of_measure
+                line = '\t'.join([copy_text(coordinates), str(sensor_id), timestamp.isoformat(), height_min, height_max,
+                                  numeric_value, copy_text(text_value), copy_text(unit)]) + '\n'
+                summary['staged'] += 1
+                yield line
+            except ObservationIngestError as error:
+                summary['rejected'] += 1
+                if len(summary['errors']) < max_errors:
+                    summary['errors'].append({'row': number, 'error': str(error)})
+
+    def ingest(self, rows, unit_of_measure=None):
+        """
+        Loads the rows in one transaction.
+        :param rows: Iterator of (row number, values) pairs, see read_rows
+        :param unit_of_measure: Unit of the rows without one
+        :return: Dictionary with the counts, the first OBSERVATION_INGEST_MAX_ERRORS row errors and the days
+                 touched per location
+        """
+        summary = {'received': 0, 'staged': 0, 'rejected': 0, 'inserted': 0, 'duplicates': 0, 'errors': [],
+                   'locations': []}
+        copy_stream = None
+        try:
+            # Timestamps without an offset are UTC.
+            db.session.execute(text("SET LOCAL TIME ZONE 'UTC'"))
+            db.session.execute(text(STAGING_SQL))
+            cursor = db.session.connection().connection.cursor()
+            copy_stream = CopyStream(self.get_copy_lines(rows, summary, unit_of_measure))
+            cursor.copy_expert("COPY observation_ingest_staging (" + COPY_COLUMNS + ") FROM STDIN", copy_stream,
+                               size=current_app.config['OBSERVATION_INGEST_COPY_BUFFER_SIZE'])
+            db.session.execute(text("ANALYZE observation_ingest_staging"))
+            results = db.session.execute(text(INSERT_SQL)).fetchall()
+            db.session.commit()
+        except (DBAPIError, psycopg2.Error) as error:
+            db.session.rollback()
+            if copy_stream != None and copy_stream.error != None:
+                raise copy_stream.error
+            error = error.orig if isinstance(error, DBAPIError) else error
+            raise ObservationIngestError(str(error).strip().split('\n')[0])
+        except Exception:
+            db.session.rollback()
+            raise
+        for location, first_day, last_day, inserted in results:
+            summary['inserted'] += inserted
+            summary['locations'].append({'location': self.location_names.get(location), 'first_day': first_day.isoformat(),
+                                         'last_day': last_day.isoformat(), 'inserted': inserted})
+        summary['locations'].sort(key=lambda item: item['location'] or '')
+        summary['duplicates'] = summary['staged'] - summary['inserted']
+        return summary
@@ -0,0 +1,178 @@
+#
+# Registry of the SQL statements run by the API.
+# A statement is compiled once, when it is registered, and on PostgreSQL it is prepared on each pooled
+# connection the first time it runs there and then run with EXECUTE, so repeated calls skip parsing and
+# planning. Calls, time and rows are kept per statement name to see which statements load the database.
+# @version 1.0
+#
+
+import re
+import time
+import hashlib
+import threading
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.sql import text
+from flask import current_app
+from permafrost_observations_api.extensions import db
+from permafrost_observations_api.providers.request_metrics import request_metrics
+from permafrost_observations_api.providers.slow_query_log import slow_query_log
+
+# Same bound parameter syntax as text(), casts (::date) and times (00:00) are not parameters.
+BIND_PARAMETER = re.compile(r'(?<![:\w\\]):(\w+)(?!:)')
+
+# Appended to the paginated statements, so the statement text does not change from page to page.
+# A NULL limit returns all the rows.
+PAGINATION_SQL = ' LIMIT :limit OFFSET :offset'
+
+class RegisteredQuery:
+    def __init__(self, name, sql_statement):
+        self.name = name
+        self.sql_statement = sql_statement
+        self.statement = text(sql_statement)
+        self.prepared_name = 'registered_' + hashlib.md5(sql_statement.encode('utf-8')).hexdigest()[:20]
+        # Parameters numbered in order of first appearance for PREPARE.
+        self.bind_names = []
+        for name in BIND_PARAMETER.findall(sql_statement):
+            if name not in self.bind_names:
+                self.bind_names.append(name)
+        self.prepared_statement = BIND_PARAMETER.sub(lambda match: '$' + str(self.bind_names.index(match.group(1)) + 1),
+                                                     sql_statement)
+        self.execute_statement = text('EXECUTE ' + self.prepared_name +
+                                      ('(' + ', '.join(':' + name for name in self.bind_names) + ')'
+                                       if self.bind_names else ''))
+        # False once PREPARE failed, e.g. when the type of a parameter cannot be inferred.
+        self.preparable = True
+
+class QueryStats:
+    def __init__(self, name, sql_statement):
+        self.name = name
+        self.sql_statement = ' '.join(sql_statement.split())[:200]
+        self.calls = 0
+        self.prepared_calls = 0
+        self.errors = 0
+        self.rows = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'statement': self.sql_statement,
+            'calls': self.calls,
+            'prepared_calls': self.prepared_calls,
+            'errors': self.errors,
+            'rows': self.rows,
+            'total_time_ms': round(self.total_time * 1000, 3),
+            'mean_time_ms': round(self.total_time * 1000 / self.calls, 3) if self.calls else 0,
+            'max_time_ms': round(self.max_time * 1000, 3)
+        }
+
+class QueryRegistry:
+    def __init__(self):
+        self.queries = {}
+        self.statistics = {}
+        self.lock = threading.Lock()
+
+    def register(self, name, sql_statement):
+        """
+        :param name: Name of the statement in the statistics, shared by the variants of a dynamic statement
+        :return: RegisteredQuery compiled once for the text of the statement
+        """
+        query = self.queries.get(sql_statement)
+        if query == None:
+            query = RegisteredQuery(name, sql_statement)
+            with self.lock:
+                query = self.queries.setdefault(sql_statement, query)
+        return query
+
+    def get(self, sql_statement, name=None, register=True):
+        # Statements built per request are registered under their name while there is room for them.
+        query = self.queries.get(sql_statement)
+        if query != None:
+            return query
+        if name == None:
+            name = 'sql_' + hashlib.md5(sql_statement.encode('utf-8')).hexdigest()[:8]
+        if not register or len(self.queries) >= current_app.config['QUERY_REGISTRY_MAX_QUERIES']:
+            return RegisteredQuery(name, sql_statement)
+        return self.register(name, sql_statement)
+
+    def execute(self, query, params, name=None, connection=None, prepare=True):
+        """
+        :param query: RegisteredQuery or SQL text
+        :param connection: Connection to run on instead of the session, the statement is not prepared there
+        :param prepare: False for the statements that cannot run as EXECUTE, their text is not registered
+        :return: The results of the statement
+        """
+        if not isinstance(query, RegisteredQuery):
+            query = self.get(query, name, register=prepare)
+        # Statements are prepared on the connection of the session only.
+        executor = connection if connection != None else db.session
+        prepared = prepare and connection == None and self.prepare(query)
+        start = time.perf_counter()
+        try:
+            if prepared:
+                results = executor.execute(query.execute_statement, dict((key, params.get(key)) for key in query.bind_names))
+            else:
+                results = executor.execute(query.statement, params)
+        except Exception as error:
+            elapsed = time.perf_counter() - start
+            self.record(query, name, elapsed, 0, prepared, error=True)
+            slow_query_log.record(query, params, elapsed, name, error)
+            raise
+        elapsed = time.perf_counter() - start
+        request_metrics.add_phase('db_execute', elapsed)
+        slow_query_log.record(query, params, elapsed, name)
+        # Rows read later from a server-side cursor are not counted.
+        rows = max(results.rowcount, 0) if connection == None else 0
+        self.record(query, name, elapsed, rows, prepared)
+        return results
+
+    def prepare(self, query):
+        # True when the statement is prepared on the connection of the session, PREPARE runs once per pooled connection.
+        if not query.preparable or not current_app.config['QUERY_REGISTRY_PREPARE_ENABLED']:
+            return False
+        connection = db.session.connection()
+        if connection.dialect.name != 'postgresql':
+            return False
+        prepared_names = connection.info.setdefault('registered_queries', set())
+        if query.prepared_name in prepared_names:
+            return True
+        savepoint = db.session.begin_nested()
+        try:
+            connection.exec_driver_sql('PREPARE ' + query.prepared_name + ' AS ' + query.prepared_statement)
+            savepoint.commit()
+        except DBAPIError as error:
+            savepoint.rollback()
+            # Already prepared by a connection state this process did not track, e.g. after a failed commit.
+            if 'already exists' in str(error.orig):
+                prepared_names.add(query.prepared_name)
+                return True
+            query.preparable = False
+            return False
+        prepared_names.add(query.prepared_name)
+        return True
+
+    def record(self, query, name, elapsed, rows, prepared, error=False):
+        name = name if name != None else query.name
+        with self.lock:
+            stats = self.statistics.get(name)
+            if stats == None:
+                stats = self.statistics[name] = QueryStats(name, query.sql_statement)
+            stats.calls += 1
+            stats.prepared_calls += 1 if prepared else 0
+            stats.errors += 1 if error else 0
+            stats.rows += rows
+            stats.total_time += elapsed
+            stats.max_time = max(stats.max_time, elapsed)
+
+    def stats(self):
+        # Statements ordered by the database time they used.
+        with self.lock:
+            statistics = [stats.to_dict() for stats in self.statistics.values()]
+        statistics.sort(key=lambda stats: stats['total_time_ms'], reverse=True)
+        return {
+            'registered': len(self.queries),
+            'queries': statistics
+        }
+
+query_registry = QueryRegistry()
@@ -4,111 +4,386 @@
 # @author Sergiu Buhatel <sergiu.buhatel@carleton.ca>
 #
 
-from sqlalchemy.sql import text
-from flask import json, jsonify, Response, blueprints, request
-from permafrost_observations_api.extensions import db, ma
-from collections import namedtuple
+import io
+import csv
+import time
+import base64
+from datetime import date
+from operator import attrgetter
+from flask import json, jsonify, Response, request, current_app, abort, stream_with_context
+from permafrost_observations_api.extensions import db
+from permafrost_observations_api.providers.temperature_rollup_provider import TemperatureRollupProvider, RESOLUTIONS, \
+    DEFAULT_START_DATE, DEFAULT_END_DATE
+from permafrost_observations_api.providers.row_serializer import ResultGroup, group_results
+from permafrost_observations_api.cache.ttl_lru_cache import TtlLruCache
+from permafrost_observations_api.cache.response_cache import response_cache
+from permafrost_observations_api.providers.query_registry import query_registry, PAGINATION_SQL
+from permafrost_observations_api.providers.request_metrics import request_metrics
+
+rollup_provider = TemperatureRollupProvider()
+count_cache = TtlLruCache(max_size=1024, ttl=60)
 
 class RawSqlProvider:
-    def execute_sql_and_fetch_records(self, sql_statement, params):
-        results = self.execute_sql(sql_statement, params)
-        return self.fetch_records(results)
+    def abort_bad_request(self, message):
+        error = {
+            "error": message
+        }
+        abort(Response(json.dumps(error), 400, mimetype="application/json"))
 
-    def apply_limit_and_offset(self, sql_statement):
-        limit = request.args.get('limit')
-        offset = request.args.get('offset')
-        if limit != None:
-            sql_statement = sql_statement + ' LIMIT ' + limit
-        if offset != None:
-            sql_statement = sql_statement + ' OFFSET ' + offset
-        return sql_statement
+    def get_non_negative_int_arg(self, name):
+        value = request.args.get(name)
+        if value == None:
+            return None
+        try:
+            value = int(value)
+        except ValueError:
+            self.abort_bad_request(name + " must be a non-negative integer")
+        if value < 0:
+            self.abort_bad_request(name + " must be a non-negative integer")
+        return value
+
+    def get_date_arg(self, name, default):
+        value = request.args.get(name)
+        if not value:
+            return default
+        try:
+            return date.fromisoformat(value[:10])
+        except ValueError:
+            self.abort_bad_request(name + " must be a date (YYYY-MM-DD)")
+
+    def get_resolution(self):
+        resolution = request.args.get('resolution', 'daily')
+        if resolution not in RESOLUTIONS:
+            self.abort_bad_request("resolution must be one of " + ", ".join(RESOLUTIONS))
+        return resolution
+
+    def get_locations_arg(self):
+        # Batch requests repeat the location argument, once per location.
+        locations = list(dict.fromkeys(location for location in request.args.getlist('location') if location))
+        if not locations:
+            self.abort_bad_request("at least one location is required")
+        max_locations = current_app.config['BATCH_MAX_LOCATIONS']
+        if len(locations) > max_locations:
+            self.abort_bad_request("at most " + str(max_locations) + " locations can be requested at once")
+        return locations
+
+    def get_series_options(self):
+        return {
+            'resolution': self.get_resolution(),
+            'start_date': self.get_date_arg('start_date', DEFAULT_START_DATE),
+            'end_date': self.get_date_arg('end_date', DEFAULT_END_DATE)
+        }
+
+    def get_pagination_options(self):
+        offset = self.get_non_negative_int_arg('offset')
+        return {
+            'limit': self.get_non_negative_int_arg('limit'),
+            'offset': offset if offset != None else 0
+        }
+
+    def get_export_options(self):
+        """
+        Options of the CSV exports read from the request arguments and checked at once, so that the exports
+        can be built outside of the request, e.g. by the export workers.
+        :return: Dictionary of resolution, start_date and end_date (temperatures), start_time and end_time
+                 (thermal regime), limit and offset
+        """
+        options = self.get_series_options()
+        options.update(self.get_pagination_options())
+        options.update({'start_time': request.args.get('start_date'), 'end_time': request.args.get('end_date')})
+        return options
+
+    def get_ground_temperatures_query(self, locations, options=None):
+        """
+        Ground temperatures statement and parameters for the resolution, start_date and end_date options.
+        :param options: Options of get_export_options, read from the request when None
+        :return: (statement without ORDER BY, parameters, True when it is the full daily series)
+        """
+        if options == None:
+            options = self.get_series_options()
+        sql_statement, params = rollup_provider.get_temperatures_query(locations, options['resolution'])
+        params['start_date'] = options['start_date']
+        params['end_date'] = options['end_date']
+        full_daily_series = (options['resolution'] == 'daily' and params['start_date'] == DEFAULT_START_DATE
+                             and params['end_date'] == DEFAULT_END_DATE)
+        return sql_statement, params, full_daily_series
+
+    def get_thermal_regime_query(self, locations, by_year=False, options=None):
+        if options == None:
+            options = {'start_time': request.args.get('start_date'), 'end_time': request.args.get('end_date')}
+        query = rollup_provider.get_thermal_regime_query(locations, options['start_time'], options['end_time'], by_year)
+        if query == None:
+            self.abort_bad_request("start_date and end_date must be ISO 8601 dates or timestamps")
+        return query
+
+    def apply_limit_and_offset(self, sql_statement, params, options=None):
+        self.bind_limit_and_offset(params, options)
+        return sql_statement + PAGINATION_SQL
+
+    def bind_limit_and_offset(self, params, options=None):
+        # Pagination is bound, the statement stays the same for every page.
+        if options == None:
+            options = self.get_pagination_options()
+        params['limit'] = options['limit']
+        params['offset'] = options['offset']
+        return params
+
+    def apply_keyset_pagination(self, sql_statement, params, order_by):
+        """
+        Orders the statement and, when the request carries a cursor, seeks past the last row of the
+        previous page instead of skipping rows with OFFSET.
+        :param sql_statement: Statement without ORDER BY, LIMIT and OFFSET
+        :param params: Bound parameters of the statement, updated in place
+        :param order_by: List of (column alias, 'ASC' or 'DESC') tuples identifying a row uniquely
+        :return: The paginated statement
+        """
+        order_by_clause = self.get_order_by_clause(order_by)
+        cursor = request.args.get('cursor')
+        if cursor == None:
+            return self.apply_limit_and_offset(sql_statement + order_by_clause, params)
+
+        values = self.decode_cursor(cursor, len(order_by))
+        limit_clause = ' LIMIT :limit'
+        params['limit'] = self.get_non_negative_int_arg('limit')
+        # One branch per key: the rows sharing the first i keys of the cursor and following it on key i.
+        # Every branch is an ordered range scan stopping after one page, so deep pages cost as much as the first.
+        branches = []
+        for i in reversed(range(len(order_by))):
+            predicates = [self.get_keyset_predicate(column, direction, values[j], j, j == i)
+                          for j, (column, direction) in enumerate(order_by[:i + 1])]
+            if None in predicates:
+                continue
+            branches.append('(SELECT * FROM (' + sql_statement + ') page WHERE ' + ' AND '.join(predicates) +
+                            order_by_clause + limit_clause + ')')
+        for j, value in enumerate(values):
+            if value != None:
+                params['keyset_' + str(j)] = value
+        if not branches:
+            # The cursor is the last row of a series whose keys all sort last.
+            branches.append('(SELECT * FROM (' + sql_statement + ') page WHERE FALSE)')
+        return 'SELECT * FROM (' + ' UNION ALL '.join(branches) + ') keyset' + order_by_clause + limit_clause
+
+    def get_order_by_clause(self, order_by):
+        return ' ORDER BY ' + ', '.join(column + ' ' + direction for column, direction in order_by)
+
+    def get_keyset_predicate(self, column, direction, value, index, following):
+        """
+        Predicate of the rows equal to the cursor on a key, or following it.
+        NULL keys sort last in ascending order and first in descending order, as in PostgreSQL.
+        :return: The predicate, None when no row can follow the cursor on the key
+        """
+        parameter = ':keyset_' + str(index)
+        if not following:
+            return column + ' IS NULL' if value == None else column + ' = ' + parameter
+        if value == None:
+            return None if direction == 'ASC' else column + ' IS NOT NULL'
+        if direction == 'ASC':
+            return '(' + column + ' > ' + parameter + ' OR ' + column + ' IS NULL)'
+        return column + ' < ' + parameter
+
+    def encode_cursor(self, record, order_by):
+        values = []
+        for column, direction in order_by:
+            value = getattr(record, column)
+            if value != None:
+                value = value.isoformat() if hasattr(value, 'isoformat') else str(value)
+            values.append(value)
+        return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+    def decode_cursor(self, cursor, length):
+        try:
+            values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        except ValueError:
+            values = None
+        if not isinstance(values, list) or len(values) != length or \
+                not all(value == None or isinstance(value, str) for value in values):
+            self.abort_bad_request("cursor is not valid")
+        return values
+
+    def set_next_cursor(self, response, rows, order_by):
+        # A full page means there may be more rows, the client passes the cursor back to get them.
+        limit = self.get_non_negative_int_arg('limit')
+        if limit and rows.count == limit:
+            response.headers['X-Next-Cursor'] = self.encode_cursor(rows.last_row, order_by)
+        return response
 
     def apply_count(self, sql_statement):
         return "SELECT COUNT(*) FROM (" + sql_statement + " ) src"
 
-    def execute_sql(self, sql_statement, params):
-        results = db.session.execute(text(sql_statement), params)
+    def is_approximate_count(self):
+        return request.args.get('approximate_count', '').lower() in ('1', 'true', 'yes')
+
+    def count_records(self, sql_statement, params, name=None):
+        """
+        Counts the rows of a statement without ORDER BY, LIMIT and OFFSET.
+        Exact counts are cached per statement, parameters and version of the data (the same as the response
+        cache), so a write is counted at once. Approximate counts are the planner estimate.
+        """
+        if self.is_approximate_count():
+            return self.estimate_count(sql_statement, params)
+        key = sql_statement + json.dumps([params, response_cache.get_data_key()], sort_keys=True, default=str)
+        count = count_cache.get(key)
+        if count == None:
+            count = self.execute_sql(self.apply_count(sql_statement), params,
+                                     name + '_count' if name != None else None).scalar()
+            count_cache.set(key, count)
+        return count
+
+    def estimate_count(self, sql_statement, params):
+        # EXPLAIN cannot be prepared.
+        results = self.execute_sql("EXPLAIN (FORMAT JSON) " + sql_statement, params, 'estimate_count', prepare=False)
+        plan = results.scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+
+    def apply_limit_and_offset_to_count(self, count):
+        # Same result as counting the rows of the page selected by limit and offset.
+        limit = self.get_non_negative_int_arg('limit')
+        offset = self.get_non_negative_int_arg('offset')
+        if offset != None:
+            count = max(count - offset, 0)
+        if limit != None:
+            count = min(count, limit)
+        return count
+
+    def jsonify_count(self, count):
+        return jsonify([{"count": count}])
+
+    def set_total_items(self, response, count_function):
+        # Lets a client get the total together with the data instead of calling the count endpoint.
+        if request.args.get('include_total', '').lower() in ('1', 'true', 'yes'):
+            response.headers['X-Total-Items'] = str(count_function())
+        return response
+
+    def execute_sql(self, sql_statement, params, name=None, prepare=True):
+        """
+        :param sql_statement: RegisteredQuery or SQL text, registered under name the first time it runs
+        :param prepare: False for the statements that cannot be prepared, they are not registered
+        """
+        results = query_registry.execute(sql_statement, params, name, prepare=prepare)
         db.session.commit()
         return results
 
-    def fetch_records(self, results):
-        Record = namedtuple('Record', results.keys())
-        records = [Record(*r) for r in results.fetchall()]
-        return records
-
-    def float_or_null(self, value):
-        return float(value) if value != None else value
-
-    def jsonify_records(self, records):
-        array = []
-        for record in records:
-            item = {}
-            item["name"] = record.name
-            item["text"] = record.name
-            item["lat"] = record.lat
-            item["lon"] = record.lon
-            item["lng"] = record.lon
-            item["elevation_in_metres"] = self.float_or_null(record.elevation_in_metres)
-            item["comment"] = record.comment
-            item["record_observations"] = record.record_observations
-            item["accuracy_in_metres"] = self.float_or_null(record.accuracy_in_metres)
-            item["provider"] = record.provider
-            array.append(item)
-        return jsonify(array)
-
-    def jsonify_count_records(self, records):
-        array = []
-        for record in records:
-            item = {}
-            item["count"] = record.count
-            array.append(item)
-        return jsonify(array)
-
-    def write_observation_time_temperature_into_file(self, fullpath, location):
-        with open(fullpath, 'w') as f:
-            sql_statement = """SELECT locations.name AS loc_name, 
-                                    observations.height_min_metres AS height, 
-                                    AVG(observations.numeric_value) as agg_avg, 
-                                    COUNT(observations.numeric_value) as agg_cnt, 
-                                    TO_TIMESTAMP(FLOOR(EXTRACT('epoch' FROM observations.corrected_utc_time) / 86400) * 86400) AT TIME ZONE 'UTC' AS time 
-                               FROM observations 
-                                    INNER JOIN locations ON observations.location = locations.coordinates 
-                               WHERE observations.corrected_utc_time BETWEEN '1950-01-01 00:00:00+00' AND '2050-01-01 00:00:00+00' 
-                                    AND locations.name = :location 
-                                    AND observations.unit_of_measure = 'C' 
-                                    GROUP BY observations.height_min_metres, locations.name, time 
-                                    ORDER BY loc_name ASC, height DESC """
-            sql_statement = self.apply_limit_and_offset(sql_statement)
-
-            records = self.execute_sql_and_fetch_records(sql_statement, {'location': location})
-            f.write("name,height,agg_avg,time\n")
-            for record in records:
-                f.write(record.loc_name + ',' + str(record.height) + ',' + str(record.agg_avg) + ',' + str(record.time) + "\n")
-
-    def write_observation_temperature_height_into_file(self, fullpath, location, start_date, end_date):
-        with open(fullpath, 'w') as f:
-            sql_statement = """SELECT locations.name AS loc_name, observations.
-                                            height_min_metres AS height, 
-                                            MAX(observations.numeric_value) AS max, 
-                                            MIN(observations.numeric_value) AS min, 
-                                            AVG(observations.numeric_value) as average_value, 
-                                            COUNT(observations.numeric_value) as cnt 
-                                      FROM observations 
-                                           INNER JOIN locations ON observations.location = locations.coordinates 
-                                     WHERE observations.corrected_utc_time BETWEEN :start_date 
-                                       AND :end_date 
-                                       AND locations.name = :location 
-                                       AND observations.unit_of_measure = 'C' 
-                                    GROUP BY observations.height_min_metres, locations.name 
-                                    ORDER BY loc_name ASC, height DESC; """
-            sql_statement = self.apply_limit_and_offset(sql_statement)
-
-            records = self.execute_sql_and_fetch_records(sql_statement, {
-                                                                            'location': location,
-                                                                            'start_date': start_date,
-                                                                            'end_date': end_date
-                                                                        })
-            f.write("name,height,max,min,average_value,cnt\n")
-            for record in records:
-                f.write(record.loc_name + ',' + str(record.height) + ',' + str(record.max) + ',' + str(record.min) +
-                        ',' + str(record.average_value) + ',' + str(record.cnt) + "\n")
+    def get_serialization_format(self):
+        # json is the array of objects, columnar and binary are the column oriented encodings of the same rows.
+        format = request.args.get('format', 'json')
+        if format not in ('json', 'columnar', 'binary'):
+            self.abort_bad_request("format must be one of json, columnar, binary")
+        return format
+
+    def execute_sql_and_serialize(self, sql_statement, params, serializer, format='json', name=None):
+        results = self.execute_sql(sql_statement, params, name)
+        return self.serialize(results, serializer, format)
+
+    def serialize(self, results, serializer, format='json'):
+        return request_metrics.time_serialization(self.serialize_results, results, serializer, format)
+
+    def serialize_results(self, results, serializer, format):
+        if format == 'columnar':
+            return serializer.serialize_columnar(results)
+        if format == 'binary':
+            return serializer.serialize_binary(results)
+        return serializer.serialize(results)
+
+    def serialized_response(self, rows):
+        return Response(rows.body, mimetype=rows.mimetype)
+
+    def serialize_by_location(self, results, serializer, format, locations):
+        # JSON object of the serialized rows of each location, requested locations without rows are empty.
+        yield '{'
+        separator = ''
+        remaining = list(locations)
+        for location, group in group_results(results, 'loc_name'):
+            yield separator + json.dumps(location) + ':' + self.serialize(group, serializer, format).body
+            separator = ','
+            if location in remaining:
+                remaining.remove(location)
+        for location in remaining:
+            empty = ResultGroup(list(results.keys()), iter(()))
+            yield separator + json.dumps(location) + ':' + self.serialize(empty, serializer, format).body
+            separator = ','
+        yield '}'
+
+    def grouped_response(self, sql_statement, params, serializer, locations, transform=None, name=None):
+        """
+        Runs one statement for several locations and answers a JSON object keyed by location.
+        With stream=true each location is sent as soon as its rows are serialized.
+        :param sql_statement: Statement ordered by loc_name
+        :param transform: Optional function applied to the results before serialization
+        """
+        format = self.get_serialization_format()
+        if format == 'binary':
+            self.abort_bad_request("format binary is not available for several locations")
+
+        def generate():
+            connection, results = self.execute_sql_streamed(sql_statement, params, name=name)
+            try:
+                if transform != None:
+                    results = transform(results)
+                for chunk in self.serialize_by_location(results, serializer, format, locations):
+                    yield chunk
+            finally:
+                connection.close()
+
+        if request.args.get('stream', '').lower() in ('1', 'true', 'yes'):
+            return Response(stream_with_context(generate()), mimetype="application/json")
+        return Response(''.join(generate()), mimetype="application/json")
+
+    def execute_sql_streamed(self, sql_statement, params, batch_size=None, name=None):
+        # Rows are read in batches from a server-side cursor on a dedicated connection,
+        # so memory stays flat whatever the size of the result. The caller closes the connection.
+        if batch_size == None:
+            batch_size = current_app.config['EXPORT_FETCH_BATCH_SIZE']
+        connection = db.engine.connect().execution_options(stream_results=True, max_row_buffer=batch_size)
+        try:
+            return connection, query_registry.execute(sql_statement, params, name, connection=connection)
+        except Exception:
+            connection.close()
+            raise
+
+    def stream_records(self, sql_statement, params, batch_size=None, name=None):
+        if batch_size == None:
+            batch_size = current_app.config['EXPORT_FETCH_BATCH_SIZE']
+        connection, results = self.execute_sql_streamed(sql_statement, params, batch_size, name)
+        results = request_metrics.timed_results(results)
+        try:
+            while True:
+                rows = results.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            connection.close()
+
+    def stream_csv(self, sql_statement, params, columns, header=None, name=None):
+        yield ','.join(header if header != None else columns) + "\n"
+        getter = attrgetter(*columns)
+        for rows in self.stream_records(sql_statement, params, name=name):
+            start = time.perf_counter()
+            buffer = io.StringIO()
+            writer = csv.writer(buffer, lineterminator="\n")
+            writer.writerows(getter(row) for row in rows)
+            request_metrics.add_phase('serialize', time.perf_counter() - start)
+            yield buffer.getvalue()
+
+    def order_time_temperatures(self, sql_statement):
+        return sql_statement + """ ORDER BY loc_name ASC, height DESC, time ASC """
+
+    def stream_observation_time_temperature_csv(self, location, options):
+        """
+        :param options: Options of get_export_options, the statement is built now and run when the chunks are read
+        """
+        sql_statement, params, full_daily_series = self.get_ground_temperatures_query([location], options)
+        sql_statement = self.order_time_temperatures(sql_statement)
+        sql_statement = self.apply_limit_and_offset(sql_statement, params, options)
+        return self.stream_csv(sql_statement, params, ['loc_name', 'height', 'agg_avg', 'time'],
+                               header=['name', 'height', 'agg_avg', 'time'], name='ground_temperatures_csv')
+
+    def stream_observation_temperature_height_csv(self, location, options):
+        sql_statement, params = self.get_thermal_regime_query([location], options=options)
+        sql_statement = self.apply_limit_and_offset(sql_statement, params, options)
+        return self.stream_csv(sql_statement, params,
+                               ['loc_name', 'height', 'max', 'min', 'average_value', 'cnt'],
+                               header=['name', 'height', 'max', 'min', 'average_value', 'cnt'],
+                               name='ground_thermal_regime_csv')
@@ -0,0 +1,249 @@
+#
+# Per-route request metrics in the Prometheus text format.
+# Each request gets a timer in flask.g, to which authorization, statement execution, row fetching and
+# serialization add their time. The timer is recorded when the request is torn down, so a request costs a
+# few dictionary updates and one locked merge. The size of a body of unknown length is recorded when the
+# server closes it, after the last chunk, whether or not the request was torn down before.
+# @version 1.0
+#
+
+import time
+import bisect
+import threading
+from flask import current_app, g, has_request_context, request
+
+PHASES = ('auth', 'db_execute', 'fetch', 'serialize', 'other')
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+BYTE_BUCKETS = (1024, 8192, 65536, 262144, 1048576, 4194304, 16777216, 67108864, 268435456)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labels):
+    return '{' + ','.join(name + '="' + escape_label(value) + '"' for name, value in labels) + '}'
+
+def format_number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        # Buckets are upper bounds, inclusive as the le label says.
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels, lines):
+        cumulative = 0
+        for bucket, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(name + '_bucket' + format_labels(labels + [('le', format_number(bucket))]) + ' ' + str(cumulative))
+        lines.append(name + '_bucket' + format_labels(labels + [('le', '+Inf')]) + ' ' + str(self.count))
+        lines.append(name + '_sum' + format_labels(labels) + ' ' + format_number(self.sum))
+        lines.append(name + '_count' + format_labels(labels) + ' ' + str(self.count))
+
+class RouteMetrics:
+    def __init__(self):
+        self.statuses = {}
+        self.duration = Histogram(LATENCY_BUCKETS)
+        self.phases = dict((phase, Histogram(LATENCY_BUCKETS)) for phase in PHASES)
+        self.rows = Histogram(ROW_BUCKETS)
+        self.bytes = Histogram(BYTE_BUCKETS)
+
+class RequestTimer:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = {}
+        self.rows = None
+        self.bytes = None
+        self.status = None
+        # Route of the recorded request and whether its body is still being sent.
+        self.key = None
+        self.sending = False
+
+    def add(self, phase, elapsed):
+        self.phases[phase] = self.phases.get(phase, 0.0) + elapsed
+
+class TimedResults:
+    # Result-like object (keys, fetchmany and fetchall) adding the time and the rows read to the timer.
+    def __init__(self, results, timer):
+        self.results = results
+        self.timer = timer
+
+    def keys(self):
+        return self.results.keys()
+
+    def fetchmany(self, size):
+        start = time.perf_counter()
+        rows = self.results.fetchmany(size)
+        self.record(rows, time.perf_counter() - start)
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = self.results.fetchall()
+        self.record(rows, time.perf_counter() - start)
+        return rows
+
+    def record(self, rows, elapsed):
+        self.timer.add('fetch', elapsed)
+        self.timer.rows = (self.timer.rows or 0) + len(rows)
+
+class CountedChunks:
+    # Body of a streamed response counting its bytes, e.g. a generator or the file of send_file.
+    def __init__(self, chunks, timer, metrics):
+        self.chunks = chunks
+        self.timer = timer
+        self.metrics = metrics
+        timer.bytes = 0
+        timer.sending = True
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            self.timer.bytes += len(chunk) if isinstance(chunk, bytes) else len(chunk.encode('utf-8'))
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.chunks, 'close'):
+                self.chunks.close()
+        finally:
+            self.metrics.finish_body(self.timer)
+
+class RequestMetrics:
+    def __init__(self):
+        self.routes = {}
+        self.in_flight = 0
+        self.lock = threading.Lock()
+
+    def get_timer(self):
+        return g.get('request_timer') if has_request_context() else None
+
+    def start_request(self):
+        if not current_app.config['METRICS_ENABLED']:
+            return
+        g.request_timer = RequestTimer()
+        with self.lock:
+            self.in_flight += 1
+
+    def add_phase(self, phase, elapsed):
+        timer = self.get_timer()
+        if timer != None:
+            timer.add(phase, elapsed)
+
+    def timed_results(self, results):
+        """
+        :return: The results, read through a TimedResults when the request is timed
+        """
+        timer = self.get_timer()
+        return TimedResults(results, timer) if timer != None else results
+
+    def time_serialization(self, serialize, results, *args):
+        """
+        Calls serialize(results, *args), its time reading rows goes to the fetch phase and the rest to serialize.
+        """
+        timer = self.get_timer()
+        if timer == None:
+            return serialize(results, *args)
+        fetch_time = timer.phases.get('fetch', 0.0)
+        start = time.perf_counter()
+        rows = serialize(TimedResults(results, timer), *args)
+        timer.add('serialize', time.perf_counter() - start - (timer.phases.get('fetch', 0.0) - fetch_time))
+        return rows
+
+    def finish_response(self, response):
+        timer = self.get_timer()
+        if timer == None:
+            return response
+        timer.status = response.status_code
+        if response.content_length != None:
+            timer.bytes = response.content_length
+        elif response.is_streamed:
+            response.response = CountedChunks(response.response, timer, self)
+        else:
+            timer.bytes = response.calculate_content_length()
+        return response
+
+    def finish_request(self):
+        timer = g.pop('request_timer', None)
+        if timer == None:
+            return
+        elapsed = time.perf_counter() - timer.start
+        key = (request.url_rule.rule if request.url_rule != None else 'unmatched', request.method)
+        # View code outside the measured phases, e.g. jsonify of fetched records, and cache hits.
+        timer.phases['other'] = max(elapsed - sum(timer.phases.values()), 0.0)
+        with self.lock:
+            self.in_flight -= 1
+            route = self.routes.get(key)
+            if route == None:
+                route = self.routes[key] = RouteMetrics()
+            status = timer.status if timer.status != None else 500
+            route.statuses[status] = route.statuses.get(status, 0) + 1
+            route.duration.observe(elapsed)
+            for phase in PHASES:
+                route.phases[phase].observe(timer.phases.get(phase, 0.0))
+            if timer.rows != None:
+                route.rows.observe(timer.rows)
+            if timer.sending:
+                # Recorded by finish_body.
+                timer.key = key
+            elif timer.bytes != None:
+                route.bytes.observe(timer.bytes)
+
+    def finish_body(self, timer):
+        # The body was closed by the server, its size is recorded with the request if it was already torn down.
+        with self.lock:
+            timer.sending = False
+            if timer.key != None:
+                self.routes[timer.key].bytes.observe(timer.bytes)
+
+    def render(self):
+        """
+        :return: The metrics in the Prometheus text exposition format
+        """
+        lines = []
+        with self.lock:
+            routes = sorted(self.routes.items())
+            lines.append('# HELP permafrost_api_requests_in_flight Requests being served.')
+            lines.append('# TYPE permafrost_api_requests_in_flight gauge')
+            lines.append('permafrost_api_requests_in_flight ' + str(self.in_flight))
+            lines.append('# HELP permafrost_api_requests_total Requests served, by route, method and status.')
+            lines.append('# TYPE permafrost_api_requests_total counter')
+            for (rule, method), route in routes:
+                for status, count in sorted(route.statuses.items()):
+                    lines.append('permafrost_api_requests_total' +
+                                 format_labels([('route', rule), ('method', method), ('status', status)]) +
+                                 ' ' + str(count))
+            lines.append('# HELP permafrost_api_request_duration_seconds Time from the start of the request to '
+                         'the last byte of the response.')
+            lines.append('# TYPE permafrost_api_request_duration_seconds histogram')
+            for (rule, method), route in routes:
+                route.duration.render('permafrost_api_request_duration_seconds',
+                                      [('route', rule), ('method', method)], lines)
+            lines.append('# HELP permafrost_api_request_phase_seconds Time of a request spent in auth, db_execute, '
+                         'fetch, serialize and other.')
+            lines.append('# TYPE permafrost_api_request_phase_seconds histogram')
+            for (rule, method), route in routes:
+                for phase in PHASES:
+                    route.phases[phase].render('permafrost_api_request_phase_seconds',
+                                               [('route', rule), ('method', method), ('phase', phase)], lines)
+            lines.append('# HELP permafrost_api_response_rows Rows read from the database per request.')
+            lines.append('# TYPE permafrost_api_response_rows histogram')
+            for (rule, method), route in routes:
+                route.rows.render('permafrost_api_response_rows', [('route', rule), ('method', method)], lines)
+            lines.append('# HELP permafrost_api_response_bytes Size of the response body.')
+            lines.append('# TYPE permafrost_api_response_bytes histogram')
+            for (rule, method), route in routes:
+                route.bytes.render('permafrost_api_response_bytes', [('route', rule), ('method', method)], lines)
+        return '\n'.join(lines) + '\n'
+
+request_metrics = RequestMetrics()
@@ -0,0 +1,187 @@
+#
+# Compression of the JSON and CSV responses, negotiated with the Accept-Encoding header of the client.
+# zstd and brotli are used when their packages (zstandard, brotli) are installed and accepted, gzip otherwise.
+# Bodies under COMPRESSION_MIN_BYTES are sent as they are, streamed bodies are compressed chunk by chunk.
+# @version 1.0
+#
+
+import zlib
+from flask import current_app, request, g
+from permafrost_observations_api.cache.response_cache import response_cache
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = ['application/json', 'text/plain', 'text/csv', 'text/html']
+
+# Suffix of the precompressed copy of a file, e.g. an export artifact.
+SUFFIXES = {'zstd': '.zst', 'br': '.br', 'gzip': '.gz'}
+
+COPY_BUFFER_SIZE = 256 * 1024
+
+class GzipCompressor:
+    def __init__(self, level):
+        # wbits 31: gzip header and trailer around the deflate stream.
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def flush(self):
+        return self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.compressor.flush()
+
+class ZstdCompressor:
+    def __init__(self, level):
+        self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def flush(self):
+        return self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self.compressor.flush()
+
+class BrotliCompressor:
+    def __init__(self, level):
+        self.compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def flush(self):
+        return self.compressor.flush()
+
+    def finish(self):
+        return self.compressor.finish()
+
+class CompressedChunks:
+    # Body of a streamed response compressed as it is read, the inner body is closed with it.
+    # Each chunk is flushed, the client receives it when the view yields it, as without compression.
+    def __init__(self, chunks, compressor):
+        self.chunks = chunks
+        self.compressor = compressor
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            data = self.compressor.compress(chunk if isinstance(chunk, bytes) else chunk.encode('utf-8'))
+            data += self.compressor.flush()
+            if data:
+                yield data
+        yield self.compressor.finish()
+
+    def close(self):
+        if hasattr(self.chunks, 'close'):
+            self.chunks.close()
+
+class ResponseCompression:
+    def get_encodings(self):
+        """
+        :return: Encodings this process can produce, preferred first
+        """
+        encodings = []
+        for encoding in current_app.config['COMPRESSION_ENCODINGS']:
+            if encoding == 'zstd' and zstandard == None or encoding == 'br' and brotli == None:
+                continue
+            if encoding in SUFFIXES:
+                encodings.append(encoding)
+        return encodings
+
+    def is_enabled(self):
+        return current_app.config['COMPRESSION_ENABLED']
+
+    def negotiate(self):
+        """
+        :return: Encoding of the response, the best quality accepted by the client and then the server
+        preference, None when the client accepts none of them
+        """
+        if not self.is_enabled():
+            return None
+        accepted = request.accept_encodings
+        best = None
+        best_quality = 0
+        for encoding in self.get_encodings():
+            quality = accepted[encoding]
+            if quality > best_quality:
+                best = encoding
+                best_quality = quality
+        return best
+
+    def get_compressor(self, encoding):
+        config = current_app.config
+        if encoding == 'zstd':
+            return ZstdCompressor(config['COMPRESSION_ZSTD_LEVEL'])
+        if encoding == 'br':
+            return BrotliCompressor(config['COMPRESSION_BROTLI_QUALITY'])
+        return GzipCompressor(config['COMPRESSION_GZIP_LEVEL'])
+
+    def compress(self, data, encoding):
+        compressor = self.get_compressor(encoding)
+        return compressor.compress(data) + compressor.finish()
+
+    def compress_file(self, path, encoding):
+        """
+        Writes the compressed copy of a file next to it.
+        :return: Path of the copy
+        """
+        compressed_path = path + SUFFIXES[encoding]
+        compressor = self.get_compressor(encoding)
+        with open(path, 'rb') as source, open(compressed_path, 'wb') as destination:
+            while True:
+                data = source.read(COPY_BUFFER_SIZE)
+                if not data:
+                    break
+                destination.write(compressor.compress(data))
+            destination.write(compressor.finish())
+        return compressed_path
+
+    def is_compressible(self, response):
+        return response.mimetype in COMPRESSIBLE_MIMETYPES
+
+    def compress_response(self, response):
+        """
+        Compresses the body of a response in the encoding negotiated with the client.
+        :param response: Response of a view
+        :return: The response, compressed when the client accepts it and it is worth it
+        """
+        if not self.is_compressible(response) or not self.is_enabled():
+            return response
+        response.vary.add('Accept-Encoding')
+        if request.method == 'HEAD' or response.status_code != 200 or 'Content-Encoding' in response.headers \
+                or 'Content-Range' in response.headers:
+            return response
+        encoding = self.negotiate()
+        if encoding == None:
+            return response
+        if response.is_streamed:
+            response.response = CompressedChunks(response.response, self.get_compressor(encoding))
+            # The file wrapper of send_file is replaced, waitress reads the compressed chunks.
+            response.direct_passthrough = False
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < current_app.config['COMPRESSION_MIN_BYTES']:
+                return response
+            data = self.compress(data, encoding)
+            response.set_data(data)
+            cache_entry = g.pop('response_cache_entry', None)
+            if cache_entry != None:
+                response_cache.set_encoding(cache_entry[0], cache_entry[1], encoding, data)
+        response.headers['Content-Encoding'] = encoding
+        # A compressed body is another representation of the resource.
+        if response.get_etag()[0] != None:
+            response.set_etag(response.get_etag()[0], weak=True)
+        return response
+
+response_compression = ResponseCompression()
@@ -0,0 +1,156 @@
+#
+# Log of the statements slower than SLOW_QUERY_THRESHOLD_MS, with their parameters and their plan.
+# The last SLOW_QUERY_LOG_SIZE statements are kept in a ring buffer. A worker thread explains them on its
+# own connection, after the request, at most once per statement name every SLOW_QUERY_EXPLAIN_INTERVAL
+# seconds. EXPLAIN ANALYZE runs the statement again in a read-only transaction that is rolled back; a
+# statement that writes is explained without ANALYZE.
+# @version 1.0
+#
+
+import time
+import queue
+import datetime
+import threading
+import collections
+from decimal import Decimal
+from sqlalchemy.sql import text
+from flask import current_app, has_request_context, request
+from permafrost_observations_api.extensions import db
+
+EXPLAIN_QUEUE_SIZE = 16
+
+def get_loggable_value(value):
+    if value == None or isinstance(value, (str, int, float, bool)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [get_loggable_value(item) for item in value]
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    return str(value)
+
+class SlowQueryLog:
+    def __init__(self):
+        self.entries = None
+        self.explained_at = {}
+        self.explain_queue = queue.Queue(EXPLAIN_QUEUE_SIZE)
+        self.worker = None
+        self.lock = threading.Lock()
+        self.slow_queries = 0
+        self.dropped_explains = 0
+
+    def get_entries(self):
+        if self.entries == None:
+            with self.lock:
+                if self.entries == None:
+                    self.entries = collections.deque(maxlen=current_app.config['SLOW_QUERY_LOG_SIZE'])
+        return self.entries
+
+    def record(self, query, params, elapsed, name=None, error=None):
+        """
+        Logs the statement when it ran longer than the threshold, and queues its plan.
+        :param query: RegisteredQuery that ran
+        :param elapsed: Duration of the statement in seconds
+        :param name: Name the statement ran under, the name it was registered with by default
+        """
+        config = current_app.config
+        if not config['SLOW_QUERY_LOG_ENABLED'] or elapsed * 1000 < config['SLOW_QUERY_THRESHOLD_MS']:
+            return
+        name = name if name != None else query.name
+        params = dict((key, params.get(key)) for key in query.bind_names)
+        entry = {
+            'name': name,
+            'statement': query.sql_statement,
+            'params': dict((key, get_loggable_value(value)) for key, value in params.items()),
+            'duration_ms': round(elapsed * 1000, 3),
+            'logged_at': datetime.datetime.utcnow().isoformat() + 'Z',
+            'path': request.full_path if has_request_context() else None,
+            'error': str(error).strip().split('\n')[0] if error != None else None,
+            'plan': None,
+            'plan_status': 'not_sampled'
+        }
+        entries = self.get_entries()
+        with self.lock:
+            self.slow_queries += 1
+            entries.append(entry)
+            sampled = (config['SLOW_QUERY_EXPLAIN_ENABLED'] and db.engine.dialect.name == 'postgresql' and
+                       time.time() - self.explained_at.get(name, 0) >= config['SLOW_QUERY_EXPLAIN_INTERVAL'])
+            if sampled:
+                self.explained_at[name] = time.time()
+                entry['plan_status'] = 'pending'
+        if sampled:
+            self.queue_explain(entry, query, params)
+
+    def queue_explain(self, entry, query, params):
+        try:
+            self.explain_queue.put_nowait((current_app._get_current_object(), entry, query, params))
+        except queue.Full:
+            with self.lock:
+                self.dropped_explains += 1
+                entry['plan_status'] = 'dropped'
+            return
+        with self.lock:
+            if self.worker == None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self.explain_worker, name='slow-query-explain', daemon=True)
+                self.worker.start()
+
+    def explain_worker(self):
+        while True:
+            app, entry, query, params = self.explain_queue.get()
+            try:
+                with app.app_context():
+                    plan, analyzed = self.explain(query, params)
+                with self.lock:
+                    entry['plan'] = plan
+                    entry['plan_status'] = 'analyzed' if analyzed else 'explained'
+            except Exception as error:
+                with self.lock:
+                    entry['plan_status'] = 'failed'
+                    entry['plan_error'] = str(error).strip().split('\n')[0]
+
+    def explain(self, query, params):
+        """
+        :return: (JSON plan of the statement, True when it comes from EXPLAIN ANALYZE)
+        """
+        config = current_app.config
+        timeout = int(config['SLOW_QUERY_EXPLAIN_TIMEOUT_MS'])
+        with db.engine.connect() as connection:
+            if config['SLOW_QUERY_EXPLAIN_ANALYZE']:
+                transaction = connection.begin()
+                try:
+                    connection.execute(text("SET TRANSACTION READ ONLY"))
+                    connection.execute(text("SET LOCAL statement_timeout = " + str(timeout)))
+                    results = connection.execute(text("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + query.sql_statement),
+                                                 params)
+                    return results.scalar(), True
+                except Exception:
+                    # Statements that write cannot run in a read-only transaction and statements that time out
+                    # are only explained.
+                    pass
+                finally:
+                    transaction.rollback()
+            transaction = connection.begin()
+            try:
+                connection.execute(text("SET LOCAL statement_timeout = " + str(timeout)))
+                results = connection.execute(text("EXPLAIN (FORMAT JSON) " + query.sql_statement), params)
+                return results.scalar(), False
+            finally:
+                transaction.rollback()
+
+    def stats(self, name=None, limit=None):
+        """
+        :param name: Only the entries of this statement name
+        :param limit: Number of entries returned, the most recent first
+        """
+        entries = self.get_entries()
+        with self.lock:
+            selected = [dict(entry) for entry in reversed(entries) if name == None or entry['name'] == name]
+            return {
+                'threshold_ms': current_app.config['SLOW_QUERY_THRESHOLD_MS'],
+                'slow_queries': self.slow_queries,
+                'dropped_explains': self.dropped_explains,
+                'entries': selected[:limit] if limit != None else selected
+            }
+
+slow_query_log = SlowQueryLog()
@@ -0,0 +1,469 @@
+#
+# Per-location, per-depth, per-day rollup of the ground temperature observations.
+# The rollup keeps sum, count, min and max so daily averages can be served without
+# scanning the raw observations. Triggers on observations record the days touched by
+# new data and the refresh only reprocesses those days. Monthly partials merged from the days
+# answer the ground thermal regime of long date ranges with a few rows per depth.
+# @version 1.0
+#
+
+import time
+from datetime import date, datetime, timedelta, timezone
+from dateutil.parser import isoparse
+from sqlalchemy.sql import text
+from flask import current_app
+from permafrost_observations_api.extensions import db
+
+# UTC day of an observation, the same bucketing used by the queries on the raw observations.
+DAY_EXPRESSION = """(TO_TIMESTAMP(FLOOR(EXTRACT('epoch' FROM observations.corrected_utc_time) / 86400) * 86400) AT TIME ZONE 'UTC')::date"""
+
+# Resolutions of /ground_temperatures and the DATE_TRUNC unit of their buckets.
+RESOLUTIONS = {
+    'hourly': 'hour',
+    'daily': 'day',
+    'weekly': 'week',
+    'monthly': 'month',
+    'yearly': 'year'
+}
+
+# (rollup, raw) branches of the statements: rollup only, raw observations only, or both.
+BRANCH_COMBINATIONS = [(True, False), (False, True), (True, True)]
+
+DEFAULT_START_DATE = date(1950, 1, 1)
+DEFAULT_END_DATE = date(2050, 1, 1)
+
+# The date window is inclusive and applies to whole UTC days, the same on both sources.
+TEMPERATURES_RAW_SQL = """SELECT locations.name AS loc_name,
+                              observations.height_min_metres AS height,
+                              AVG(observations.numeric_value) as agg_avg,
+                              COUNT(observations.numeric_value) as agg_cnt,
+                              DATE_TRUNC('{unit}', TO_TIMESTAMP(EXTRACT('epoch' FROM observations.corrected_utc_time)) AT TIME ZONE 'UTC') AS time
+                         FROM observations
+                              INNER JOIN locations ON observations.location = locations.coordinates
+                         WHERE observations.corrected_utc_time >= CAST(:start_date AS timestamp) AT TIME ZONE 'UTC'
+                              AND observations.corrected_utc_time < (CAST(:end_date AS timestamp) + INTERVAL '1 day') AT TIME ZONE 'UTC'
+                              AND locations.name = ANY(:raw_locations)
+                              AND observations.unit_of_measure = 'C'
+                              GROUP BY observations.height_min_metres, locations.name, time """
+
+DAILY_TEMPERATURES_ROLLUP_SQL = """SELECT location_name AS loc_name,
+                                       height,
+                                       sum_value / NULLIF(count_value, 0) AS agg_avg,
+                                       count_value AS agg_cnt,
+                                       day::timestamp AS time
+                                  FROM daily_temperature_rollups
+                                 WHERE location_name = ANY(:rollup_locations)
+                                   AND day BETWEEN :start_date AND :end_date """
+
+# Coarser resolutions merge the daily partial aggregates.
+MERGED_TEMPERATURES_ROLLUP_SQL = """SELECT location_name AS loc_name,
+                                        height,
+                                        SUM(sum_value) / NULLIF(SUM(count_value), 0) AS agg_avg,
+                                        SUM(count_value) AS agg_cnt,
+                                        DATE_TRUNC('{unit}', day::timestamp) AS time
+                                   FROM daily_temperature_rollups
+                                  WHERE location_name = ANY(:rollup_locations)
+                                    AND day BETWEEN :start_date AND :end_date
+                                  GROUP BY location_name, height, time """
+
+SCHEMA_SQL = [
+    """CREATE TABLE IF NOT EXISTS daily_temperature_rollups (
+           location_name TEXT NOT NULL,
+           height NUMERIC NOT NULL,
+           day DATE NOT NULL,
+           sum_value NUMERIC,
+           count_value BIGINT NOT NULL,
+           min_value NUMERIC,
+           max_value NUMERIC,
+           PRIMARY KEY (location_name, height, day))""",
+    # Matches the ORDER BY of /ground_temperatures so keyset pages are read as ordered index ranges.
+    """CREATE INDEX IF NOT EXISTS daily_temperature_rollups_keyset
+           ON daily_temperature_rollups (location_name, height DESC, (day::timestamp))""",
+    """CREATE TABLE IF NOT EXISTS temperature_rollup_dirty_days (
+           location_name TEXT NOT NULL,
+           day DATE NOT NULL,
+           PRIMARY KEY (location_name, day))""",
+    """CREATE TABLE IF NOT EXISTS temperature_rollup_locations (
+           location_name TEXT PRIMARY KEY,
+           refreshed_at TIMESTAMPTZ NOT NULL DEFAULT now())""",
+    """ALTER TABLE temperature_rollup_locations ADD COLUMN IF NOT EXISTS row_count BIGINT""",
+    """CREATE TABLE IF NOT EXISTS monthly_temperature_rollups (
+           location_name TEXT NOT NULL,
+           height NUMERIC NOT NULL,
+           month DATE NOT NULL,
+           sum_value NUMERIC,
+           count_value BIGINT NOT NULL,
+           min_value NUMERIC,
+           max_value NUMERIC,
+           PRIMARY KEY (location_name, month, height))""",
+    # Existing daily rollups get their months on the first install.
+    """INSERT INTO monthly_temperature_rollups (location_name, height, month, sum_value, count_value, min_value, max_value)
+       SELECT location_name, height, DATE_TRUNC('month', day)::date, SUM(sum_value), SUM(count_value), MIN(min_value), MAX(max_value)
+         FROM daily_temperature_rollups
+        WHERE NOT EXISTS (SELECT 1 FROM monthly_temperature_rollups)
+        GROUP BY 1, 2, 3""",
+    """CREATE OR REPLACE FUNCTION mark_temperature_rollup_dirty_days() RETURNS trigger AS $$
+       BEGIN
+           INSERT INTO temperature_rollup_dirty_days (location_name, day)
+           SELECT DISTINCT locations.name, """ + DAY_EXPRESSION.replace('observations.', 'changed_observations.') + """
+             FROM changed_observations
+                  INNER JOIN locations ON changed_observations.location = locations.coordinates
+            WHERE changed_observations.unit_of_measure = 'C'
+           ON CONFLICT DO NOTHING;
+           RETURN NULL;
+       END;
+       $$ LANGUAGE plpgsql""",
+    """DROP TRIGGER IF EXISTS observations_rollup_insert ON observations""",
+    """CREATE TRIGGER observations_rollup_insert AFTER INSERT ON observations
+       REFERENCING NEW TABLE AS changed_observations
+       FOR EACH STATEMENT EXECUTE PROCEDURE mark_temperature_rollup_dirty_days()""",
+    """DROP TRIGGER IF EXISTS observations_rollup_update_old ON observations""",
+    """CREATE TRIGGER observations_rollup_update_old AFTER UPDATE ON observations
+       REFERENCING OLD TABLE AS changed_observations
+       FOR EACH STATEMENT EXECUTE PROCEDURE mark_temperature_rollup_dirty_days()""",
+    """DROP TRIGGER IF EXISTS observations_rollup_update_new ON observations""",
+    """CREATE TRIGGER observations_rollup_update_new AFTER UPDATE ON observations
+       REFERENCING NEW TABLE AS changed_observations
+       FOR EACH STATEMENT EXECUTE PROCEDURE mark_temperature_rollup_dirty_days()""",
+    """DROP TRIGGER IF EXISTS observations_rollup_delete ON observations""",
+    """CREATE TRIGGER observations_rollup_delete AFTER DELETE ON observations
+       REFERENCING OLD TABLE AS changed_observations
+       FOR EACH STATEMENT EXECUTE PROCEDURE mark_temperature_rollup_dirty_days()"""
+]
+
+ROLLUP_SELECT_SQL = """SELECT locations.name,
+                              observations.height_min_metres,
+                              """ + DAY_EXPRESSION + """ AS day,
+                              SUM(observations.numeric_value),
+                              COUNT(observations.numeric_value),
+                              MIN(observations.numeric_value),
+                              MAX(observations.numeric_value)
+                         FROM observations
+                              INNER JOIN locations ON observations.location = locations.coordinates """
+
+ROLLUP_GROUP_BY_SQL = """ AND observations.unit_of_measure = 'C'
+                          AND observations.height_min_metres IS NOT NULL
+                     GROUP BY 1, 2, 3"""
+
+ROLLUP_INSERT_SQL = """INSERT INTO daily_temperature_rollups
+                              (location_name, height, day, sum_value, count_value, min_value, max_value) """
+
+MONTHLY_ROLLUP_INSERT_SQL = """INSERT INTO monthly_temperature_rollups
+                                      (location_name, height, month, sum_value, count_value, min_value, max_value)
+                               SELECT daily_temperature_rollups.location_name,
+                                      daily_temperature_rollups.height,
+                                      DATE_TRUNC('month', daily_temperature_rollups.day)::date AS month,
+                                      SUM(daily_temperature_rollups.sum_value),
+                                      SUM(daily_temperature_rollups.count_value),
+                                      MIN(daily_temperature_rollups.min_value),
+                                      MAX(daily_temperature_rollups.max_value)
+                                 FROM daily_temperature_rollups """
+
+MONTHLY_ROLLUP_GROUP_BY_SQL = """ GROUP BY 1, 2, 3"""
+
+# Partial aggregates (min, max, sum, count) per year and depth of the ground thermal regime sources.
+YEAR_EXPRESSION = """EXTRACT(YEAR FROM TO_TIMESTAMP(EXTRACT('epoch' FROM observations.corrected_utc_time)) AT TIME ZONE 'UTC')"""
+
+THERMAL_REGIME_RAW_PARTIALS_SQL = """SELECT locations.name AS loc_name,
+                                            """ + YEAR_EXPRESSION + """ AS year,
+                                            observations.height_min_metres AS height,
+                                            MIN(observations.numeric_value) AS min_value,
+                                            MAX(observations.numeric_value) AS max_value,
+                                            SUM(observations.numeric_value) AS sum_value,
+                                            COUNT(observations.numeric_value) AS count_value
+                                       FROM observations
+                                            INNER JOIN locations ON observations.location = locations.coordinates
+                                      WHERE {time_range}
+                                        AND locations.name = ANY(:{locations})
+                                        AND observations.unit_of_measure = 'C'
+                                      GROUP BY 1, 2, 3"""
+
+THERMAL_REGIME_DAILY_PARTIALS_SQL = """SELECT location_name AS loc_name, EXTRACT(YEAR FROM day) AS year, height,
+                                              min_value, max_value, sum_value, count_value
+                                         FROM daily_temperature_rollups
+                                        WHERE location_name = ANY(:rollup_locations)
+                                          AND (day >= :first_day AND day < :first_month
+                                               OR day >= :end_month AND day <= :last_day)"""
+
+THERMAL_REGIME_MONTHLY_PARTIALS_SQL = """SELECT location_name AS loc_name, EXTRACT(YEAR FROM month) AS year, height,
+                                                min_value, max_value, sum_value, count_value
+                                           FROM monthly_temperature_rollups
+                                          WHERE location_name = ANY(:rollup_locations)
+                                            AND month >= :first_month AND month < :end_month"""
+
+THERMAL_REGIME_SQL = """SELECT loc_name,{year_column}
+                               height,
+                               MAX(max_value) AS max,
+                               MIN(min_value) AS min,
+                               SUM(sum_value) / NULLIF(SUM(count_value), 0) AS average_value,
+                               SUM(count_value) AS cnt
+                          FROM ({partials}) partials
+                         GROUP BY loc_name,{year_column} height
+                         ORDER BY loc_name ASC,{year_order} height DESC """
+
+def parse_timestamp(value):
+    # Timestamps without an offset are UTC. None when the value is not an ISO 8601 date or timestamp.
+    try:
+        value = isoparse(value)
+    except (ValueError, OverflowError):
+        return None
+    if value.tzinfo == None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+def next_month(day):
+    return date(day.year + 1, 1, 1) if day.month == 12 else date(day.year, day.month + 1, 1)
+
+class TemperatureRollupProvider:
+    def __init__(self):
+        self.installed = False
+        self.installed_checked_at = 0
+
+    def create_schema(self):
+        for sql_statement in SCHEMA_SQL:
+            db.session.execute(text(sql_statement))
+        db.session.commit()
+
+    def refresh(self, full=False):
+        """
+        Refreshes the rollup.
+        :param full: Rebuild the rollup of every location instead of only the dirty days
+        :return: The names of the refreshed locations, None after a full refresh
+        """
+        locations = None
+        if full:
+            self.refresh_all()
+            self.update_row_counts("")
+        else:
+            locations = self.refresh_dirty_days() | self.refresh_stale_locations()
+            self.update_row_counts("""WHERE row_count IS NULL
+                                         OR location_name IN (SELECT location_name FROM claimed_dirty_days)""")
+        db.session.commit()
+        return locations
+
+    def update_row_counts(self, where_clause):
+        # Number of daily rows served by /ground_temperatures for the default window, kept so counts are a point lookup.
+        db.session.execute(text("""UPDATE temperature_rollup_locations
+                                      SET row_count = (SELECT COUNT(*) FROM daily_temperature_rollups
+                                                        WHERE daily_temperature_rollups.location_name = temperature_rollup_locations.location_name
+                                                          AND day BETWEEN :start_date AND :end_date) """ + where_clause),
+                           {'start_date': DEFAULT_START_DATE, 'end_date': DEFAULT_END_DATE})
+
+    def refresh_all(self):
+        db.session.execute(text("""TRUNCATE daily_temperature_rollups, monthly_temperature_rollups,
+                                            temperature_rollup_dirty_days, temperature_rollup_locations"""))
+        db.session.execute(text(ROLLUP_INSERT_SQL + ROLLUP_SELECT_SQL + " WHERE TRUE " + ROLLUP_GROUP_BY_SQL))
+        db.session.execute(text(MONTHLY_ROLLUP_INSERT_SQL + MONTHLY_ROLLUP_GROUP_BY_SQL))
+        db.session.execute(text("""INSERT INTO temperature_rollup_locations (location_name)
+                                   SELECT name FROM locations"""))
+
+    def refresh_dirty_days(self):
+        # Days marked dirty while the refresh runs stay in the queue for the next refresh.
+        db.session.execute(text("""CREATE TEMPORARY TABLE claimed_dirty_days (location_name TEXT, day DATE)
+                                   ON COMMIT DROP"""))
+        db.session.execute(text("""WITH claimed AS (DELETE FROM temperature_rollup_dirty_days
+                                                    RETURNING location_name, day)
+                                   INSERT INTO claimed_dirty_days SELECT location_name, day FROM claimed"""))
+        db.session.execute(text("""DELETE FROM daily_temperature_rollups
+                                    USING claimed_dirty_days
+                                   WHERE daily_temperature_rollups.location_name = claimed_dirty_days.location_name
+                                     AND daily_temperature_rollups.day = claimed_dirty_days.day"""))
+        db.session.execute(text(ROLLUP_INSERT_SQL + ROLLUP_SELECT_SQL + """
+                                     INNER JOIN claimed_dirty_days
+                                             ON claimed_dirty_days.location_name = locations.name
+                                            AND claimed_dirty_days.day = """ + DAY_EXPRESSION + """
+                                WHERE TRUE """ + ROLLUP_GROUP_BY_SQL))
+        # The months of the dirty days are merged again from their days.
+        claimed_months = """(SELECT DISTINCT location_name, DATE_TRUNC('month', day)::date AS month
+                               FROM claimed_dirty_days) claimed_months"""
+        db.session.execute(text("""DELETE FROM monthly_temperature_rollups
+                                    USING """ + claimed_months + """
+                                   WHERE monthly_temperature_rollups.location_name = claimed_months.location_name
+                                     AND monthly_temperature_rollups.month = claimed_months.month"""))
+        db.session.execute(text(MONTHLY_ROLLUP_INSERT_SQL + """
+                                     INNER JOIN """ + claimed_months + """
+                                             ON claimed_months.location_name = daily_temperature_rollups.location_name
+                                            AND claimed_months.month = DATE_TRUNC('month', daily_temperature_rollups.day)::date
+                                """ + MONTHLY_ROLLUP_GROUP_BY_SQL))
+        results = db.session.execute(text("SELECT DISTINCT location_name FROM claimed_dirty_days"))
+        return set(record[0] for record in results)
+
+    def refresh_stale_locations(self):
+        # Locations that were added, moved or deleted since the last refresh are rebuilt completely.
+        results = db.session.execute(text("""SELECT name FROM locations
+                                             WHERE name NOT IN (SELECT location_name FROM temperature_rollup_locations)"""))
+        locations = set(record[0] for record in results)
+        for table in ['daily_temperature_rollups', 'monthly_temperature_rollups']:
+            db.session.execute(text("""DELETE FROM """ + table + """
+                                       WHERE location_name NOT IN (SELECT location_name FROM temperature_rollup_locations)
+                                          OR location_name NOT IN (SELECT name FROM locations)"""))
+        db.session.execute(text("""DELETE FROM temperature_rollup_locations
+                                   WHERE location_name NOT IN (SELECT name FROM locations)"""))
+        db.session.execute(text(ROLLUP_INSERT_SQL + ROLLUP_SELECT_SQL + """
+                                WHERE locations.name NOT IN (SELECT location_name FROM temperature_rollup_locations)
+                                """ + ROLLUP_GROUP_BY_SQL))
+        db.session.execute(text(MONTHLY_ROLLUP_INSERT_SQL + """
+                                WHERE daily_temperature_rollups.location_name NOT IN (SELECT location_name FROM temperature_rollup_locations)
+                                """ + MONTHLY_ROLLUP_GROUP_BY_SQL))
+        db.session.execute(text("""INSERT INTO temperature_rollup_locations (location_name)
+                                   SELECT name FROM locations
+                                   ON CONFLICT (location_name) DO UPDATE SET refreshed_at = now()"""))
+        return locations
+
+    def invalidate_location(self, location):
+        # The location falls back to the raw observations until the next refresh rebuilds it.
+        if self.is_installed():
+            db.session.execute(text("DELETE FROM temperature_rollup_locations WHERE location_name = :location"),
+                               {'location': location})
+            db.session.commit()
+
+    def invalidate_locations(self, locations):
+        if self.is_installed():
+            db.session.execute(text("DELETE FROM temperature_rollup_locations WHERE location_name = ANY(:locations)"),
+                               {'locations': list(locations)})
+            db.session.commit()
+
+    def is_installed(self):
+        if not current_app.config['TEMPERATURE_ROLLUP_ENABLED']:
+            return False
+        if not self.installed and time.time() - self.installed_checked_at > 60:
+            self.installed_checked_at = time.time()
+            results = db.session.execute(text("SELECT to_regclass('monthly_temperature_rollups') IS NOT NULL AS installed"))
+            self.installed = results.scalar()
+        return self.installed
+
+    def get_fresh_locations(self, locations):
+        """
+        :return: The locations whose rollups are complete and can be read instead of the raw observations
+        """
+        if not self.is_installed() or not locations:
+            return []
+        results = db.session.execute(text("""SELECT location_name FROM temperature_rollup_locations
+                                              WHERE location_name = ANY(:locations)
+                                                AND NOT EXISTS (SELECT 1 FROM temperature_rollup_dirty_days
+                                                                 WHERE temperature_rollup_dirty_days.location_name
+                                                                       = temperature_rollup_locations.location_name)"""),
+                                     {'locations': list(locations)})
+        fresh = set(record[0] for record in results)
+        return [location for location in locations if location in fresh]
+
+    def get_row_count(self, location):
+        # None when the location is not fresh and the count has to come from the raw observations.
+        if not self.is_installed():
+            return None
+        results = db.session.execute(text("""SELECT row_count FROM temperature_rollup_locations
+                                              WHERE location_name = :location
+                                                AND NOT EXISTS (SELECT 1 FROM temperature_rollup_dirty_days
+                                                                 WHERE location_name = :location)"""),
+                                     {'location': location})
+        return results.scalar()
+
+    def get_temperatures_query(self, locations, resolution='daily'):
+        """
+        Statement of the mean temperature per depth and time bucket of the locations. The fresh locations
+        are read from the rollup and the others from the raw observations, in one statement.
+        :param resolution: One of RESOLUTIONS, hourly always reads the raw observations
+        :return: (statement, parameters), the caller adds :start_date and :end_date
+        """
+        fresh_locations = self.get_fresh_locations(locations) if resolution != 'hourly' else []
+        raw_locations = [location for location in locations if location not in fresh_locations]
+        sql_statement = self.build_temperatures_sql(resolution, bool(fresh_locations),
+                                                    bool(raw_locations) or not fresh_locations)
+        return sql_statement, {'rollup_locations': fresh_locations, 'raw_locations': raw_locations}
+
+    def build_temperatures_sql(self, resolution, rollup, raw):
+        unit = RESOLUTIONS[resolution]
+        branches = []
+        if rollup:
+            if resolution == 'daily':
+                branches.append(DAILY_TEMPERATURES_ROLLUP_SQL)
+            else:
+                branches.append(MERGED_TEMPERATURES_ROLLUP_SQL.format(unit=unit))
+        if raw:
+            branches.append(TEMPERATURES_RAW_SQL.format(unit=unit))
+        return ' UNION ALL '.join(branches)
+
+    def get_temperatures_statements(self):
+        # Every statement get_temperatures_query can return, to register them once.
+        for resolution in RESOLUTIONS:
+            for rollup, raw in BRANCH_COMBINATIONS:
+                if resolution != 'hourly' or not rollup:
+                    yield self.build_temperatures_sql(resolution, rollup, raw)
+
+    def get_thermal_regime_query(self, locations, start_date, end_date, by_year=False):
+        """
+        Statement of the max, min, mean and count per location and depth (and per year) of the observations
+        between start_date and end_date, both included. On a fresh location the whole months come from the monthly
+        partials, the whole days of the first and last months from the daily rollup, and only the partial
+        days at both ends are read from the raw observations.
+        :param start_date: ISO 8601 date or timestamp, UTC when without offset
+        :param end_date: ISO 8601 date or timestamp, UTC when without offset
+        :param by_year: One row per year and depth instead of one row per depth
+        :return: (statement, parameters), None when a date cannot be parsed
+        """
+        if not start_date or not end_date:
+            # Nothing is between a missing date and any other.
+            start = end = None
+        else:
+            start = parse_timestamp(start_date)
+            end = parse_timestamp(end_date)
+            if start == None or end == None:
+                return None
+        params = {'start_date': start, 'end_date': end}
+        fresh_locations = []
+        if start != None:
+            # Whole UTC days of the range.
+            first_day = start.date() if start.time() == datetime.min.time() else start.date() + timedelta(days=1)
+            last_day = end.date() - timedelta(days=1)
+            if first_day <= last_day:
+                fresh_locations = self.get_fresh_locations(locations)
+        raw_locations = [location for location in locations if location not in fresh_locations]
+        params.update({'rollup_locations': fresh_locations, 'raw_locations': raw_locations})
+        if fresh_locations:
+            # Whole months of the whole days, the end is excluded.
+            first_month = first_day if first_day.day == 1 else next_month(first_day)
+            end_month = date(last_day.year, last_day.month, 1)
+            if last_day + timedelta(days=1) == next_month(end_month):
+                end_month = next_month(end_month)
+            if first_month >= end_month:
+                first_month = end_month = last_day + timedelta(days=1)
+            params.update({
+                'first_day': first_day,
+                'last_day': last_day,
+                'first_month': first_month,
+                'end_month': end_month,
+                'first_instant': datetime.combine(first_day, datetime.min.time(), timezone.utc),
+                'after_last_instant': datetime.combine(last_day + timedelta(days=1), datetime.min.time(), timezone.utc)
+            })
+        sql_statement = self.build_thermal_regime_sql(bool(fresh_locations), bool(raw_locations) or not fresh_locations,
+                                                      by_year)
+        return sql_statement, params
+
+    def build_thermal_regime_sql(self, rollup, raw, by_year):
+        branches = []
+        if rollup:
+            branches.extend([
+                THERMAL_REGIME_RAW_PARTIALS_SQL.format(
+                    locations='rollup_locations',
+                    time_range="""observations.corrected_utc_time >= :start_date
+                                  AND observations.corrected_utc_time < :first_instant"""),
+                THERMAL_REGIME_RAW_PARTIALS_SQL.format(
+                    locations='rollup_locations',
+                    time_range="""observations.corrected_utc_time >= :after_last_instant
+                                  AND observations.corrected_utc_time <= :end_date"""),
+                THERMAL_REGIME_DAILY_PARTIALS_SQL,
+                THERMAL_REGIME_MONTHLY_PARTIALS_SQL
+            ])
+        if raw:
+            branches.append(THERMAL_REGIME_RAW_PARTIALS_SQL.format(
+                locations='raw_locations',
+                time_range="observations.corrected_utc_time BETWEEN :start_date AND :end_date"))
+        partials = ' UNION ALL '.join(branches)
+        year_column = ' year,' if by_year else ''
+        year_order = ' year ASC,' if by_year else ''
+        return THERMAL_REGIME_SQL.format(year_column=year_column, year_order=year_order, partials=partials)
+
+    def get_thermal_regime_statements(self, by_year):
+        # Every statement get_thermal_regime_query can return, to register them once.
+        for rollup, raw in BRANCH_COMBINATIONS:
+            yield self.build_thermal_regime_sql(rollup, raw, by_year)
@@ -0,0 +1,177 @@
+#
+# Validation of OIDC bearer tokens.
+# Signed JWTs are verified locally against the identity provider signing keys (JWKS),
+# tokens already validated are cached until they expire and introspection is only
+# used for opaque tokens or tokens that cannot be verified locally.
+# @version 1.0
+#
+
+import json
+import time
+import base64
+import hashlib
+import threading
+import requests
+import rsa
+from flask import current_app, g
+from permafrost_observations_api.extensions import oidc
+from permafrost_observations_api.cache.ttl_lru_cache import TtlLruCache
+
+class TokenValidationProvider:
+    def __init__(self):
+        self.cache = None
+        self.signing_keys = {}
+        self.signing_keys_fetched_at = 0
+        self.jwks_uri = None
+        self.lock = threading.Lock()
+        self.local_validations = 0
+        self.introspections = 0
+
+    def get_cache(self):
+        if self.cache == None:
+            with self.lock:
+                if self.cache == None:
+                    self.cache = TtlLruCache(max_size=current_app.config['OIDC_TOKEN_CACHE_SIZE'],
+                                             ttl=current_app.config['OIDC_TOKEN_CACHE_DEFAULT_TTL'])
+        return self.cache
+
+    def validate_token(self, token):
+        cache_key = hashlib.sha256(token.encode('utf-8')).hexdigest()
+        cache = self.get_cache()
+        token_info = cache.get(cache_key)
+        if token_info != None:
+            g.oidc_token_info = token_info
+            return True
+
+        token_info = None
+        if current_app.config['OIDC_LOCAL_JWT_VALIDATION']:
+            try:
+                token_info = self.verify_jwt(token)
+            except InvalidTokenError:
+                return False
+            except UnverifiableTokenError:
+                token_info = None
+        if token_info != None:
+            self.local_validations += 1
+        else:
+            self.introspections += 1
+            if not oidc.validate_token(token):
+                return False
+            token_info = getattr(g, 'oidc_token_info', None) or {}
+
+        expires_at = token_info.get('exp')
+        if expires_at != None:
+            cache.set(cache_key, token_info, expires_at=float(expires_at))
+        else:
+            cache.set(cache_key, token_info)
+        g.oidc_token_info = token_info
+        return True
+
+    def verify_jwt(self, token):
+        fragments = token.split('.')
+        if len(fragments) != 3:
+            raise UnverifiableTokenError('Token is not a JWT')
+        try:
+            header = json.loads(self.base64url_decode(fragments[0]))
+            claims = json.loads(self.base64url_decode(fragments[1]))
+            signature = self.base64url_decode(fragments[2])
+        except ValueError:
+            raise UnverifiableTokenError('Token is not a JWT')
+        if not isinstance(header, dict) or not isinstance(claims, dict):
+            raise UnverifiableTokenError('Token is not a JWT')
+        if header.get('alg') != 'RS256':
+            raise UnverifiableTokenError('Unsupported signing algorithm')
+
+        public_key = self.get_signing_key(header.get('kid'))
+        signing_input = (fragments[0] + '.' + fragments[1]).encode('ascii')
+        try:
+            hash_method = rsa.verify(signing_input, signature, public_key)
+        except rsa.VerificationError:
+            raise InvalidTokenError('Token signature is not valid')
+        if hash_method != 'SHA-256':
+            raise InvalidTokenError('Token signature is not valid')
+
+        self.verify_claims(claims)
+        claims['active'] = True
+        return claims
+
+    def verify_claims(self, claims):
+        now = time.time()
+        leeway = current_app.config['OIDC_TOKEN_CLOCK_SKEW']
+        if 'exp' not in claims or float(claims['exp']) + leeway < now:
+            raise InvalidTokenError('Token has expired')
+        if 'nbf' in claims and float(claims['nbf']) - leeway > now:
+            raise InvalidTokenError('Token is not valid yet')
+        issuer = oidc.client_secrets.get('issuer')
+        if issuer and claims.get('iss') != issuer:
+            raise InvalidTokenError('Token issuer is not valid')
+        if 'aud' in claims and current_app.config['OIDC_RESOURCE_CHECK_AUD']:
+            audience = claims['aud'] if isinstance(claims['aud'], list) else [claims['aud']]
+            if oidc.client_secrets['client_id'] not in audience:
+                raise InvalidTokenError('Token audience is not valid')
+
+    def get_signing_key(self, kid):
+        max_age = current_app.config['OIDC_JWKS_CACHE_SECONDS']
+        public_key = self.signing_keys.get(kid)
+        if public_key != None and time.time() - self.signing_keys_fetched_at < max_age:
+            return public_key
+        # Unknown key ids trigger a refresh so that key rotations are picked up,
+        # but the identity provider is not hit more than once per minimum interval.
+        self.refresh_signing_keys()
+        public_key = self.signing_keys.get(kid)
+        if public_key == None:
+            raise UnverifiableTokenError('Unknown signing key')
+        return public_key
+
+    def refresh_signing_keys(self):
+        with self.lock:
+            if time.time() - self.signing_keys_fetched_at < current_app.config['OIDC_JWKS_MIN_REFRESH_SECONDS']:
+                return
+            self.signing_keys_fetched_at = time.time()
+            try:
+                response = requests.get(self.get_jwks_uri(), timeout=5)
+                response.raise_for_status()
+                keys = response.json().get('keys', [])
+            except (requests.RequestException, ValueError, KeyError):
+                return
+            signing_keys = {}
+            for key in keys:
+                if key.get('kty') != 'RSA' or key.get('use', 'sig') != 'sig':
+                    continue
+                modulus = int.from_bytes(self.base64url_decode(key['n']), 'big')
+                exponent = int.from_bytes(self.base64url_decode(key['e']), 'big')
+                signing_keys[key.get('kid')] = rsa.PublicKey(modulus, exponent)
+            self.signing_keys = signing_keys
+
+    def get_jwks_uri(self):
+        if self.jwks_uri == None:
+            jwks_uri = oidc.client_secrets.get('jwks_uri')
+            if not jwks_uri:
+                issuer = oidc.client_secrets.get('issuer')
+                if not issuer:
+                    raise KeyError('issuer')
+                issuer = issuer.rstrip('/')
+                response = requests.get(issuer + '/.well-known/openid-configuration', timeout=5)
+                response.raise_for_status()
+                jwks_uri = response.json()['jwks_uri']
+            self.jwks_uri = jwks_uri
+        return self.jwks_uri
+
+    def base64url_decode(self, value):
+        value = value + '=' * (-len(value) % 4)
+        try:
+            return base64.urlsafe_b64decode(value.encode('ascii'))
+        except (TypeError, UnicodeEncodeError, base64.binascii.Error):
+            raise ValueError('Invalid base64url value')
+
+    def stats(self):
+        stats = self.get_cache().stats()
+        stats['local_validations'] = self.local_validations
+        stats['introspections'] = self.introspections
+        return stats
+
+class InvalidTokenError(Exception):
+    pass
+
+class UnverifiableTokenError(Exception):
+    pass
@@ -0,0 +1,115 @@
+#
+# Streamed ZIP archives built from several CSV exports running in parallel.
+# @version 1.0
+#
+
+import queue
+import threading
+import collections
+from zipfile import ZipFile, ZIP_DEFLATED
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+
+# Chunks of an export waiting to be written to the archive, a worker waits when its queue is full.
+QUEUE_SIZE = 8
+QUEUE_PUT_TIMEOUT = 0.5
+
+# Marker of the end of an export in its queue.
+END = object()
+
+class ZipStream:
+    # Write only file object, ZipFile falls back to data descriptors because it is not seekable.
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+class ZipExportProvider:
+    def stream_zip(self, entries, max_workers=None, progress=None):
+        """
+        Yields the bytes of a ZIP archive as soon as they are produced.
+        :param entries: List of (archive name, iterable of CSV chunks) tuples, the chunks are
+                        produced by a worker thread with its own database connection
+        :param max_workers: Maximum number of exports running at the same time
+        :param progress: Optional function called with the archive name of each entry written
+        """
+        if max_workers == None:
+            max_workers = current_app.config['EXPORT_MAX_CONCURRENT_QUERIES']
+        app = current_app._get_current_object()
+        entries = iter(entries)
+        stream = ZipStream()
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        # Set when the archive is closed, e.g. the client went away, so the workers stop waiting.
+        stopped = threading.Event()
+        pending = collections.deque()
+        try:
+            with ZipFile(stream, 'w', ZIP_DEFLATED) as zip_file:
+                # The entries are written one after the other while the next ones are exported, at most
+                # QUEUE_SIZE chunks of each are held in memory.
+                for arcname, chunks in entries:
+                    pending.append((arcname, self.submit_entry(executor, app, chunks, stopped)))
+                    if len(pending) >= max_workers:
+                        break
+                while pending:
+                    arcname, chunk_queue = pending.popleft()
+                    with zip_file.open(arcname, 'w') as entry:
+                        while True:
+                            chunk = chunk_queue.get()
+                            if chunk is END:
+                                break
+                            if isinstance(chunk, Exception):
+                                raise chunk
+                            entry.write(chunk)
+                            yield stream.drain()
+                    for next_arcname, next_chunks in entries:
+                        pending.append((next_arcname, self.submit_entry(executor, app, next_chunks, stopped)))
+                        break
+                    if progress != None:
+                        progress(arcname)
+                    yield stream.drain()
+            yield stream.drain()
+        finally:
+            stopped.set()
+            executor.shutdown(wait=False)
+
+    def submit_entry(self, executor, app, chunks, stopped):
+        chunk_queue = queue.Queue(maxsize=QUEUE_SIZE)
+        executor.submit(self.render_entry, app, chunks, chunk_queue, stopped)
+        return chunk_queue
+
+    def render_entry(self, app, chunks, chunk_queue, stopped):
+        with app.app_context():
+            try:
+                for chunk in chunks:
+                    if not self.put_chunk(chunk_queue, chunk.encode('utf-8'), stopped):
+                        return
+                item = END
+            except Exception as error:
+                item = error
+            finally:
+                # Releases the database connection of an export left unfinished.
+                if hasattr(chunks, 'close'):
+                    chunks.close()
+            self.put_chunk(chunk_queue, item, stopped)
+
+    def put_chunk(self, chunk_queue, item, stopped):
+        """
+        :return: False when the archive was closed before the item could be queued
+        """
+        while not stopped.is_set():
+            try:
+                chunk_queue.put(item, timeout=QUEUE_PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                pass
+        return False
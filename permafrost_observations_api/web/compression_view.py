@@ -0,0 +1,13 @@
+#
+# Compression of the responses of the blueprint routes.
+# Imported before the metrics view: the after request functions run in reverse order, so the metrics count
+# the bytes of the bodies before compression, all read before a streamed response tears the request down.
+# @version 1.0
+#
+
+from permafrost_observations_api.web.common_view import permafrost_observations_bp
+from permafrost_observations_api.providers.response_compression import response_compression
+
+@permafrost_observations_bp.after_request
+def compress_response(response):
+    return response_compression.compress_response(response)
@@ -0,0 +1,50 @@
+#
+# Diagnostics view.
+# @version 1.0
+#
+
+from flask import jsonify, request
+from permafrost_observations_api.web.common_view import permafrost_observations_bp
+from permafrost_observations_api.decorators.crossorigin import crossdomain
+from permafrost_observations_api.decorators.authorization import authorization, token_validator
+from permafrost_observations_api.cache.response_cache import response_cache
+from permafrost_observations_api.providers.query_registry import query_registry
+from permafrost_observations_api.providers.slow_query_log import slow_query_log
+from permafrost_observations_api.providers.export_job_provider import export_job_provider
+from permafrost_observations_api.providers.raw_sql_provider import RawSqlProvider
+
+provider = RawSqlProvider()
+
+@permafrost_observations_bp.route("/diagnostics/token_cache")
+@crossdomain(origin='*')
+@authorization
+def get_token_cache_stats():
+    return jsonify(token_validator.stats())
+
+@permafrost_observations_bp.route("/diagnostics/response_cache")
+@crossdomain(origin='*')
+@authorization
+def get_response_cache_stats():
+    return jsonify(response_cache.stats())
+
+@permafrost_observations_bp.route("/diagnostics/queries")
+@crossdomain(origin='*')
+@authorization
+def get_query_stats():
+    return jsonify(query_registry.stats())
+
+@permafrost_observations_bp.route("/diagnostics/exports")
+@crossdomain(origin='*')
+@authorization
+def get_export_stats():
+    return jsonify(export_job_provider.stats())
+
+@permafrost_observations_bp.route("/diagnostics/slow_queries")
+@crossdomain(origin='*')
+@authorization
+def get_slow_queries():
+    """
+    Slow statements with their parameters and plans, the most recent first.
+    Optional arguments: name of the statement, limit
+    """
+    return jsonify(slow_query_log.stats(request.args.get('name'), provider.get_non_negative_int_arg('limit')))
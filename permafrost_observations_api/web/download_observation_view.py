@@ -4,17 +4,57 @@
 # @author Sergiu Buhatel <sergiu.buhatel@carleton.ca>
 #
 
-from flask import request, jsonify, abort,render_template,request,redirect,url_for, json, Response, send_file
-from werkzeug import secure_filename
-import os
+from flask import request, jsonify, abort,render_template,request,redirect,url_for, json, Response, send_file, stream_with_context, \
+    current_app
+from werkzeug.utils import secure_filename
 from permafrost_observations_api.web.common_view import permafrost_observations_bp
 from permafrost_observations_api.decorators.crossorigin import crossdomain
 from permafrost_observations_api.decorators.authorization import authorization
 from permafrost_observations_api.providers.raw_sql_provider import RawSqlProvider
-from zipfile import ZipFile
-from uuid import uuid4
+from permafrost_observations_api.providers.temperature_rollup_provider import TemperatureRollupProvider
+from permafrost_observations_api.providers.query_registry import query_registry, PAGINATION_SQL
+from permafrost_observations_api.providers.zip_export_provider import ZipExportProvider
+from permafrost_observations_api.providers.export_job_provider import export_job_provider, ExportJobError, EXPORT_TYPES
+from permafrost_observations_api.providers.response_compression import response_compression, COMPRESSIBLE_MIMETYPES
+from permafrost_observations_api.cache.export_cache import export_cache
 
 provider = RawSqlProvider()
+rollup_provider = TemperatureRollupProvider()
+zip_provider = ZipExportProvider()
+
+# Every variant of the statements of the downloads is registered at import.
+for sql_statement in rollup_provider.get_temperatures_statements():
+    query_registry.register('ground_temperatures_csv', provider.order_time_temperatures(sql_statement) + PAGINATION_SQL)
+for sql_statement in rollup_provider.get_thermal_regime_statements(False):
+    query_registry.register('ground_thermal_regime_csv', sql_statement + PAGINATION_SQL)
+
+def attachment_response(chunks, filename, mimetype='text/plain'):
+    # The chunks are sent to the client while the rows are still being read from the database.
+    response = Response(stream_with_context(chunks), mimetype=mimetype)
+    response.headers['Content-Disposition'] = 'attachment; filename=' + secure_filename(filename)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def artifact_response(path, filename, mimetype):
+    # Finished export from the export cache, sent by waitress from the file or its compressed copy.
+    encoding = response_compression.negotiate() if mimetype in COMPRESSIBLE_MIMETYPES else None
+    compressed_path = export_cache.get_compressed(path, encoding) if encoding != None else None
+    response = send_file(compressed_path if compressed_path != None else path, mimetype=mimetype, as_attachment=True,
+                         attachment_filename=secure_filename(filename), conditional=True)
+    if compressed_path != None:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def error_response(message, status):
+    return Response(json.dumps({"error": message}), status, mimetype="application/json")
+
+def export_status(job):
+    status = job.to_dict()
+    status['status_url'] = url_for('permafrost_observations_api.get_export', job_id=job.id)
+    if job.status == 'done':
+        status['download_url'] = url_for('permafrost_observations_api.download_export', job_id=job.id)
+    return status
 
 @permafrost_observations_bp.route("/download_observation_time_temperature", methods=['GET'])
 @crossdomain(origin='*')
@@ -22,13 +62,11 @@ provider = RawSqlProvider()
 def download_observation_time_temperature():
     location = request.args.get('location')
     if location:
-        folder = 'download_observation_time_temperature'
-        if not os.path.exists(folder):
-            os.makedirs(folder)
-        fullpath = os.path.join(folder, location + '.txt')
-        provider.write_observation_time_temperature_into_file(fullpath, location)
-        print(fullpath)
-        return send_file(fullpath, as_attachment=True, cache_timeout=-1)
+        options = provider.get_export_options()
+        path = export_job_provider.get_cached('time_temperature', [location])
+        if path != None:
+            return artifact_response(path, location + '.txt', 'text/plain')
+        return attachment_response(provider.stream_observation_time_temperature_csv(location, options), location + '.txt')
     return Response(json.dumps([]), 404, mimetype="application/json")
 
 @permafrost_observations_bp.route("/download_observations_time_temperature", methods=['POST'])
@@ -41,20 +79,17 @@ def download_observation_time_temperatures():
         for observation in observations:
             if not isinstance(observation, str):
                 return Response(json.dumps(observations), 400, mimetype="application/json")
-        # If checks pass create the folder if it doesn't exist.
+        # Each location is exported by a worker with its own database connection and the
+        # archive is streamed to the client as the exports complete.
+        locations = list(dict.fromkeys(observations))
+        options = provider.get_export_options()
+        path = export_job_provider.get_cached('time_temperature', locations) if len(locations) > 1 else None
+        if path != None:
+            return artifact_response(path, 'observations.zip', 'application/zip')
         folder = 'download_observation_time_temperature'
-        if not os.path.exists(folder):
-            os.makedirs(folder)
-        # Generate a zip file path name dynamically.
-        zip_path = os.path.join(folder, str(uuid4()) + '.zip')
-        # Create the zip file and append all the observations into it.
-        with ZipFile(zip_path, 'w') as newzip:
-            for observation in observations:
-                observation_file_path = os.path.join(folder, observation + '.txt')
-                provider.write_observation_time_temperature_into_file(observation_file_path, observation)
-                newzip.write(observation_file_path)
-        # Send the zip file that got created back to the client.
-        return send_file(zip_path, attachment_filename='observations.zip', as_attachment=True, cache_timeout=-1)
+        entries = [(folder + '/' + observation + '.txt', provider.stream_observation_time_temperature_csv(observation, options))
+                   for observation in locations]
+        return attachment_response(zip_provider.stream_zip(entries), 'observations.zip', mimetype='application/zip')
     return Response(json.dumps(observations), 404, mimetype="application/json")
 
 @permafrost_observations_bp.route("/download_observation_temperature_height", methods=['GET'])
@@ -62,13 +97,70 @@ def download_observation_time_temperatures():
 @authorization
 def download_observation_temperature_height():
     location = request.args.get('location')
-    start_date = request.args.get('start_date')
-    end_date = request.args.get('end_date')
     if location:
-        folder = 'download_observation_temperature_height'
-        if not os.path.exists(folder):
-            os.makedirs(folder)
-        fullpath = os.path.join(folder, location + '.txt')
-        provider.write_observation_temperature_height_into_file(fullpath, location, start_date, end_date)
-        return send_file(fullpath, as_attachment=True, cache_timeout=-1)
+        options = provider.get_export_options()
+        path = export_job_provider.get_cached('temperature_height', [location])
+        if path != None:
+            return artifact_response(path, location + '.txt', 'text/plain')
+        return attachment_response(provider.stream_observation_temperature_height_csv(location, options), location + '.txt')
     return Response(json.dumps([]), 404, mimetype="application/json")
+
+@permafrost_observations_bp.route("/exports", methods=['POST'])
+@crossdomain(origin='*')
+@authorization
+def submit_export():
+    """
+    Runs an export in the background and answers its job at once, 200 when the export was cached, 202 otherwise.
+    The locations are location arguments or a JSON array in the body, a ZIP archive is built for several.
+    The type (time_temperature or temperature_height) and the other arguments are those of the downloads.
+    """
+    export_type = request.args.get('type', 'time_temperature')
+    if export_type not in EXPORT_TYPES:
+        provider.abort_bad_request("type must be one of " + ", ".join(sorted(EXPORT_TYPES)))
+    locations = request.args.getlist('location')
+    body = request.get_json(silent=True)
+    if isinstance(body, list):
+        locations = locations + body
+    if not all(isinstance(location, str) for location in locations):
+        provider.abort_bad_request("locations must be strings")
+    locations = list(dict.fromkeys(location for location in locations if location))
+    if not locations:
+        provider.abort_bad_request("at least one location is required")
+    max_locations = current_app.config['EXPORT_JOB_MAX_LOCATIONS']
+    if len(locations) > max_locations:
+        provider.abort_bad_request("at most " + str(max_locations) + " locations can be exported at once")
+    try:
+        job = export_job_provider.submit(export_type, locations)
+    except ExportJobError as error:
+        response = error_response(str(error), 503)
+        response.headers['Retry-After'] = '30'
+        return response
+    response = jsonify(export_status(job))
+    response.status_code = 200 if job.status == 'done' else 202
+    response.headers['Location'] = url_for('permafrost_observations_api.get_export', job_id=job.id)
+    return response
+
+@permafrost_observations_bp.route("/exports/<job_id>", methods=['GET'])
+@crossdomain(origin='*')
+@authorization
+def get_export(job_id):
+    job = export_job_provider.get_job(job_id)
+    if job == None:
+        return error_response("unknown export " + job_id, 404)
+    return jsonify(export_status(job))
+
+@permafrost_observations_bp.route("/exports/<job_id>/download", methods=['GET'])
+@crossdomain(origin='*')
+@authorization
+def download_export(job_id):
+    job = export_job_provider.get_job(job_id)
+    if job == None:
+        return error_response("unknown export " + job_id, 404)
+    if job.status == 'failed':
+        return error_response("the export failed: " + str(job.error), 409)
+    if job.status != 'done':
+        return error_response("the export is " + job.status, 409)
+    try:
+        return artifact_response(job.path, job.get_filename(), job.get_mimetype())
+    except FileNotFoundError:
+        return error_response("the export was evicted from the export cache, submit it again", 410)
@@ -4,15 +4,133 @@
 # @author Sergiu Buhatel <sergiu.buhatel@carleton.ca>
 #
 
-import math
-from decimal import *
-from flask import json, jsonify, Response, blueprints, request
+from flask import json, jsonify, Response, blueprints, request, current_app
 from permafrost_observations_api.web.common_view import permafrost_observations_bp
 from permafrost_observations_api.decorators.crossorigin import crossdomain
 from permafrost_observations_api.decorators.authorization import authorization
+from permafrost_observations_api.decorators.cached_response import cached_response
+from permafrost_observations_api.decorators.conditional_response import conditional_response
+from permafrost_observations_api.cache.response_cache import response_cache
+from permafrost_observations_api.cache.location_catalog import location_catalog
 from permafrost_observations_api.providers.raw_sql_provider import RawSqlProvider
+from permafrost_observations_api.providers.temperature_rollup_provider import TemperatureRollupProvider
+from permafrost_observations_api.providers.downsampling_provider import DownsamplingProvider
+from permafrost_observations_api.providers.marker_cluster_provider import MarkerClusterProvider
+from permafrost_observations_api.providers.location_import_provider import LocationImportProvider, LocationImportError
+from permafrost_observations_api.providers.location_summary_provider import LocationSummaryProvider
+from permafrost_observations_api.providers.observation_ingest_provider import ObservationIngestProvider
+from permafrost_observations_api.providers.row_serializer import RowSerializer
+from permafrost_observations_api.providers.query_registry import query_registry, PAGINATION_SQL
 
 provider = RawSqlProvider()
+rollup_provider = TemperatureRollupProvider()
+downsampling_provider = DownsamplingProvider()
+marker_cluster_provider = MarkerClusterProvider()
+import_provider = LocationImportProvider()
+summary_provider = LocationSummaryProvider()
+ingest_provider = ObservationIngestProvider()
+
+# Sort keys identifying a row uniquely, used to build the keyset pagination cursors.
+# The ground temperatures are grouped by these keys in every branch of their statement. The observations
+# of a location name (unique, see locations_name_unique) are told apart by their id.
+GROUND_TEMPERATURES_ORDER_BY = [('loc_name', 'ASC'), ('height', 'DESC'), ('time', 'ASC')]
+OBSERVATIONS_RANGE_ORDER_BY = [('label', 'ASC'), ('ffrom', 'DESC'), ('tto', 'DESC'), ('observation_id', 'ASC')]
+
+# Statements compiled once and prepared on each pooled connection, see query_registry.
+LOCATIONS_OF_OBSERVATIONS_QUERY = query_registry.register('locations_of_observations', """
+    SELECT name,
+           ST_X(coordinates) AS lon,
+           ST_Y(coordinates) AS lat,
+           elevation_in_metres,
+           comment,
+           record_observations,
+           accuracy_in_metres,
+           'Carleton Internal' as provider
+      FROM LOCATIONS
+     WHERE name LIKE :name_pattern AND ST_GeometryType(coordinates)=:geometry_type
+     ORDER BY name ASC""" + PAGINATION_SQL)
+INSERT_LOCATION_QUERY = query_registry.register('insert_location', """
+    INSERT into locations (name, coordinates, accuracy_in_metres, comment, record_observations, elevation_in_metres)
+    VALUES(:name, ST_SetSRID(ST_MakePoint(:lng, :lat), 4326),
+           :accuracy_in_metres, :comment, :record_observations, :elevation_in_metres)""")
+UPDATE_LOCATION_QUERY = query_registry.register('update_location', """
+    UPDATE locations
+       SET coordinates = ST_SetSRID(ST_MakePoint(:lng, :lat), 4326),
+           accuracy_in_metres = :accuracy_in_metres,
+           comment = :comment,
+           record_observations = :record_observations,
+           elevation_in_metres = :elevation_in_metres
+     WHERE name = :name""")
+DELETE_LOCATION_QUERY = query_registry.register('delete_location', """
+    DELETE FROM locations
+     WHERE name = :name""")
+
+LOCATIONS_OF_OBSERVATIONS_COUNT_SQL = """SELECT name
+                       FROM LOCATIONS
+                       WHERE name LIKE :name_pattern AND ST_GeometryType(coordinates)=:geometry_type"""
+
+OBSERVATIONS_RANGE_SQL = """SELECT name, label,
+                                height_max_metres as ffrom,
+                                height_min_metres as tto,
+                                numeric_value,
+                                text_value{observation_id}
+                           FROM observations
+                                JOIN locations
+                                  ON ST_Intersects(observations.location, locations.coordinates)
+                                INNER JOIN sensors
+                                  ON sensors.id = observations.sensor_id
+                          WHERE locations.name = :location"""
+
+# Column plans of the JSON responses: (output key, source column, encoder).
+LOCATIONS_SERIALIZER = RowSerializer([
+    ('name', 'name', 'string'),
+    ('text', 'name', 'string'),
+    ('lat', 'lat', 'float'),
+    ('lon', 'lon', 'float'),
+    ('lng', 'lon', 'float'),
+    ('elevation_in_metres', 'elevation_in_metres', 'float'),
+    ('comment', 'comment', 'string'),
+    ('record_observations', 'record_observations', 'value'),
+    ('accuracy_in_metres', 'accuracy_in_metres', 'float'),
+    ('provider', 'provider', 'string')
+])
+GROUND_TEMPERATURES_SERIALIZER = RowSerializer([
+    ('loc_name', 'loc_name', 'string'),
+    ('height', 'height', 'float'),
+    ('agg_avg', 'agg_avg', 'float'),
+    ('time', 'time', 'http_date')
+])
+HEIGHT_SERIALIZER = RowSerializer([
+    ('height', 'height', 'float')
+])
+GROUND_THERMAL_REGIME_SERIALIZER = RowSerializer([
+    ('loc_name', 'loc_name', 'string'),
+    ('height', 'height', 'float'),
+    ('max', 'max', 'float'),
+    ('min', 'min', 'float'),
+    ('average_value', 'average_value', 'float'),
+    ('cnt', 'cnt', 'float')
+])
+GROUND_THERMAL_REGIME_BY_YEAR_SERIALIZER = RowSerializer([
+    ('loc_name', 'loc_name', 'string'),
+    ('year', 'year', 'int'),
+    ('height', 'height', 'float'),
+    ('max', 'max', 'float'),
+    ('min', 'min', 'float'),
+    ('average_value', 'average_value', 'float'),
+    ('cnt', 'cnt', 'float')
+])
+OBSERVATIONS_RANGE_SERIALIZER = RowSerializer([
+    ('name', 'name', 'string'),
+    ('label', 'label', 'string'),
+    ('from', 'ffrom', 'float'),
+    ('to', 'tto', 'float'),
+    ('numeric_value', 'numeric_value', 'float_or_empty_string'),
+    ('text_value', 'text_value', 'string')
+])
+CATEGORIES_SERIALIZER = RowSerializer([
+    ('label', 'label', 'string')
+])
 
 def get_name_pattern():
     name_pattern = request.args.get('name_pattern')
@@ -21,76 +139,174 @@ def get_name_pattern():
     name_pattern = name_pattern if name_pattern else '%'
     return name_pattern
 
+def count_locations_of_observations(geometry_type, name_pattern):
+    if location_catalog.is_enabled():
+        return len(location_catalog.search(name_pattern, geometry_type))
+    return provider.count_records(LOCATIONS_OF_OBSERVATIONS_COUNT_SQL,
+                                  { 'geometry_type': geometry_type, 'name_pattern': name_pattern },
+                                  'locations_of_observations')
+
+def serialize_locations_of_observations(query, params):
+    # Served from the location catalog, the statement is only run when the catalog is disabled.
+    if location_catalog.is_enabled():
+        rows = location_catalog.search(params['name_pattern'], params['geometry_type'])
+        return serialize_location_rows(apply_limit_and_offset_to_rows(rows))
+    return provider.execute_sql_and_serialize(query, params, LOCATIONS_SERIALIZER)
+
+def apply_limit_and_offset_to_rows(rows):
+    offset = provider.get_non_negative_int_arg('offset')
+    limit = provider.get_non_negative_int_arg('limit')
+    if offset != None:
+        rows = rows[offset:]
+    if limit != None:
+        rows = rows[:limit]
+    return rows
+
+def get_markers_in_bbox(geometry_type, name_pattern):
+    # Without zoom: the markers of the bounding box. With zoom: clusters and markers of the map tiles
+    # covering the bounding box (the whole world when it is missing), individual markers from MARKER_CLUSTER_MAX_ZOOM.
+    bbox = (-180.0, -90.0, 180.0, 90.0)
+    if request.args.get('bbox') != None:
+        bbox = marker_cluster_provider.parse_bbox(request.args.get('bbox'))
+        if bbox == None:
+            provider.abort_bad_request("bbox must be west,south,east,north in degrees")
+    zoom = provider.get_non_negative_int_arg('zoom')
+    if zoom != None and zoom > 30:
+        provider.abort_bad_request("zoom must be at most 30")
+    if zoom == None or zoom >= current_app.config['MARKER_CLUSTER_MAX_ZOOM']:
+        markers = marker_cluster_provider.get_markers(bbox, name_pattern, geometry_type)
+        if zoom == None:
+            return provider.serialized_response(serialize_location_rows(apply_limit_and_offset_to_rows(markers)))
+        clusters = []
+    else:
+        if marker_cluster_provider.count_tiles(bbox, zoom) > current_app.config['MARKER_CLUSTER_MAX_TILES']:
+            provider.abort_bad_request("bbox covers too many tiles at this zoom")
+        clusters, markers = marker_cluster_provider.get_clusters(bbox, zoom, name_pattern, geometry_type)
+    body = '{"clusters":' + json.dumps(clusters) + ',"markers":' + serialize_location_rows(markers).body + '}'
+    return Response(body, mimetype="application/json")
+
+def serialize_location_rows(rows):
+    return provider.serialize(location_catalog.get_results(rows), LOCATIONS_SERIALIZER)
+
+def count_ground_temperatures(location):
+    sql_statement, params, full_daily_series = provider.get_ground_temperatures_query([location])
+    count = None
+    if full_daily_series and not provider.is_approximate_count():
+        count = rollup_provider.get_row_count(location)
+    if count == None:
+        count = provider.count_records(sql_statement, params, 'ground_temperatures')
+    return count
+
+def get_max_points():
+    max_points = provider.get_non_negative_int_arg('max_points')
+    if max_points == None:
+        return None
+    if max_points < 3:
+        provider.abort_bad_request("max_points must be at least 3")
+    # The whole series is downsampled, a page of it would not be.
+    for name in ['limit', 'offset', 'cursor']:
+        if request.args.get(name) != None:
+            provider.abort_bad_request("max_points cannot be combined with " + name)
+    return max_points
+
+def order_ground_temperatures(sql_statement):
+    return sql_statement + provider.get_order_by_clause(GROUND_TEMPERATURES_ORDER_BY)
+
+def get_observations_range_sql(category, keyed):
+    sql_statement = OBSERVATIONS_RANGE_SQL.format(observation_id=', observations.id AS observation_id' if keyed else '')
+    if category is not None:
+        sql_statement = sql_statement + """ AND sensors.label = :category"""
+
+    return sql_statement + """ AND sensors.label IN ('geo_class_1', 'ice_visual_perc',
+                                                 'ice_description', 'geo_description')"""
+
+def get_observations_range_order_by(keyed):
+    # Without the observation ids (make_rollup.py not run) the rows are paginated by offset only.
+    return OBSERVATIONS_RANGE_ORDER_BY if keyed else OBSERVATIONS_RANGE_ORDER_BY[:-1]
+
+# Every variant of the statements of the views is registered at import, the statements built per request
+# (keyset pages) only take the room left in the registry. The statements of the batches are also streamed.
+query_registry.register('locations_of_observations_count', provider.apply_count(LOCATIONS_OF_OBSERVATIONS_COUNT_SQL))
+for sql_statement in rollup_provider.get_temperatures_statements():
+    query_registry.register('ground_temperatures', order_ground_temperatures(sql_statement) + PAGINATION_SQL)
+    query_registry.register('ground_temperatures_count', provider.apply_count(sql_statement))
+    query_registry.register('ground_temperatures_batch', order_ground_temperatures(sql_statement))
+for by_year in (False, True):
+    for sql_statement in rollup_provider.get_thermal_regime_statements(by_year):
+        query_registry.register('ground_thermal_regime', sql_statement + PAGINATION_SQL)
+        query_registry.register('ground_thermal_regime_batch', sql_statement)
+for sql_statement in summary_provider.get_heights_statements():
+    query_registry.register('ground_temperature_heights', sql_statement + PAGINATION_SQL)
+for sql_statement in summary_provider.get_categories_statements():
+    query_registry.register('observations_categories', sql_statement + PAGINATION_SQL)
+for category in (None, ''):
+    for keyed in (False, True):
+        query_registry.register('observations_range', get_observations_range_sql(category, keyed) +
+                                provider.get_order_by_clause(get_observations_range_order_by(keyed)) + PAGINATION_SQL)
+
+def downsample_ground_temperatures_results(results, max_points):
+    # Each depth of each location is reduced to max_points.
+    return downsampling_provider.downsample(results, max_points, ['loc_name', 'height'], 'time', 'agg_avg')
+
+def downsample_ground_temperatures(sql_statement, params, max_points):
+    # The series is streamed ordered by depth and time, one depth is held in memory at a time.
+    connection, results = provider.execute_sql_streamed(order_ground_temperatures(sql_statement), params,
+                                                        name='ground_temperatures_downsampled')
+    try:
+        results = downsample_ground_temperatures_results(results, max_points)
+        return provider.serialize(results, GROUND_TEMPERATURES_SERIALIZER, provider.get_serialization_format())
+    finally:
+        connection.close()
+
 @permafrost_observations_bp.route("/locations_of_observations")
 @crossdomain(origin='*')
 @authorization
+@conditional_response
+@cached_response
 def get_locations_of_observations():
     geometry_type = request.args.get('geometry_type')
     geometry_type = geometry_type if geometry_type else 'ST_Point'
     name_pattern = get_name_pattern()
 
-    sql_statement = """SELECT name, 
-                              ST_X(coordinates) AS lon, 
-                              ST_Y(coordinates) AS lat,
-                              elevation_in_metres,
-                              comment,
-                              record_observations,
-                              accuracy_in_metres,
-                              'Carleton Internal' as provider
-                       FROM LOCATIONS
-                       WHERE name LIKE :name_pattern AND ST_GeometryType(coordinates)=:geometry_type
-                       ORDER BY name ASC"""
-    sql_statement = provider.apply_limit_and_offset(sql_statement)
+    params = { 'geometry_type': geometry_type, 'name_pattern': name_pattern }
+    provider.bind_limit_and_offset(params)
 
-    records = provider.execute_sql_and_fetch_records(sql_statement, { 'geometry_type': geometry_type, 'name_pattern': name_pattern })
-    return provider.jsonify_records(records)
+    rows = serialize_locations_of_observations(LOCATIONS_OF_OBSERVATIONS_QUERY, params)
+    return provider.set_total_items(provider.serialized_response(rows),
+                                    lambda: count_locations_of_observations(geometry_type, name_pattern))
 
 @permafrost_observations_bp.route("/locations_of_observations_as_markers")
 @crossdomain(origin='*')
 @authorization
+@conditional_response
+@cached_response
 def get_locations_of_observations_as_markers():
     geometry_type = request.args.get('geometry_type')
     geometry_type = geometry_type if geometry_type else 'ST_Point'
     name_pattern = get_name_pattern()
 
-    sql_statement = """SELECT name, 
-                              ST_X(coordinates) AS lon, 
-                              ST_Y(coordinates) AS lat,
-                              elevation_in_metres,
-                              comment,
-                              record_observations,
-                              accuracy_in_metres,
-                              'Carleton Internal' as provider
-                       FROM LOCATIONS
-                       WHERE name LIKE :name_pattern AND ST_GeometryType(coordinates)=:geometry_type
-                       ORDER BY name ASC"""
-    sql_statement = provider.apply_limit_and_offset(sql_statement)
+    if request.args.get('bbox') != None or request.args.get('zoom') != None:
+        return get_markers_in_bbox(geometry_type, name_pattern)
+
+    params = { 'geometry_type': geometry_type, 'name_pattern': name_pattern }
+    provider.bind_limit_and_offset(params)
 
-    records = provider.execute_sql_and_fetch_records(sql_statement, { 'geometry_type': geometry_type, 'name_pattern': name_pattern })
-    return provider.jsonify_records(records)
+    rows = serialize_locations_of_observations(LOCATIONS_OF_OBSERVATIONS_QUERY, params)
+    return provider.set_total_items(provider.serialized_response(rows),
+                                    lambda: count_locations_of_observations(geometry_type, name_pattern))
 
 @permafrost_observations_bp.route("/locations_of_observations/count")
 @crossdomain(origin='*')
 @authorization
+@conditional_response
+@cached_response
 def get_locations_of_observations_count():
     geometry_type = request.args.get('geometry_type')
     geometry_type = geometry_type if geometry_type else 'ST_Point'
     name_pattern = get_name_pattern()
 
-    sql_statement = """SELECT name, ST_X(coordinates) AS lon, ST_Y(coordinates) AS lat
-                       FROM LOCATIONS
-                       WHERE name LIKE :name_pattern AND ST_GeometryType(coordinates)=:geometry_type
-                       ORDER BY name ASC"""
-    sql_statement = provider.apply_limit_and_offset(sql_statement)
-    sql_statement = provider.apply_count(sql_statement)
-
-    records = provider.execute_sql_and_fetch_records(sql_statement, { 'geometry_type': geometry_type, 'name_pattern': name_pattern })
-    array = []
-    for record in records:
-        item = {}
-        item["count"] = record.count
-        array.append(item)
-    return jsonify(array)
+    count = count_locations_of_observations(geometry_type, name_pattern)
+    return provider.jsonify_count(provider.apply_limit_and_offset_to_count(count))
 
 @permafrost_observations_bp.route("/locations_of_observations_as_markers", methods=['POST'])
 @crossdomain(origin='*')
@@ -106,10 +322,6 @@ def add_locations_of_observations():
     elevation_in_metres = data.get('elevation_in_metres')
     record_observations = data.get('record_observations')
 
-    sql_statement = """INSERT into locations (name, coordinates, accuracy_in_metres, comment, record_observations,
-                                              elevation_in_metres) 
-                       VALUES(:name, ST_SetSRID(ST_MakePoint(:lng, :lat), 4326), 
-                              :accuracy_in_metres, :comment, :record_observations, :elevation_in_metres)"""
     params = {
         'name': name,
         'lat': lat,
@@ -119,7 +331,9 @@ def add_locations_of_observations():
         'accuracy_in_metres': accuracy_in_metres,
         'elevation_in_metres': elevation_in_metres
     }
-    records = provider.execute_sql(sql_statement, params)
+    records = provider.execute_sql(INSERT_LOCATION_QUERY, params)
+    location_catalog.refresh_location(name)
+    response_cache.invalidate_location(name)
     return jsonify([])
 
 @permafrost_observations_bp.route("/locations_of_observations_as_markers", methods=['PUT'])
@@ -136,13 +350,6 @@ def update_locations_of_observations():
     elevation_in_metres = data.get('elevation_in_metres')
     record_observations = data.get('record_observations')
 
-    sql_statement = """UPDATE locations 
-                       SET coordinates = ST_SetSRID(ST_MakePoint(:lng, :lat), 4326),
-                           accuracy_in_metres = :accuracy_in_metres,
-                           comment = :comment,
-                           record_observations = :record_observations,
-                           elevation_in_metres = :elevation_in_metres
-                       WHERE name = :name"""
     params = {
         'name': name,
         'lat': lat,
@@ -152,7 +359,11 @@ def update_locations_of_observations():
         'accuracy_in_metres': accuracy_in_metres,
         'elevation_in_metres': elevation_in_metres
     }
-    records = provider.execute_sql(sql_statement, params)
+    records = provider.execute_sql(UPDATE_LOCATION_QUERY, params)
+    rollup_provider.invalidate_location(name)
+    summary_provider.invalidate_location(name)
+    location_catalog.refresh_location(name)
+    response_cache.invalidate_location(name)
     return jsonify([])
 
 @permafrost_observations_bp.route("/locations_of_observations_as_markers", methods=['DELETE'])
@@ -163,201 +374,172 @@ def delete_locations_of_observations():
     data = request.get_json()
     name = data.get('text')
 
-    sql_statement = """DELETE FROM locations
-                       WHERE name = :name"""
     params = {
         'name': name
     }
-    records = provider.execute_sql(sql_statement, params)
+    records = provider.execute_sql(DELETE_LOCATION_QUERY, params)
+    rollup_provider.invalidate_location(name)
+    summary_provider.invalidate_location(name)
+    location_catalog.refresh_location(name)
+    response_cache.invalidate_location(name)
     return jsonify([])
 
+@permafrost_observations_bp.route("/locations_of_observations_as_markers/bulk", methods=['POST'])
+@crossdomain(origin='*')
+@authorization
+def upsert_locations_of_observations():
+    # Insert or update many locations, the body is a JSON array, a CSV file or NDJSON lines of markers.
+    if not import_provider.is_installed():
+        error = {
+            "error": "the unique index on the location names is missing, run make_rollup.py"
+        }
+        return Response(json.dumps(error), 503, mimetype="application/json")
+    try:
+        summary = import_provider.upsert(import_provider.read_rows(request.stream, request.mimetype))
+    except LocationImportError as error:
+        provider.abort_bad_request(str(error))
+    names = summary.pop('names')
+    if names:
+        rollup_provider.invalidate_locations(names)
+        summary_provider.invalidate_locations(names)
+        location_catalog.reload()
+        response_cache.invalidate_locations(names)
+    return jsonify(summary)
+
 @permafrost_observations_bp.route("/ground_temperatures")
 @crossdomain(origin='*')
 @authorization
+@conditional_response
+@cached_response
 def get_ground_temperatures():
     location = request.args.get('location')
 
-    sql_statement = """SELECT locations.name AS loc_name, 
-                            observations.height_min_metres AS height, 
-                            AVG(observations.numeric_value) as agg_avg, 
-                            COUNT(observations.numeric_value) as agg_cnt, 
-                            TO_TIMESTAMP(FLOOR(EXTRACT('epoch' FROM observations.corrected_utc_time) / 86400) * 86400) AT TIME ZONE 'UTC' AS time 
-                       FROM observations 
-                            INNER JOIN locations ON observations.location = locations.coordinates 
-                       WHERE observations.corrected_utc_time BETWEEN '1950-01-01 00:00:00+00' AND '2050-01-01 00:00:00+00' 
-                            AND locations.name = :location 
-                            AND observations.unit_of_measure = 'C' 
-                            GROUP BY observations.height_min_metres, locations.name, time 
-                            ORDER BY loc_name ASC, height DESC """
-    sql_statement = provider.apply_limit_and_offset(sql_statement)
-
-    records = provider.execute_sql_and_fetch_records(sql_statement, { 'location': location })
-    array = []
-    for record in records:
-        item = {}
-        item["loc_name"] = record.loc_name
-        item["height"] = float(record.height)
-        item["agg_avg"] = float(record.agg_avg)
-        item["time"] = record.time
-        array.append(item)
-    return jsonify(array)
+    sql_statement, params, full_daily_series = provider.get_ground_temperatures_query([location])
+    max_points = get_max_points()
+    if max_points != None:
+        rows = downsample_ground_temperatures(sql_statement, params, max_points)
+    else:
+        sql_statement = provider.apply_keyset_pagination(sql_statement, params, GROUND_TEMPERATURES_ORDER_BY)
+        rows = provider.execute_sql_and_serialize(sql_statement, params, GROUND_TEMPERATURES_SERIALIZER,
+                                                 provider.get_serialization_format(), 'ground_temperatures')
+    response = provider.set_next_cursor(provider.serialized_response(rows), rows, GROUND_TEMPERATURES_ORDER_BY)
+    return provider.set_total_items(response, lambda: count_ground_temperatures(location))
+
+@permafrost_observations_bp.route("/ground_temperatures/batch")
+@crossdomain(origin='*')
+@authorization
+@conditional_response
+@cached_response
+def get_ground_temperatures_batch():
+    locations = provider.get_locations_arg()
+
+    sql_statement, params, full_daily_series = provider.get_ground_temperatures_query(locations)
+    max_points = get_max_points()
+    transform = None
+    if max_points != None:
+        transform = lambda results: downsample_ground_temperatures_results(results, max_points)
+    return provider.grouped_response(order_ground_temperatures(sql_statement), params,
+                                     GROUND_TEMPERATURES_SERIALIZER, locations, transform, 'ground_temperatures_batch')
 
 @permafrost_observations_bp.route("/ground_temperatures/count")
 @crossdomain(origin='*')
 @authorization
+@conditional_response
+@cached_response
 def get_ground_temperatures_count():
     location = request.args.get('location')
 
-    sql_statement = """SELECT locations.name AS loc_name, 
-                            observations.height_min_metres AS height, 
-                            AVG(observations.numeric_value) as agg_avg, 
-                            COUNT(observations.numeric_value) as agg_cnt, 
-                            TO_TIMESTAMP(FLOOR(EXTRACT('epoch' FROM observations.corrected_utc_time) / 86400) * 86400) AT TIME ZONE 'UTC' AS time 
-                       FROM observations 
-                            INNER JOIN locations ON observations.location = locations.coordinates 
-                       WHERE observations.corrected_utc_time BETWEEN '1950-01-01 00:00:00+00' AND '2050-01-01 00:00:00+00' 
-                            AND locations.name = :location 
-                            AND observations.unit_of_measure = 'C' 
-                            GROUP BY observations.height_min_metres, locations.name, time 
-                            ORDER BY loc_name ASC, height DESC """
-    sql_statement = provider.apply_limit_and_offset(sql_statement)
-    sql_statement = provider.apply_count(sql_statement)
-
-    records = provider.execute_sql_and_fetch_records(sql_statement, { 'location': location })
-    array = []
-    for record in records:
-        item = {}
-        item["count"] = record.count
-        array.append(item)
-    return jsonify(array)
+    count = count_ground_temperatures(location)
+    return provider.jsonify_count(provider.apply_limit_and_offset_to_count(count))
 
 @permafrost_observations_bp.route("/ground_temperatures/height")
 @crossdomain(origin='*')
 @authorization
+@conditional_response
+@cached_response
 def get_ground_temperature_height():
     location = request.args.get('location')
 
-    sql_statement = """SELECT DISTINCT observations.height_min_metres AS height 
-                       FROM observations 
-                            INNER JOIN locations ON observations.location = locations.coordinates 
-                       WHERE observations.corrected_utc_time BETWEEN '1950-01-01 00:00:00+00' AND '2050-01-01 00:00:00+00' 
-                            AND locations.name = :location 
-                            AND observations.unit_of_measure = 'C' 
-                            GROUP BY observations.height_min_metres, locations.name, observations.corrected_utc_time"""
-    sql_statement = provider.apply_limit_and_offset(sql_statement)
-
-    records = provider.execute_sql_and_fetch_records(sql_statement, { 'location': location })
-    array = []
-    for record in records:
-        item = {}
-        item["height"] = float(record.height)
-        array.append(item)
-    return jsonify(array)
+    sql_statement, params = summary_provider.get_heights_query(location, '1950-01-01 00:00:00+00',
+                                                               '2050-01-01 00:00:00+00')
+    sql_statement = provider.apply_limit_and_offset(sql_statement, params)
+
+    rows = provider.execute_sql_and_serialize(sql_statement, params, HEIGHT_SERIALIZER, name='ground_temperature_heights')
+    return provider.serialized_response(rows)
 
 @permafrost_observations_bp.route("/ground_thermal_regime")
 @crossdomain(origin='*')
 @authorization
+@conditional_response
+@cached_response
 def get_ground_thermal_regime():
     location = request.args.get('location')
-    start_date = request.args.get('start_date')
-    end_date = request.args.get('end_date')
-
-    sql_statement = """SELECT locations.name AS loc_name, observations.
-                                height_min_metres AS height, 
-                                MAX(observations.numeric_value) AS max, 
-                                MIN(observations.numeric_value) AS min, 
-                                AVG(observations.numeric_value) as average_value, 
-                                COUNT(observations.numeric_value) as cnt 
-                          FROM observations 
-                               INNER JOIN locations ON observations.location = locations.coordinates 
-                         WHERE observations.corrected_utc_time BETWEEN :start_date 
-                           AND :end_date 
-                           AND locations.name = :location 
-                           AND observations.unit_of_measure = 'C' 
-                        GROUP BY observations.height_min_metres, locations.name 
-                        ORDER BY loc_name ASC, height DESC; """
-    sql_statement = provider.apply_limit_and_offset(sql_statement)
-
-    records = provider.execute_sql_and_fetch_records(sql_statement, {
-                                                                        'location': location,
-                                                                        'start_date': start_date,
-                                                                        'end_date': end_date
-                                                                    })
-    array = []
-    for record in records:
-        item = {}
-        item["loc_name"] = record.loc_name
-        item["height"] = float(record.height)
-        item["max"] = float(record.max)
-        item["min"] = float(record.min)
-        item["average_value"] = float(record.average_value)
-        item["cnt"] = float(record.cnt)
-        array.append(item)
-    return jsonify(array)
+    # One envelope per year of the range instead of one for the whole range.
+    by_year = request.args.get('multi_year', '').lower() in ('1', 'true', 'yes')
+
+    sql_statement, params = provider.get_thermal_regime_query([location], by_year)
+    sql_statement = provider.apply_limit_and_offset(sql_statement, params)
+
+    serializer = GROUND_THERMAL_REGIME_BY_YEAR_SERIALIZER if by_year else GROUND_THERMAL_REGIME_SERIALIZER
+    rows = provider.execute_sql_and_serialize(sql_statement, params, serializer,
+                                             provider.get_serialization_format(), 'ground_thermal_regime')
+    return provider.serialized_response(rows)
+
+@permafrost_observations_bp.route("/ground_thermal_regime/batch")
+@crossdomain(origin='*')
+@authorization
+@conditional_response
+@cached_response
+def get_ground_thermal_regime_batch():
+    locations = provider.get_locations_arg()
+    by_year = request.args.get('multi_year', '').lower() in ('1', 'true', 'yes')
+
+    sql_statement, params = provider.get_thermal_regime_query(locations, by_year)
+    serializer = GROUND_THERMAL_REGIME_BY_YEAR_SERIALIZER if by_year else GROUND_THERMAL_REGIME_SERIALIZER
+    return provider.grouped_response(sql_statement, params, serializer, locations, name='ground_thermal_regime_batch')
 
 @permafrost_observations_bp.route("/observations/range")
 @crossdomain(origin='*')
 @authorization
+@conditional_response
+@cached_response
 def get_observations_range():
     location = request.args.get('location')
     category = request.args.get('category')
 
-    sql_statement = """SELECT name, label,
-                                height_max_metres as ffrom,
-                                height_min_metres as tto,
-                                numeric_value,
-                                text_value
-                           FROM observations
-                                JOIN locations
-                                  ON ST_Intersects(observations.location, locations.coordinates)
-                                INNER JOIN sensors
-                                  ON sensors.id = observations.sensor_id
-                          WHERE locations.name = :location"""
+    params = { 'location': location, 'category': category }
+    keyed = ingest_provider.has_observation_ids()
+    if not keyed and request.args.get('cursor') != None:
+        provider.abort_bad_request("cursor pagination of the observations needs the ids installed by make_rollup.py")
+    sql_statement = get_observations_range_sql(category, keyed)
+    order_by = get_observations_range_order_by(keyed)
+    sql_statement = provider.apply_keyset_pagination(sql_statement, params, order_by)
 
-    if category is not None:
-        sql_statement = sql_statement + """ AND sensors.label = :category"""
+    rows = provider.execute_sql_and_serialize(sql_statement, params, OBSERVATIONS_RANGE_SERIALIZER,
+                                             provider.get_serialization_format(), 'observations_range')
+    response = provider.serialized_response(rows)
+    return provider.set_next_cursor(response, rows, order_by) if keyed else response
+
+@permafrost_observations_bp.route("/locations_of_observations/summary")
+@crossdomain(origin='*')
+@authorization
+@conditional_response
+@cached_response
+def get_location_of_observations_summary():
+    location = request.args.get('location')
 
-    sql_statement = sql_statement + """ AND sensors.label IN ('geo_class_1', 'ice_visual_perc',
-                                                 'ice_description', 'geo_description')
-                       ORDER BY label ASC, ffrom DESC"""
-
-    sql_statement = provider.apply_limit_and_offset(sql_statement)
-
-    records = provider.execute_sql_and_fetch_records(sql_statement, { 'location': location, 'category': category })
-    array = []
-    for record in records:
-        item = {}
-        item["name"] = record.name
-        item["label"] = record.label
-        item["from"] = float(record.ffrom)
-        item["to"] = float(record.tto)
-        item["numeric_value"] = float(record.numeric_value) if not math.isnan(float(record.numeric_value)) else ""
-        item["text_value"] = record.text_value
-        array.append(item)
-    return jsonify(array)
+    return jsonify(summary_provider.get_summary(location))
 
 @permafrost_observations_bp.route("/observations/categories")
 @crossdomain(origin='*')
 @authorization
+@conditional_response
+@cached_response
 def get_observations_categories():
     location = request.args.get('location')
 
-    sql_statement = """SELECT DISTINCT label
-                           FROM observations
-                                JOIN locations
-                                  ON ST_Intersects(observations.location, locations.coordinates)
-                                INNER JOIN sensors
-                                  ON sensors.id = observations.sensor_id
-                          WHERE locations.name = :location
-                            AND sensors.label IN ('geo_class_1', 'ice_visual_perc',
-                                                 'ice_description', 'geo_description')"""
-
-    sql_statement = provider.apply_limit_and_offset(sql_statement)
+    sql_statement, params = summary_provider.get_categories_query(location)
+    sql_statement = provider.apply_limit_and_offset(sql_statement, params)
 
-    records = provider.execute_sql_and_fetch_records(sql_statement, { 'location': location })
-    array = []
-    for record in records:
-        item = {}
-        item["label"] = record.label
-        array.append(item)
-    return jsonify(array)
+    rows = provider.execute_sql_and_serialize(sql_statement, params, CATEGORIES_SERIALIZER, name='observations_categories')
+    return provider.serialized_response(rows)
@@ -0,0 +1,28 @@
+#
+# Request metrics of the blueprint routes and their Prometheus scrape endpoint.
+# @version 1.0
+#
+
+from flask import Response
+from permafrost_observations_api.web.common_view import permafrost_observations_bp
+from permafrost_observations_api.decorators.crossorigin import crossdomain
+from permafrost_observations_api.decorators.authorization import authorization
+from permafrost_observations_api.providers.request_metrics import request_metrics, CONTENT_TYPE
+
+@permafrost_observations_bp.before_request
+def start_request_metrics():
+    request_metrics.start_request()
+
+@permafrost_observations_bp.after_request
+def finish_response_metrics(response):
+    return request_metrics.finish_response(response)
+
+@permafrost_observations_bp.teardown_request
+def finish_request_metrics(error=None):
+    request_metrics.finish_request()
+
+@permafrost_observations_bp.route("/metrics")
+@crossdomain(origin='*')
+@authorization
+def get_metrics():
+    return Response(request_metrics.render(), content_type=CONTENT_TYPE)
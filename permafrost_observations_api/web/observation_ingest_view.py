@@ -0,0 +1,31 @@
+#
+# Observation ingest view.
+# @version 1.0
+#
+
+from flask import request, jsonify
+from permafrost_observations_api.web.common_view import permafrost_observations_bp
+from permafrost_observations_api.decorators.crossorigin import crossdomain
+from permafrost_observations_api.decorators.authorization import authorization
+from permafrost_observations_api.cache.response_cache import response_cache
+from permafrost_observations_api.providers.raw_sql_provider import RawSqlProvider
+from permafrost_observations_api.providers.observation_ingest_provider import ObservationIngestProvider, \
+    ObservationIngestError
+
+provider = RawSqlProvider()
+ingest_provider = ObservationIngestProvider()
+
+@permafrost_observations_bp.route("/observations/ingest", methods=['POST'])
+@crossdomain(origin='*')
+@authorization
+def ingest_observations():
+    # The body is a CSV file (text/csv) or NDJSON lines, unit_of_measure is the unit of the rows without one.
+    rows = ingest_provider.read_rows(request.stream, request.mimetype)
+    try:
+        summary = ingest_provider.ingest(rows, request.args.get('unit_of_measure'))
+    except ObservationIngestError as error:
+        provider.abort_bad_request(str(error))
+    locations = [item['location'] for item in summary['locations'] if item['location'] != None]
+    if locations:
+        response_cache.invalidate_observations(locations)
+    return jsonify(summary)
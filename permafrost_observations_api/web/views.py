@@ -11,6 +11,10 @@ from permafrost_observations_api.decorators.crossorigin import crossdomain
 from permafrost_observations_api.decorators.authorization import authorization
 import permafrost_observations_api.web.location_of_observations_view
 import permafrost_observations_api.web.download_observation_view
+import permafrost_observations_api.web.diagnostics_view
+import permafrost_observations_api.web.observation_ingest_view
+import permafrost_observations_api.web.compression_view
+import permafrost_observations_api.web.metrics_view
 
 @permafrost_observations_bp.route("/", methods=['GET'])
 @crossdomain(origin='*')
@@ -0,0 +1,16 @@
+#
+# Fixtures of the unit tests, a bare application without database nor OpenID Connect.
+# @version 1.0
+#
+
+import pytest
+from flask import Flask
+
+@pytest.fixture
+def app():
+    app = Flask('permafrost_observations_api')
+    app.config.update(
+        SERIALIZER_FETCH_BATCH_SIZE=2,
+        EXPORT_FETCH_BATCH_SIZE=2
+    )
+    return app
@@ -0,0 +1,70 @@
+#
+# Bucket boundaries, gaps and null values of the min/max downsampling.
+# @version 1.0
+#
+
+import numpy
+from datetime import datetime, timedelta
+from permafrost_observations_api.providers.downsampling_provider import DownsamplingProvider
+
+provider = DownsamplingProvider()
+
+class FakeResults:
+    def __init__(self, rows):
+        self.rows = list(rows)
+
+    def fetchmany(self, size):
+        rows = self.rows[:size]
+        del self.rows[:size]
+        return rows
+
+def select(times, values, max_points):
+    values = [numpy.nan if value == None else value for value in values]
+    kept, gaps = provider.select_points(numpy.array(times, dtype=numpy.float64),
+                                        numpy.array(values, dtype=numpy.float64), max_points)
+    return kept.tolist(), gaps
+
+def test_short_series_is_kept():
+    assert select([0, 1, 2], [5, 4, 3], 3) == ([0, 1, 2], [])
+
+def test_bucket_boundaries():
+    # 3 buckets over [0, 9]: [0, 3), [3, 6) and [6, 9]. The time 3 starts the second bucket,
+    # the time 9 falls in the last bucket instead of starting a fourth one.
+    times = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9]
+    values = [0, 9, 1, 4, 5, 6, 2, 8, 3, 1]
+    assert select(times, values, 9) == ([0, 1, 3, 5, 7, 9], [])
+
+def test_equal_values_keep_first_and_last():
+    times = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9]
+    values = [7, 7, 7, 7, 7, 7, 7, 7, 7, 7]
+    assert select(times, values, 3) == ([0, 9], [])
+
+def test_empty_bucket_is_a_gap():
+    times = [0, 0.5, 1, 1.5, 2, 2.5, 6, 7, 8, 9]
+    values = [3, 1, 9, 1, 5, 4, 2, 6, 5, 3]
+    kept, gaps = select(times, values, 9)
+    # Nothing in [3, 6), the gap is between the last point before it and the first point after it.
+    assert kept == [1, 2, 6, 7]
+    assert gaps == [(5, 6)]
+
+def test_null_values_are_left_out():
+    times = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9]
+    values = [1, 2, 3, None, None, None, 7, 8, 9, 10]
+    # The middle bucket only holds nulls, the line breaks between its neighbours.
+    assert select(times, values, 9) == ([0, 2, 6, 9], [(2, 6)])
+
+def test_only_null_values():
+    assert select([0, 1, 2, 3], [None, None, None, None], 3) == ([], [])
+
+def test_constant_time():
+    assert select([5, 5, 5, 5], [3, 1, 4, 2], 3) == ([1, 2], [])
+
+def test_downsample_rows_marks_gaps(app):
+    start = datetime(2020, 1, 1)
+    rows = [('LOC1', start + timedelta(days=day), float(day) if day not in (3, 4, 5) else None) for day in range(10)]
+    rows.append(('LOC2', start, 1.0))
+    with app.app_context():
+        downsampled = list(provider.downsample_rows(FakeResults(rows), ['loc', 'time', 'value'], 9, ['loc'],
+                                                    'time', 'value'))
+    gap = ('LOC1', start + timedelta(days=4), None)
+    assert downsampled == [rows[0], rows[2], gap, rows[6], rows[9], rows[10]]
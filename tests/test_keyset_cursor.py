@@ -0,0 +1,77 @@
+#
+# Keyset pagination cursors with null and tied sort keys.
+# @version 1.0
+#
+
+import pytest
+from collections import namedtuple
+from datetime import datetime
+from werkzeug.exceptions import HTTPException
+from permafrost_observations_api.providers.raw_sql_provider import RawSqlProvider
+
+provider = RawSqlProvider()
+
+ORDER_BY = [('label', 'ASC'), ('ffrom', 'DESC'), ('tto', 'DESC'), ('observation_id', 'ASC')]
+
+Row = namedtuple('Row', ['label', 'ffrom', 'tto', 'observation_id', 'text_value'])
+
+def round_trip(row):
+    return provider.decode_cursor(provider.encode_cursor(row, ORDER_BY), len(ORDER_BY))
+
+def test_round_trip(app):
+    with app.app_context():
+        assert round_trip(Row('geo_class_1', 3.0, 2.5, 100026, 'clay')) == ['geo_class_1', '3.0', '2.5', '100026']
+        assert round_trip(Row('temp', datetime(2020, 1, 2, 3, 4), 0, 1, None)) == \
+            ['temp', '2020-01-02T03:04:00', '0', '1']
+
+def test_round_trip_null_keys(app):
+    with app.app_context():
+        assert round_trip(Row('geo_class_1', None, 0.5, 7, None)) == ['geo_class_1', None, '0.5', '7']
+        assert round_trip(Row(None, None, None, 8, None)) == [None, None, None, '8']
+
+def test_tied_keys_differ_on_last_key(app):
+    with app.app_context():
+        first = round_trip(Row('geo_class_1', 3.0, 2.5, 1, 'clay'))
+        second = round_trip(Row('geo_class_1', 3.0, 2.5, 2, 'silt'))
+    assert first[:3] == second[:3]
+    assert first[3] != second[3]
+
+@pytest.mark.parametrize('cursor', ['not base64!', 'bnVsbA==', 'WzEsIDIsIDMsIDRd', 'WyJhIl0='])
+def test_invalid_cursor(app, cursor):
+    with app.app_context():
+        with pytest.raises(HTTPException) as error:
+            provider.decode_cursor(cursor, len(ORDER_BY))
+    assert error.value.response.status_code == 400
+
+def test_keyset_predicates():
+    assert provider.get_keyset_predicate('ffrom', 'DESC', '3.0', 1, False) == 'ffrom = :keyset_1'
+    assert provider.get_keyset_predicate('ffrom', 'DESC', None, 1, False) == 'ffrom IS NULL'
+    assert provider.get_keyset_predicate('ffrom', 'DESC', '3.0', 1, True) == 'ffrom < :keyset_1'
+    # NULL sorts first in descending order, every value follows it.
+    assert provider.get_keyset_predicate('ffrom', 'DESC', None, 1, True) == 'ffrom IS NOT NULL'
+    # NULL sorts last in ascending order, it follows every value and nothing follows it.
+    assert provider.get_keyset_predicate('tto', 'ASC', '2.5', 2, True) == '(tto > :keyset_2 OR tto IS NULL)'
+    assert provider.get_keyset_predicate('tto', 'ASC', None, 2, True) == None
+
+def test_keyset_pagination_with_null_keys(app):
+    order_by = [('label', 'ASC'), ('ffrom', 'DESC'), ('tto', 'ASC'), ('observation_id', 'ASC')]
+    with app.app_context():
+        cursor = provider.encode_cursor(Row('temp', None, None, 5, None), order_by)
+        with app.test_request_context(query_string={'cursor': cursor, 'limit': '2'}):
+            params = {}
+            sql_statement = provider.apply_keyset_pagination('SELECT * FROM t', params, order_by)
+    # No row follows the cursor on tto (NULL in ascending order), that branch is left out.
+    assert sql_statement.count('UNION ALL') == 2
+    assert 'tto > :keyset_2' not in sql_statement
+    assert 'observation_id > :keyset_3' in sql_statement
+    assert 'ffrom IS NOT NULL' in sql_statement
+    assert "label > :keyset_0" in sql_statement
+    # Null keys are matched with IS NULL, only the values are bound.
+    assert params == {'keyset_0': 'temp', 'keyset_3': '5', 'limit': 2}
+
+def test_keyset_pagination_without_cursor(app):
+    with app.test_request_context(query_string={'limit': '2', 'offset': '4'}):
+        params = {}
+        sql_statement = provider.apply_keyset_pagination('SELECT * FROM t', params, ORDER_BY)
+    assert sql_statement.startswith('SELECT * FROM t ORDER BY label ASC, ffrom DESC, tto DESC, observation_id ASC')
+    assert params == {'limit': 2, 'offset': 4}
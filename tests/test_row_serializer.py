@@ -0,0 +1,78 @@
+#
+# The serialized rows are the bytes of json.dumps of the same rows, compact with the keys in plan order.
+# @version 1.0
+#
+
+import json
+import math
+import itertools
+from datetime import datetime
+from werkzeug.http import http_date
+from permafrost_observations_api.providers.row_serializer import RowSerializer
+
+class FakeResults:
+    def __init__(self, keys, rows):
+        self.columns = keys
+        self.rows = iter(rows)
+
+    def keys(self):
+        return self.columns
+
+    def fetchmany(self, size):
+        return list(itertools.islice(self.rows, size))
+
+KEYS = ['loc_name', 'height', 'temperature', 'count', 'comment', 'time']
+
+ROWS = [
+    ('LOC1', 0.5, -1.25, 3, 'ice é "lens"\n', datetime(2020, 1, 2, 3, 4, 5)),
+    ('LOC1', 10.0, 1e-7, 0, None, datetime(2020, 1, 2, 3, 4, 5)),
+    ('LOC☃', None, None, None, '', None),
+    ('LOC2', -0.0, 123456789.123, -7, 'tab\there', datetime(1999, 12, 31, 23, 59, 59))
+]
+
+SERIALIZER = RowSerializer([
+    ('name', 'loc_name', 'string'),
+    ('depth', 'height', 'float'),
+    ('value', 'temperature', 'float'),
+    ('count', 'count', 'int'),
+    ('comment', 'comment', 'value'),
+    ('time', 'time', 'http_date')
+])
+
+def expected_body(rows):
+    records = []
+    for row in rows:
+        record = dict(zip(['name', 'depth', 'value', 'count', 'comment'], row[:5]))
+        record['time'] = http_date(row[5].utctimetuple()) if row[5] != None else None
+        records.append(record)
+    return json.dumps(records, separators=(',', ':'))
+
+def test_serialize_matches_json_dumps(app):
+    with app.app_context():
+        serialized = SERIALIZER.serialize(FakeResults(KEYS, ROWS))
+    assert serialized.body == expected_body(ROWS)
+    assert serialized.count == len(ROWS)
+    assert serialized.last_row == ROWS[-1]
+
+def test_serialize_source_columns_in_any_order(app):
+    keys = list(reversed(KEYS))
+    rows = [tuple(reversed(row)) for row in ROWS]
+    with app.app_context():
+        serialized = SERIALIZER.serialize(FakeResults(keys, rows), batch_size=3)
+    assert serialized.body == expected_body(ROWS)
+
+def test_serialize_no_rows(app):
+    with app.app_context():
+        serialized = SERIALIZER.serialize(FakeResults(KEYS, []))
+    assert serialized.body == '[]'
+    assert serialized.count == 0
+    assert serialized.last_row == None
+
+def test_serialize_special_floats(app):
+    serializer = RowSerializer([('value', 'value', 'float'), ('other', 'other', 'float_or_empty_string')])
+    rows = [(math.nan, math.nan), (math.inf, -math.inf)]
+    with app.app_context():
+        serialized = serializer.serialize(FakeResults(['value', 'other'], rows))
+    # json.dumps writes NaN, the NaN of the float_or_empty_string columns is an empty string.
+    assert serialized.body == json.dumps([{'value': math.nan, 'other': ''}, {'value': math.inf, 'other': -math.inf}],
+                                         separators=(',', ':'))